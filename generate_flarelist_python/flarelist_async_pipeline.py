@@ -0,0 +1,262 @@
+import asyncio
+import glob
+import logging
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+from astropy.time import Time
+from sunpy.util import SunpyDeprecationWarning
+
+from flarelist_download_manager import DownloadManager
+from flarelist_generate import (fetch_operational_flare_list, merge_and_process_data, _estimate_single_flare_location,
+                                _location_result)
+from flarelist_generate_utils import FileIntervalIndex, search_remote_data
+from flarelist_result_store import FlareResultStore
+
+
+async def locate_flares_async(flare_list, local_files_path, threshold_counts=1000, n_workers=1, max_connections=4,
+                              queue_size=None, result_store=None, attenuator_index=None, lazy_load=False):
+    """
+    Associates flares with data files and estimates their locations, with the downloads and the imaging
+    running at the same time.
+
+    `filter_and_associate_files` finds (and downloads) the files of all flares before
+    `estimate_flare_locations_and_attenuator` images any of them, so a backfill takes the download time
+    plus the imaging time. Here each flare is handed to the imaging as soon as its file is available:
+
+    - one association task per flare looks for a local file, or searches for and downloads the file
+      (at most `max_connections` at a time, in a `DownloadManager`), then puts the flare on a queue;
+    - `n_workers` consumers take flares off the queue and image them in a process pool.
+
+    The flares with local files are queued first, so the imaging starts straight away. The queue holds at
+    most `queue_size` flares: when the imaging falls behind, the association tasks wait to put their flares
+    on it, which stops new downloads from starting until the imaging catches up. The total time then tends
+    to the larger of the download and imaging times rather than their sum.
+
+    The `result_store` writes and the `attenuator_index` updates (which read the FITS files) run in a
+    separate thread, one at a time, so they don't hold up the downloads and imaging on the event loop.
+
+    If the coroutine is cancelled (or any task fails), the remaining tasks are cancelled, and the queued
+    downloads and imaging of flares not yet started are dropped.
+
+    Parameters
+    ----------
+    flare_list : pd.DataFrame
+        The operational flare list, as returned by `fetch_operational_flare_list`.
+    local_files_path : str
+        Path to the directory containing local .fits files, where downloaded files are also saved.
+    threshold_counts : float, default=1000
+        Only flares with counts in the 4-10 keV channel above this value are processed.
+    n_workers : int, default=1
+        Number of processes imaging the flares.
+    max_connections : int, default=4
+        Maximum number of files searched for and downloaded at the same time.
+    queue_size : int, optional
+        Maximum number of flares waiting to be imaged. Default is twice `n_workers`.
+    result_store : `FlareResultStore`, optional
+        Store of the file and location results of each flare, see `get_flares`. Flares with stored
+        locations are not imaged again.
+    attenuator_index : `AttenuatorIndex`, optional
+        Index used to find the attenuator status of each flare once its file is available,
+        see `filter_and_associate_files`.
+    lazy_load : bool, default=False
+        Only read the time bins of each file around the flare peak, see `estimate_flare_locations_and_attenuator`.
+
+    Returns
+    -------
+    pd.DataFrame
+        The flares above the threshold with their files and locations, in the same form as returned by
+        `estimate_flare_locations_and_attenuator` (and in the same order as `flare_list`).
+
+    Example Usage:
+    -------------
+    >>> flare_list_with_locations = asyncio.run(locate_flares_async(flare_list, '/path/to/local/files', n_workers=4))
+
+    """
+    flares = flare_list[flare_list["LC0_PEAK_COUNTS_4S"] >= threshold_counts].reset_index(drop=True)
+    rows = [row for _, row in flares.iterrows()]
+    file_names = [None] * len(rows)
+    flare_results = [None] * len(rows)
+    queue_size = queue_size or 2 * max(1, n_workers)
+    logging.info(f'Locating {len(rows)} flares with {n_workers} imaging workers and {max_connections} downloads')
+
+    local_files = FileIntervalIndex(glob.glob(f"{local_files_path}/*.fits"))
+    local_matches = local_files.find_many(flares["peak_UTC"])
+    stored_files = result_store.get_files() if result_store is not None else {}
+    stored_locations = result_store.get_locations() if result_store is not None else {}
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=queue_size)
+    connections = asyncio.Semaphore(max_connections)
+    download_manager = DownloadManager(max_connections=max_connections)
+    executor = ProcessPoolExecutor(max_workers=max(1, n_workers))
+    # a single thread for the SQLite databases, so they are only used by one thread at a time
+    database = ThreadPoolExecutor(max_workers=1)
+    estimate = partial(_estimate_single_flare_location, lazy_load=lazy_load)
+
+    async def in_database(func, *args):
+        return await loop.run_in_executor(database, partial(func, *args))
+
+    async def associate(i):
+        row = rows[i]
+        file = local_matches[i] or stored_files.get(row["flare_id"])
+        if file is not None:
+            await enqueue(i, file)
+            return
+        async with connections:
+            # a file downloaded (or being downloaded) for an earlier flare may also contain this one
+            file = local_files.find(row["peak_UTC"])
+            pending = download_manager.find_pending(row["peak_UTC"]) if file is None else None
+            if file is None and pending is None:
+                # the search is blocking, so it runs in a thread, then the download is awaited
+                file = await asyncio.to_thread(search_remote_data, row, path=local_files_path + "/{file}",
+                                               download_manager=download_manager)
+                if file is not None:
+                    file = await asyncio.wrap_future(file)
+                if file:
+                    local_files.add(file)
+            if pending is None:
+                # the connection is held until the flare is queued, so no more downloads start while the queue is full
+                await enqueue(i, file)
+                return
+        # the download is already counted against the connections of the flare that queued it
+        file = await asyncio.wrap_future(pending)
+        if file:
+            local_files.add(file)
+        await enqueue(i, file)
+
+    async def enqueue(i, file):
+        row = rows[i]
+        file_names[i] = file if file else "file_issue"
+        if result_store is not None and file:
+            await in_database(result_store.put_file, row["flare_id"], file)
+
+        row = row.copy()
+        row["filenames"] = file_names[i]
+        if attenuator_index is not None and file:
+            row["attenuator_in"] = await in_database(_attenuator_status, attenuator_index, file, row["peak_UTC"])
+        # waits here while the queue is full
+        await queue.put((i, row))
+
+    # flares with a local file first, so the imaging can start while the others are downloaded
+    order = sorted(range(len(rows)), key=lambda i: local_matches[i] is None)
+    pending = [i for i in order if stored_locations.get(rows[i]["flare_id"]) is None]
+    for i in set(range(len(rows))) - set(pending):
+        file_names[i] = local_matches[i] or stored_files.get(rows[i]["flare_id"], "file_issue")
+        flare_results[i] = stored_locations[rows[i]["flare_id"]]
+
+    async def produce():
+        await asyncio.gather(*(associate(i) for i in pending))
+        for _ in range(n_consumers):
+            await queue.put(None)
+
+    n_done = 0
+
+    async def consume():
+        nonlocal n_done
+        while (item := await queue.get()) is not None:
+            i, row = item
+            if row["filenames"] == "file_issue":
+                # not stored, so that the file is searched for again on resume
+                flare_results[i] = _location_result(row, False)
+            else:
+                flare_results[i] = await loop.run_in_executor(executor, estimate, row)
+                if result_store is not None:
+                    await in_database(result_store.put_location, flare_results[i])
+            n_done += 1
+            logging.info(f"Processed flare locations {n_done}/{len(pending)}")
+
+    n_consumers = max(1, n_workers)
+    tasks = [asyncio.create_task(produce())] + [asyncio.create_task(consume()) for _ in range(n_consumers)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        database.shutdown(wait=True, cancel_futures=True)
+        download_manager.close(wait=False)
+
+    flares["filenames"] = file_names
+    results = pd.DataFrame(flare_results,
+                           columns=["loc_x", "loc_y", "loc_x_stix", "loc_y_stix", "sidelobes_ratio", "flare_id",
+                                    "error", "attenuator"])
+    return pd.concat([flares, results], axis=1)
+
+
+def _attenuator_status(attenuator_index, file, peak_time):
+    """
+    Attenuator status in the ±20 s around `peak_time` from the index, after indexing `file`,
+    or NaN if the file can't be indexed or the lookup fails (the status is then checked from the data).
+    """
+    try:
+        attenuator_index.update([file])
+        if not attenuator_index.indexed([file])[0]:
+            return np.nan
+        peak = pd.to_datetime(peak_time, format="ISO8601")
+        return attenuator_index.attenuator_in([peak - pd.Timedelta(20, "s")], [peak + pd.Timedelta(20, "s")])[0]
+    except Exception as e:
+        # a failed lookup only affects this flare, rather than cancelling the pipeline
+        logging.warning(f"Error finding the attenuator status at {peak_time} from the index: {e}")
+        return np.nan
+
+
+def get_flares_pipelined(tstart, tend, local_files_path, n_workers=1, max_connections=4, queue_size=None,
+                         resume_path=None):
+    """
+    Fetches and returns a fully processed flare list with locations included, as `get_flares` does,
+    but with the file downloads and the imaging of steps 2 and 3 overlapped by `locate_flares_async`.
+
+    Parameters:
+    ----------
+    tstart : str or `~astropy.time.Time`
+        Start time of the query in ISO format or as an Astropy Time object.
+    tend : str or `~astropy.time.Time`
+        End time of the query in ISO format or as an Astropy Time object.
+    local_files_path : str
+        Path to the directory containing local .fits files.
+    n_workers : int, default=1
+        Number of processes imaging the flares.
+    max_connections : int, default=4
+        Maximum number of files searched for and downloaded at the same time.
+    queue_size : int, optional
+        Maximum number of flares waiting to be imaged, see `locate_flares_async`.
+    resume_path : str, optional
+        Path to a `FlareResultStore` database, see `get_flares`.
+
+    Return:
+    ------
+    pd.DataFrame
+        A fully processed DataFrame containing the list of flares with locations.
+
+    Example Usage:
+    -------------
+    >>> from flarelist_async_pipeline import get_flares_pipelined
+    >>> flares = get_flares_pipelined('2023-01-01', '2023-02-01', '/path/to/local/files', n_workers=4)
+
+    """
+    warnings.filterwarnings("ignore", category=SunpyDeprecationWarning)
+
+    tstart, tend = Time(tstart), Time(tend)
+    logging.info(f'Retrieving and processing flares between {tstart} and {tend}')
+
+    flare_list = fetch_operational_flare_list(tstart, tend)
+
+    result_store = FlareResultStore(resume_path) if resume_path is not None else None
+    try:
+        flare_list_with_locations = asyncio.run(
+            locate_flares_async(flare_list, local_files_path, n_workers=n_workers, max_connections=max_connections,
+                                queue_size=queue_size, result_store=result_store))
+    finally:
+        if result_store is not None:
+            result_store.close()
+
+    final_flarelist_with_locations = merge_and_process_data(flare_list_with_locations)
+    logging.info('Flare processing completed successfully.')
+    return final_flarelist_with_locations
@@ -0,0 +1,221 @@
+import os
+import logging
+import sqlite3
+
+import numpy as np
+import pandas as pd
+from astropy import units as u
+from astropy.io import fits
+from astropy.time import Time
+
+
+class AttenuatorIndex:
+    """
+    Persistent index of the time intervals in which the STIX attenuator is inserted, in a SQLite database.
+
+    The intervals are runs of consecutive time bins with a non-zero `rcr` (rate control regime), extracted
+    once per file from the `time` and `rcr` columns of its DATA table only, without decoding the product.
+    Each interval goes from the centre of its first to the centre of its last time bin, so a time window
+    overlaps an interval if and only if (for time bins shorter than the window) a time bin centred in the
+    window has a non-zero `rcr`, which is the test applied to the whole data table for each flare by
+    `estimate_flare_locations_and_attenuator`.
+
+    The attenuator status of every flare is then one interval join of the flare time windows with the
+    intervals of all indexed files (see `attenuator_in`). As the attenuator is a state of the instrument,
+    the intervals of any file covering a time apply to every flare at that time.
+
+    Parameters
+    ----------
+    path : str, optional
+        Path to the SQLite database, created if it does not exist. Default is `stix_attenuator_index.sqlite`.
+
+    Example Usage:
+    -------------
+    >>> index = AttenuatorIndex()
+    >>> index.update(flarelist["filenames"])
+    >>> flarelist["attenuator_in"] = index.attenuator_in(peak_times - 20 * u.s, peak_times + 20 * u.s)
+
+    """
+
+    def __init__(self, path="stix_attenuator_index.sqlite"):
+        self.path = path
+        # can be used from another thread (one at a time), e.g. off the event loop in `locate_flares_async`
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS intervals (path TEXT, start_time TEXT, end_time TEXT)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS intervals_path ON intervals (path)")
+        self._conn.commit()
+        self._intervals = None
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+    def update(self, files):
+        """
+        Index any of `files` that are not yet indexed, or have changed since they were.
+
+        Files that are missing (e.g. deleted since they were associated with a flare) or can't be read
+        are skipped with a warning, and removed from the index. `indexed` tells which files are indexed.
+
+        Returns
+        -------
+        int
+            the number of files that were (re)indexed.
+        """
+        known = {path: (size, mtime_ns) for path, size, mtime_ns in
+                 self._conn.execute("SELECT path, size, mtime_ns FROM files")}
+        n_indexed = 0
+        for file in dict.fromkeys(files):
+            try:
+                stat = os.stat(file)
+                if known.get(os.fspath(file)) != (stat.st_size, stat.st_mtime_ns):
+                    self.add(file)
+                    n_indexed += 1
+            except Exception as e:
+                logging.warning(f"Could not index the attenuator intervals of {file}: {e}")
+                if os.fspath(file) in known:
+                    self.remove(file)
+        if n_indexed:
+            logging.info(f"Indexed the attenuator intervals of {n_indexed} files")
+        return n_indexed
+
+    def add(self, file):
+        """
+        Extract the attenuator intervals of a file and store them, replacing any stored for it.
+        """
+        path = os.fspath(file)
+        stat = os.stat(path)
+        starts, ends = read_attenuator_intervals(path)
+        with self._conn:
+            self._conn.execute("DELETE FROM intervals WHERE path = ?", (path,))
+            self._conn.executemany("INSERT INTO intervals VALUES (?, ?, ?)",
+                                   [(path, _to_iso(start), _to_iso(end)) for start, end in zip(starts, ends)])
+            self._conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (path, stat.st_size, stat.st_mtime_ns))
+        self._intervals = None
+
+    def indexed(self, files):
+        """
+        Whether each of `files` is in the index.
+
+        Returns
+        -------
+        `numpy.ndarray`
+            boolean array, True for the files that are indexed.
+        """
+        paths = {path for path, in self._conn.execute("SELECT path FROM files")}
+        return np.array([os.fspath(file) in paths for file in files], dtype=bool)
+
+    def remove(self, file):
+        """
+        Remove a file and its intervals from the index.
+        """
+        path = os.fspath(file)
+        with self._conn:
+            self._conn.execute("DELETE FROM intervals WHERE path = ?", (path,))
+            self._conn.execute("DELETE FROM files WHERE path = ?", (path,))
+        self._intervals = None
+
+    def to_dataframe(self):
+        """
+        Return the stored intervals as a DataFrame with `path`, `start_time` and `end_time` columns.
+        """
+        intervals = pd.read_sql_query("SELECT path, start_time, end_time FROM intervals ORDER BY start_time", self._conn)
+        intervals["start_time"] = pd.to_datetime(intervals["start_time"], format="ISO8601")
+        intervals["end_time"] = pd.to_datetime(intervals["end_time"], format="ISO8601")
+        return intervals
+
+    def attenuator_in(self, starts, ends):
+        """
+        Whether the attenuator is inserted at any time from each of `starts` to the matching `ends`.
+
+        Parameters
+        ----------
+        starts, ends : array-like
+            Start and end times of the windows (e.g. around each flare peak), as `astropy.time.Time`
+            or anything `pd.to_datetime` understands.
+
+        Returns
+        -------
+        `numpy.ndarray`
+            boolean array, True for the windows that overlap an attenuator interval.
+        """
+        interval_starts, running_ends = self._sorted_intervals()
+        starts, ends = _to_datetime64(starts), _to_datetime64(ends)
+        if len(interval_starts) == 0:
+            # nothing indexed yet, or no attenuator motion in any indexed file
+            return np.zeros(len(starts), dtype=bool)
+        # the last interval starting before the end of each window, and the latest end of all intervals up to it
+        last = np.searchsorted(interval_starts, ends, side="right") - 1
+        return (last >= 0) & (running_ends[np.maximum(last, 0)] >= starts)
+
+    def _sorted_intervals(self):
+        # interval starts in order, with the running maximum of the ends, kept until the index changes
+        if self._intervals is None:
+            intervals = self.to_dataframe()
+            starts = intervals["start_time"].to_numpy(dtype="datetime64[ns]")
+            ends = np.maximum.accumulate(intervals["end_time"].to_numpy(dtype="datetime64[ns]"))
+            self._intervals = starts, ends
+        return self._intervals
+
+
+def read_attenuator_intervals(file):
+    """
+    Attenuator intervals of a STIX science data file, from the `time` and `rcr` columns of its DATA table.
+
+    Only the two columns are read (memory mapped), rather than decoding the whole product.
+
+    Raises
+    ------
+    ValueError
+        if the `time` column has no unit, as the time offsets can't then be converted.
+
+    Returns
+    -------
+    tuple of `numpy.ndarray`
+        datetime64 start and end times (centres of the first and last time bins) of each run of
+        consecutive time bins with a non-zero `rcr`.
+    """
+    with fits.open(file, memmap=True) as hdul:
+        header = hdul[0].header
+        date_obs = header.get("DATE-OBS", header.get("DATE_OBS"))
+        data = hdul["DATA"]
+        if not data.columns["time"].unit:
+            raise ValueError(f"The time column of {file} has no unit")
+        unit = u.Unit(data.columns["time"].unit)
+        offsets = (np.array(data.data["time"], dtype=float) * unit).to_value(u.ns).astype(np.int64)
+        rcr = np.array(data.data["rcr"]) != 0
+
+    times = Time(date_obs).datetime64.astype("datetime64[ns]") + offsets.astype("timedelta64[ns]")
+    return attenuator_intervals(times, rcr)
+
+
+def attenuator_intervals(times, rcr):
+    """
+    Start and end times of each run of consecutive time bins with a non-zero `rcr`.
+
+    Parameters
+    ----------
+    times : `numpy.ndarray`
+        datetime64 centre times of the time bins.
+    rcr : array-like
+        `rcr` of each time bin.
+    """
+    inserted = np.concatenate([[False], np.asarray(rcr) != 0, [False]])
+    edges = np.diff(inserted.astype(np.int8))
+    first = np.flatnonzero(edges == 1)
+    last = np.flatnonzero(edges == -1) - 1
+    return times[first], times[last]
+
+
+def _to_datetime64(times):
+    if isinstance(times, Time):
+        return np.atleast_1d(times.datetime64).astype("datetime64[ns]")
+    return pd.to_datetime(np.atleast_1d(np.asarray(times)), format="ISO8601").to_numpy(dtype="datetime64[ns]")
+
+
+def _to_iso(time):
+    # fixed width so that the stored times also sort as text
+    return pd.Timestamp(time).strftime("%Y-%m-%dT%H:%M:%S.%f")
@@ -0,0 +1,282 @@
+import logging
+
+import numpy as np
+import pandas as pd
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from sunpy.coordinates import frames, SphericalScreen, get_earth
+import sunpy.sun.constants as sun_const
+
+from flarelist_coord_utils import is_visible
+
+
+RSUN_KM = sun_const.radius.to_value(u.km)
+
+
+def hpc_to_hgs(tx, ty, observer_lon, observer_lat, observer_radius, rsun=RSUN_KM):
+    """
+    Transform Helioprojective coordinates to Heliographic Stonyhurst, for arrays of coordinates and observers.
+
+    Points on the solar disk are placed on the solar surface. Points off the disk are placed on a
+    spherical screen centred on the observer and passing through Sun centre, the same as
+    `sunpy.coordinates.SphericalScreen(observer, only_off_disk=True)`.
+
+    Parameters
+    ----------
+    tx, ty : `numpy.ndarray`
+        Helioprojective longitude and latitude in arcsec.
+    observer_lon, observer_lat : `numpy.ndarray`
+        HGS longitude and latitude of the observer in degrees.
+    observer_radius : `numpy.ndarray`
+        Distance of the observer from Sun centre in km.
+    rsun : float, optional
+        Solar radius in km.
+
+    Returns
+    -------
+    lon, lat, radius : `numpy.ndarray`
+        HGS longitude (-180 to 180) and latitude in degrees, and distance from Sun centre in km.
+    """
+    tx, ty = np.deg2rad(np.asarray(tx, dtype=float) / 3600), np.deg2rad(np.asarray(ty, dtype=float) / 3600)
+    d0 = np.asarray(observer_radius, dtype=float)
+
+    # distance along the line of sight to the solar surface (near side), or to the screen if off disk
+    cos_alpha = np.cos(ty) * np.cos(tx)
+    with np.errstate(invalid="ignore"):
+        discriminant = rsun**2 - d0**2 * (1 - cos_alpha**2)
+        distance = np.where(discriminant >= 0, d0 * cos_alpha - np.sqrt(discriminant), d0)
+
+    # heliocentric cartesian, z towards the observer
+    x = distance * np.cos(ty) * np.sin(tx)
+    y = distance * np.sin(ty)
+    z = d0 - distance * cos_alpha
+
+    b0 = np.deg2rad(observer_lat)
+    l0 = np.deg2rad(observer_lon)
+    radius = np.sqrt(x**2 + y**2 + z**2)
+    lat = np.arcsin((y * np.cos(b0) + z * np.sin(b0)) / radius)
+    lon = l0 + np.arctan2(x, z * np.cos(b0) - y * np.sin(b0))
+    lon = (lon + np.pi) % (2 * np.pi) - np.pi
+
+    return np.rad2deg(lon), np.rad2deg(lat), radius
+
+
+def hgs_to_hpc(lon, lat, radius, observer_lon, observer_lat, observer_radius):
+    """
+    Transform Heliographic Stonyhurst coordinates to Helioprojective, for arrays of coordinates and observers.
+
+    Parameters
+    ----------
+    lon, lat : `numpy.ndarray`
+        HGS longitude and latitude in degrees.
+    radius : `numpy.ndarray`
+        Distance from Sun centre in km.
+    observer_lon, observer_lat : `numpy.ndarray`
+        HGS longitude and latitude of the observer in degrees.
+    observer_radius : `numpy.ndarray`
+        Distance of the observer from Sun centre in km.
+
+    Returns
+    -------
+    tx, ty, distance : `numpy.ndarray`
+        Helioprojective longitude and latitude in arcsec, and distance from the observer in km.
+    """
+    lon, lat = np.deg2rad(lon), np.deg2rad(lat)
+    b0, l0 = np.deg2rad(observer_lat), np.deg2rad(observer_lon)
+    d0 = np.asarray(observer_radius, dtype=float)
+
+    # heliocentric cartesian, z towards the observer
+    x = radius * np.cos(lat) * np.sin(lon - l0)
+    y = radius * (np.sin(lat) * np.cos(b0) - np.cos(lat) * np.sin(b0) * np.cos(lon - l0))
+    z = radius * (np.sin(lat) * np.sin(b0) + np.cos(lat) * np.cos(b0) * np.cos(lon - l0))
+
+    distance = np.sqrt(x**2 + y**2 + (d0 - z)**2)
+    tx = np.arctan2(x, d0 - z)
+    ty = np.arcsin(y / distance)
+
+    return np.rad2deg(tx) * 3600, np.rad2deg(ty) * 3600, distance
+
+
+def is_visible_hpc(tx, ty, distance, observer_radius, rsun=RSUN_KM):
+    """
+    Array version of `flarelist_coord_utils.is_visible` for Helioprojective coordinates
+    given as Tx, Ty (arcsec) and distance from the observer (km).
+    """
+    tx, ty = np.deg2rad(np.asarray(tx) / 3600), np.deg2rad(np.asarray(ty) / 3600)
+    data_x = distance * np.cos(ty) * np.cos(tx)
+    data_y = distance * np.cos(ty) * np.sin(tx)
+    data_z = distance * np.sin(ty)
+
+    is_behind = data_x < 0
+    with np.errstate(invalid="ignore"):
+        is_beyond_limb = np.sqrt(1 - (data_x / distance)**2) > rsun / observer_radius
+    is_on_near_side = (data_x * (observer_radius - data_x) - data_y**2 - data_z**2) >= 0
+
+    return is_behind | is_beyond_limb | is_on_near_side
+
+
+def transform_solo_hpc(hpc_x_solo, hpc_y_solo, solo_coords, earth_coords, obstime):
+    """
+    Transform flare locations in Helioprojective coordinates from Solar Orbiter to Earth Helioprojective,
+    Heliographic Stonyhurst and Heliographic Carrington coordinates, with the visibility from Earth.
+
+    This is an array (NumPy) version of the transformations in `merge_and_process_data`, including the
+    spherical screen for flares off the disk as seen from Solar Orbiter.
+
+    Parameters
+    ----------
+    hpc_x_solo, hpc_y_solo : `numpy.ndarray`
+        Flare location in arcsec as seen from Solar Orbiter.
+    solo_coords, earth_coords : `~sunpy.coordinates.frames.HeliographicStonyhurst`
+        Positions of Solar Orbiter and Earth for each flare.
+    obstime : `~astropy.time.Time`
+        Time of each flare.
+
+    Returns
+    -------
+    dict
+        arrays with keys hpc_x_earth, hpc_y_earth, visible_from_earth, hgs_lon, hgs_lat, hgc_lon, hgc_lat.
+    """
+    solo_lon, solo_lat = solo_coords.lon.to_value(u.deg), solo_coords.lat.to_value(u.deg)
+    solo_radius = solo_coords.radius.to_value(u.km)
+    earth_lon, earth_lat = earth_coords.lon.to_value(u.deg), earth_coords.lat.to_value(u.deg)
+    earth_radius = earth_coords.radius.to_value(u.km)
+
+    hgs_lon, hgs_lat, radius = hpc_to_hgs(hpc_x_solo, hpc_y_solo, solo_lon, solo_lat, solo_radius)
+    hpc_x_earth, hpc_y_earth, distance = hgs_to_hpc(hgs_lon, hgs_lat, radius, earth_lon, earth_lat, earth_radius)
+
+    # the Carrington longitude offset is smooth in time, so only the zero point is transformed by sunpy
+    zero_hgs = SkyCoord(np.zeros(len(hgs_lon)) * u.deg, np.zeros(len(hgs_lon)) * u.deg,
+                        frame=frames.HeliographicStonyhurst(obstime=obstime))
+    carrington_offset = zero_hgs.transform_to(frames.HeliographicCarrington(observer=solo_coords)).lon.to_value(u.deg)
+    hgc_lon = (hgs_lon + carrington_offset) % 360
+
+    return {"hpc_x_earth": hpc_x_earth, "hpc_y_earth": hpc_y_earth,
+            "visible_from_earth": is_visible_hpc(hpc_x_earth, hpc_y_earth, distance, earth_radius),
+            "hgs_lon": hgs_lon, "hgs_lat": hgs_lat, "hgc_lon": hgc_lon, "hgc_lat": hgs_lat}
+
+
+def validate_against_sunpy(flarelist, n_sample=None, atol=1e-3 * u.arcsec):
+    """
+    Compare `transform_solo_hpc` against the sunpy transformations used in `merge_and_process_data`.
+
+    The flare locations and Solar Orbiter positions are taken from a final flarelist (e.g. one of
+    the published csv files), and the Earth positions from `sunpy.coordinates.get_earth`. Both
+    transformations are then run on these inputs and the differences are logged and returned.
+
+    Parameters
+    ----------
+    flarelist : pd.DataFrame or str
+        The final flarelist or the path to its csv file. Needs the columns peak_UTC, hpc_x_solo,
+        hpc_y_solo, solo_position_lon, solo_position_lat and solo_position_AU_distance.
+    n_sample : int, optional
+        Only compare a random sample of this many flares.
+    atol : `astropy.units.Quantity`, optional
+        Tolerance used to report whether the results agree, default 1e-3 arcsec (and the same
+        angle in degrees for the heliographic coordinates).
+
+    Returns
+    -------
+    dict
+        maximum absolute difference for each column, and the number of flares with a different visibility.
+    """
+    if isinstance(flarelist, str):
+        flarelist = pd.read_csv(flarelist)
+    flarelist = flarelist.dropna(subset=["hpc_x_solo", "hpc_y_solo"])
+    if n_sample is not None and n_sample < len(flarelist):
+        flarelist = flarelist.sample(n_sample, random_state=0)
+
+    obstime = pd.to_datetime(flarelist["peak_UTC"], format="ISO8601").to_numpy()
+    solo_coords = frames.HeliographicStonyhurst(lon=flarelist["solo_position_lon"].to_numpy() * u.deg,
+                                                lat=flarelist["solo_position_lat"].to_numpy() * u.deg,
+                                                radius=flarelist["solo_position_AU_distance"].to_numpy() * u.AU,
+                                                obstime=obstime)
+    earth_coords = get_earth(solo_coords.obstime)
+    hpc_x_solo, hpc_y_solo = flarelist["hpc_x_solo"].to_numpy(), flarelist["hpc_y_solo"].to_numpy()
+
+    fast = transform_solo_hpc(hpc_x_solo, hpc_y_solo, solo_coords, earth_coords, solo_coords.obstime)
+
+    flare_coords_solo_hpc = SkyCoord(hpc_x_solo * u.arcsec, hpc_y_solo * u.arcsec,
+                                     frame=frames.Helioprojective(observer=solo_coords, obstime=solo_coords.obstime))
+    with SphericalScreen(flare_coords_solo_hpc.observer, only_off_disk=True):
+        flare_coords_earth_hpc = flare_coords_solo_hpc.transform_to(frames.Helioprojective(observer=earth_coords))
+        flare_coords_hgs = flare_coords_solo_hpc.transform_to(frames.HeliographicStonyhurst)
+        flare_coords_hgc = flare_coords_solo_hpc.transform_to(frames.HeliographicCarrington)
+    reference = {"hpc_x_earth": flare_coords_earth_hpc.Tx.to_value(u.arcsec),
+                 "hpc_y_earth": flare_coords_earth_hpc.Ty.to_value(u.arcsec),
+                 "hgs_lon": flare_coords_hgs.lon.to_value(u.deg), "hgs_lat": flare_coords_hgs.lat.to_value(u.deg),
+                 "hgc_lon": flare_coords_hgc.lon.to_value(u.deg), "hgc_lat": flare_coords_hgc.lat.to_value(u.deg)}
+
+    differences = {}
+    for key, values in reference.items():
+        diff = np.abs(fast[key] - values)
+        if key.endswith("lon"):
+            diff = np.minimum(diff, 360 - diff)
+        tolerance = atol.to_value(u.arcsec if key.startswith("hpc") else u.deg)
+        differences[key] = np.nanmax(diff)
+        logging.info(f"{key}: max difference {differences[key]:.3g}, "
+                     f"{'within' if differences[key] <= tolerance else 'OUTSIDE'} tolerance {tolerance:.3g}")
+
+    differences["visible_from_earth"] = int(np.sum(fast["visible_from_earth"] != is_visible(flare_coords_earth_hpc)))
+    logging.info(f"visible_from_earth: {differences['visible_from_earth']} of {len(flarelist)} flares differ")
+    return differences
+
+
+def add_observer_columns(flarelist, observers, solo_coords=None):
+    """
+    Add the Helioprojective coordinates and visibility of each flare for several observers.
+
+    The flare locations are transformed from Solar Orbiter HPC to HGS once, and then to the
+    HPC frame of each observer, all as array operations. For an observer called `name` the
+    columns `hpc_x_{name}`, `hpc_y_{name}` (NaN if not visible) and `visible_from_{name}` are added.
+
+    Parameters
+    ----------
+    flarelist : pd.DataFrame
+        final flarelist with the columns hpc_x_solo and hpc_y_solo, and (if `solo_coords` is not given)
+        peak_UTC, solo_position_lon, solo_position_lat and solo_position_AU_distance.
+    observers : dict
+        mapping of observer name (e.g. "stereo_a", "psp", "l1") to its positions at the time of each flare,
+        as a `~sunpy.coordinates.frames.HeliographicStonyhurst` (or anything that can be transformed to it).
+    solo_coords : `~sunpy.coordinates.frames.HeliographicStonyhurst`, optional
+        positions of Solar Orbiter for each flare, defaults to the solo_position columns of `flarelist`.
+
+    Returns
+    -------
+    pd.DataFrame
+        `flarelist` with the observer columns added.
+
+    Example Usage:
+    -------------
+    >>> from sunpy.coordinates import get_horizons_coord
+    >>> stereo_a = get_horizons_coord("STEREO-A", Time(flarelist["peak_UTC"]))
+    >>> flarelist = add_observer_columns(flarelist, {"stereo_a": stereo_a})
+
+    """
+    if solo_coords is None:
+        solo_coords = frames.HeliographicStonyhurst(lon=flarelist["solo_position_lon"].to_numpy() * u.deg,
+                                                    lat=flarelist["solo_position_lat"].to_numpy() * u.deg,
+                                                    radius=flarelist["solo_position_AU_distance"].to_numpy() * u.AU)
+
+    hgs_lon, hgs_lat, radius = hpc_to_hgs(flarelist["hpc_x_solo"].to_numpy(), flarelist["hpc_y_solo"].to_numpy(),
+                                          solo_coords.lon.to_value(u.deg), solo_coords.lat.to_value(u.deg),
+                                          solo_coords.radius.to_value(u.km))
+
+    # stack all observers so that the transformation is done in one pass, shape (n_observers, n_flares)
+    names = list(observers)
+    observer_hgs = [observers[name] if isinstance(observers[name], frames.HeliographicStonyhurst)
+                    else observers[name].transform_to(frames.HeliographicStonyhurst) for name in names]
+    observer_lon = np.stack([np.broadcast_to(o.lon.to_value(u.deg), hgs_lon.shape) for o in observer_hgs])
+    observer_lat = np.stack([np.broadcast_to(o.lat.to_value(u.deg), hgs_lon.shape) for o in observer_hgs])
+    observer_radius = np.stack([np.broadcast_to(o.radius.to_value(u.km), hgs_lon.shape) for o in observer_hgs])
+
+    tx, ty, distance = hgs_to_hpc(hgs_lon, hgs_lat, radius, observer_lon, observer_lat, observer_radius)
+    visible = is_visible_hpc(tx, ty, distance, observer_radius)
+
+    flarelist = flarelist.copy()
+    for i, name in enumerate(names):
+        flarelist[f"visible_from_{name}"] = visible[i]
+        flarelist[f"hpc_x_{name}"] = np.where(visible[i], tx[i], np.nan)
+        flarelist[f"hpc_y_{name}"] = np.where(visible[i], ty[i], np.nan)
+
+    return flarelist
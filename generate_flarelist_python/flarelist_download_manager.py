@@ -0,0 +1,185 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from astropy.time import Time
+from sunpy.net import Fido
+from sunpy.time import TimeRange
+
+
+class DownloadManager:
+    """
+    Bounded pool for fetching STIX data files concurrently.
+
+    Each record (a row of a `Fido.search` result) is fetched in a worker thread, with at most
+    `max_connections` downloads running at the same time. Failed downloads are retried with an
+    exponential backoff, and any partially downloaded files are removed before retrying.
+    `submit` returns straight away with a future, so the caller can carry on (e.g. associating
+    other flares with files) while the download runs. Submitting the same record twice returns
+    the same future, so a file is only downloaded once. `submit_any` downloads the first of several
+    matching records that succeeds, and `find_pending` finds a queued download that covers a given time.
+
+    Parameters
+    ----------
+    max_connections : int, default=4
+        Maximum number of files downloaded at the same time.
+    max_retries : int, default=3
+        Number of times a failed download is retried.
+    backoff : float, default=2.0
+        Wait (in seconds) before the first retry, doubled for each further retry.
+    client : optional
+        object with a `fetch` method like `sunpy.net.Fido`, defaults to `Fido`.
+
+    Example Usage:
+    -------------
+    >>> with DownloadManager(max_connections=8) as downloads:
+    ...     future = downloads.submit(res["stix"][0], path="./pixel_data/{file}")
+    >>> future.result()
+
+    """
+
+    def __init__(self, max_connections=4, max_retries=3, backoff=2.0, client=Fido):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.client = client
+        self._executor = ThreadPoolExecutor(max_workers=max_connections)
+        self._futures = {}
+        self._pending = []
+        self._lock = threading.Lock()
+        self._start = None
+        self.n_files = 0
+        self.n_failed = 0
+        self.n_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, record, path):
+        """
+        Queue the download of `record` to `path`.
+
+        Returns
+        -------
+        `concurrent.futures.Future`
+            resolves to the downloaded file, or None if the download failed.
+        """
+        key = (record["Request ID"], TimeRange(record[["Start Time", "End Time"]]).start.isot)
+        with self._lock:
+            if key not in self._futures:
+                if self._start is None:
+                    self._start = time.monotonic()
+                self._futures[key] = self._executor.submit(self._fetch, record, path)
+            return self._futures[key]
+
+    def submit_any(self, records, path):
+        """
+        Queue the download of the first of `records` (e.g. all the files containing a flare) that
+        downloads successfully, trying the next record when a download fails.
+
+        Returns
+        -------
+        `concurrent.futures.Future`
+            resolves to the downloaded file, or None if all downloads failed.
+        """
+        records = list(records)
+        time_ranges = [TimeRange(record[["Start Time", "End Time"]]) for record in records]
+        key = tuple((record["Request ID"], tr.start.isot) for record, tr in zip(records, time_ranges))
+        with self._lock:
+            if key not in self._futures:
+                if self._start is None:
+                    self._start = time.monotonic()
+                self._futures[key] = self._executor.submit(self._fetch_any, records, path)
+                # whichever record is downloaded, the file covers the times common to all of them
+                start, end = max(tr.start for tr in time_ranges), min(tr.end for tr in time_ranges)
+                self._pending.append((start, end, self._futures[key]))
+            return self._futures[key]
+
+    def find_pending(self, time):
+        """
+        Find a download queued with `submit_any` whose file will contain `time`.
+
+        Returns
+        -------
+        `concurrent.futures.Future` or None
+            the download, unless none covers `time` or it has already failed.
+        """
+        time = Time(time)
+        with self._lock:
+            pending = list(self._pending)
+        for start, end, future in pending:
+            if start <= time <= end and not (future.done() and not future.result()):
+                return future
+        return None
+
+    def close(self, wait=True):
+        """
+        Shut down the pool (waiting for queued downloads unless `wait=False`) and log the throughput.
+        """
+        self._executor.shutdown(wait=wait, cancel_futures=not wait)
+        stats = self.stats()
+        logging.info(f"Downloaded {stats['files']} files ({stats['bytes'] / 1e6:.1f} MB, {stats['failed']} failed) "
+                     f"in {stats['seconds']:.1f}s: {stats['bytes_per_s'] / 1e6:.2f} MB/s, "
+                     f"{stats['files_per_s']:.2f} files/s")
+
+    def stats(self):
+        """
+        Throughput of the downloads so far.
+
+        Returns
+        -------
+        dict
+            with keys files, failed, bytes, seconds, bytes_per_s and files_per_s.
+        """
+        seconds = time.monotonic() - self._start if self._start is not None else 0.0
+        with self._lock:
+            n_files, n_failed, n_bytes = self.n_files, self.n_failed, self.n_bytes
+        return {"files": n_files, "failed": n_failed, "bytes": n_bytes, "seconds": seconds,
+                "bytes_per_s": n_bytes / seconds if seconds > 0 else 0.0,
+                "files_per_s": n_files / seconds if seconds > 0 else 0.0}
+
+    def _fetch_any(self, records, path):
+        for record in records:
+            file = self._fetch(record, path)
+            if file:
+                return file
+            if len(records) > 1:
+                logging.warning(f"Trying another file after the download of request {record['Request ID']} failed")
+        return None
+
+    def _fetch(self, record, path):
+        for attempt in range(self.max_retries + 1):
+            try:
+                f = self.client.fetch(record, path=path)
+                errors = getattr(f, "errors", [])
+                if f and not errors:
+                    with self._lock:
+                        self.n_files += 1
+                        self.n_bytes += os.path.getsize(f[0]) if os.path.exists(f[0]) else 0
+                    return f[0]
+                _remove_partial_files(errors)
+                error = errors[0] if errors else "no file returned"
+            except Exception as e:
+                error = e
+
+            if attempt < self.max_retries:
+                wait = self.backoff * 2**attempt
+                logging.warning(f"Download of request {record['Request ID']} failed ({error}), retrying in {wait:.0f}s")
+                time.sleep(wait)
+
+        logging.error(f"Download of request {record['Request ID']} failed after {self.max_retries + 1} attempts")
+        with self._lock:
+            self.n_failed += 1
+        return None
+
+
+def _remove_partial_files(errors):
+    # parfive reports where a failed download was being written to (when the filename was already known)
+    for error in errors:
+        partial = getattr(error, "filepath_partial", None)
+        if isinstance(partial, (str, os.PathLike)) and os.path.exists(partial):
+            os.remove(partial)
@@ -0,0 +1,111 @@
+import os
+import logging
+
+import numpy as np
+import pandas as pd
+from astropy import units as u
+from astropy.time import Time
+from sunpy.coordinates import frames
+import astrospice
+
+
+class EphemerisCache:
+    """
+    Local cache of the Heliographic Stonyhurst positions of Solar Orbiter and Earth.
+
+    The positions are calculated with `astrospice` on a fixed time grid (every `step`), saved to
+    `cache_file`, and positions at any times are then linearly interpolated from the grid in
+    Cartesian HGS coordinates. This means the SPICE kernels only need to be loaded when the grid
+    needs extending, and the positions of many flares are obtained in one array operation.
+
+    Parameters
+    ----------
+    cache_file : str, optional
+        Path of the `.npz` file to keep the grid in. Default is `stix_ephemeris_cache.npz`.
+    step : `astropy.units.Quantity`, optional
+        Spacing of the time grid. Default is 1 hour.
+
+    Notes
+    -----
+    The error of the linear interpolation is at most a h^2 / 8, where h is the grid step and a the
+    acceleration of the body in the (rotating) HGS frame. For Solar Orbiter at perihelion (~0.28 AU)
+    a is below 0.1 m/s^2, so with the default 1 hour step the position error is below ~200 km,
+    i.e. < 1 arcsec as seen from the Sun and far below the STIX back-projection pixel size.
+    The error for Earth is below ~20 km.
+
+    Example Usage:
+    -------------
+    >>> ephemeris = EphemerisCache()
+    >>> solo = ephemeris.positions("solar orbiter", flarelist["peak_UTC"])
+
+    """
+
+    bodies = {"solar orbiter": "SOLAR ORBITER", "earth": "earth"}
+
+    def __init__(self, cache_file="stix_ephemeris_cache.npz", step=1 * u.hour):
+        self.cache_file = cache_file
+        self.step = np.timedelta64(int(step.to_value(u.s)), "s").astype("timedelta64[ns]")
+        self._times = np.array([], dtype="datetime64[ns]")
+        self._xyz = {body: np.empty((0, 3)) for body in self.bodies}
+        if os.path.exists(cache_file):
+            cached = np.load(cache_file)
+            if np.timedelta64(int(cached["step"]), "ns") == self.step:
+                self._times = cached["times"].astype("datetime64[ns]")
+                self._xyz = {body: cached[body.replace(" ", "_")] for body in self.bodies}
+
+    def positions(self, body, times):
+        """
+        Interpolated HGS positions of `body` at `times`.
+
+        Parameters
+        ----------
+        body : str
+            "solar orbiter" or "earth".
+        times : array-like
+            times at which to get the positions (anything `pd.to_datetime` understands).
+
+        Returns
+        -------
+        `~sunpy.coordinates.frames.HeliographicStonyhurst`
+            positions with an `obstime` of `times`.
+        """
+        times = pd.to_datetime(np.atleast_1d(np.asarray(times)), format="ISO8601").to_numpy(dtype="datetime64[ns]")
+        self.ensure(times.min(), times.max())
+
+        grid = self._times.astype(np.int64)
+        t = times.astype(np.int64)
+        xyz = np.stack([np.interp(t, grid, self._xyz[body][:, k]) for k in range(3)], axis=-1)
+
+        radius = np.linalg.norm(xyz, axis=-1)
+        lon = np.arctan2(xyz[:, 1], xyz[:, 0])
+        lat = np.arcsin(xyz[:, 2] / radius)
+        return frames.HeliographicStonyhurst(lon=lon * u.rad, lat=lat * u.rad, radius=radius * u.km,
+                                             obstime=Time(times))
+
+    def ensure(self, tstart, tend):
+        """
+        Make sure the grid covers `tstart` to `tend`, calculating and saving any missing grid points.
+        """
+        tstart = np.datetime64(pd.Timestamp(tstart).floor("D"), "ns")
+        tend = np.datetime64(pd.Timestamp(tend).ceil("D"), "ns") + self.step
+        needed = np.arange(tstart, tend, self.step)
+        missing = np.setdiff1d(needed, self._times)
+        if len(missing) == 0:
+            return
+
+        logging.info(f"Calculating ephemeris for {len(missing)} grid points from {missing[0]} to {missing[-1]}")
+        astrospice.registry.get_kernels("solar orbiter", "predict")
+        new_xyz = {}
+        for body, spice_name in self.bodies.items():
+            coords = astrospice.generate_coords(spice_name, pd.to_datetime(missing)).heliographic_stonyhurst
+            new_xyz[body] = coords.cartesian.xyz.to_value(u.km).T
+
+        times = np.concatenate([self._times, missing])
+        order = np.argsort(times)
+        self._times = times[order]
+        self._xyz = {body: np.concatenate([self._xyz[body], new_xyz[body]])[order] for body in self.bodies}
+        self.save()
+
+    def save(self):
+        np.savez(self.cache_file, times=self._times.astype(np.int64), step=self.step.astype(np.int64),
+                 **{body.replace(" ", "_"): xyz for body, xyz in self._xyz.items()})
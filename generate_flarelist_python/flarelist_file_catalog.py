@@ -0,0 +1,177 @@
+import os
+import re
+import sqlite3
+import logging
+from datetime import datetime
+
+import pandas as pd
+from astropy.io import fits
+from sunpy.time import parse_time
+
+from flarelist_generate_utils import parse_file_date_range, FileIntervalIndex
+
+
+class LocalFileCatalog:
+    """
+    Persistent catalog of the STIX cpd files in a local directory, stored in a SQLite database.
+
+    For each file the catalog holds the time range it covers, the request ID, and the size and
+    modification time of the file. The time range and request ID are taken from the filename
+    where possible, and from the FITS header otherwise, so files that don't follow the
+    `YYYYMMDDTHHMMSS-YYYYMMDDTHHMMSS` naming are also included.
+
+    `update()` only reads files that are new or have changed (size or mtime) since the last scan,
+    and removes entries for files that no longer exist.
+
+    Parameters
+    ----------
+    local_files_path : str
+        Path to the directory containing local .fits files.
+    catalog_path : str, optional
+        Path to the SQLite database. Defaults to `stix_file_catalog.sqlite` in `local_files_path`.
+
+    Example Usage:
+    -------------
+    >>> catalog = LocalFileCatalog('/path/to/local/files')
+    >>> catalog.update()
+    >>> catalog.find('2023-01-01T12:00:00.000')
+
+    """
+
+    def __init__(self, local_files_path, catalog_path=None):
+        self.local_files_path = local_files_path
+        if catalog_path is None:
+            catalog_path = os.path.join(local_files_path, "stix_file_catalog.sqlite")
+        self.catalog_path = catalog_path
+        self._conn = sqlite3.connect(catalog_path)
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS files (
+                                path TEXT PRIMARY KEY,
+                                start_time TEXT,
+                                end_time TEXT,
+                                request_id INTEGER,
+                                size INTEGER,
+                                mtime_ns INTEGER)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS files_time ON files (start_time, end_time)")
+        self._conn.commit()
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+    def update(self):
+        """
+        Scan `local_files_path` and update the catalog for new, changed and removed files.
+
+        Returns
+        -------
+        int
+            number of files that were (re)read.
+
+        """
+        known = {path: (size, mtime_ns) for path, size, mtime_ns
+                 in self._conn.execute("SELECT path, size, mtime_ns FROM files")}
+
+        on_disk = set()
+        new_rows = []
+        with os.scandir(self.local_files_path) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".fits") or not entry.is_file():
+                    continue
+                path = os.path.abspath(entry.path)
+                on_disk.add(path)
+                stat = entry.stat()
+                if known.get(path) == (stat.st_size, stat.st_mtime_ns):
+                    continue
+                try:
+                    start_dt, end_dt, request_id = _read_file_info(path)
+                except Exception as e:
+                    logging.warning(f"Could not read time range of {path}: {e}")
+                    continue
+                new_rows.append((path, _to_iso(start_dt), _to_iso(end_dt), request_id,
+                                 stat.st_size, stat.st_mtime_ns))
+
+        removed = [(path,) for path in known if path not in on_disk]
+        with self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", new_rows)
+            self._conn.executemany("DELETE FROM files WHERE path = ?", removed)
+
+        logging.info(f"Updated file catalog: {len(new_rows)} new or changed, {len(removed)} removed, "
+                     f"{len(on_disk)} files in total")
+        return len(new_rows)
+
+    def add(self, path):
+        """
+        Add a single file (e.g. one that has just been downloaded) to the catalog.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        start_dt, end_dt, request_id = _read_file_info(path)
+        with self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                               (path, _to_iso(start_dt), _to_iso(end_dt), request_id,
+                                stat.st_size, stat.st_mtime_ns))
+
+    def find(self, flare_time):
+        """
+        Find a file in the catalog that contains `flare_time`.
+
+        Parameters
+        ----------
+        flare_time : str or datetime.datetime
+            Time for which to find the matching file
+
+        Returns
+        ------
+        file : str or None
+
+        """
+        flare_iso = _to_iso(pd.Timestamp(flare_time).to_pydatetime())
+        res = self._conn.execute("SELECT path FROM files WHERE start_time <= ? AND end_time >= ? "
+                                 "ORDER BY start_time DESC LIMIT 1", (flare_iso, flare_iso)).fetchone()
+        return res[0] if res else None
+
+    def to_dataframe(self):
+        """
+        Return the catalog as a `pd.DataFrame`.
+        """
+        catalog = pd.read_sql_query("SELECT * FROM files ORDER BY start_time", self._conn)
+        catalog["start_time"] = pd.to_datetime(catalog["start_time"])
+        catalog["end_time"] = pd.to_datetime(catalog["end_time"])
+        return catalog
+
+    def interval_index(self):
+        """
+        Return a `FileIntervalIndex` of the catalogued files for bulk matching of flare times.
+        """
+        rows = self._conn.execute("SELECT start_time, end_time, path FROM files")
+        return FileIntervalIndex.from_ranges((datetime.fromisoformat(start), datetime.fromisoformat(end), path)
+                                             for start, end, path in rows)
+
+
+def _to_iso(dt):
+    # fixed width so that the times sort correctly as strings in SQLite
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+
+def _read_file_info(path):
+    """
+    Get the start time, end time and request ID of a cpd file, from the filename if it follows
+    the usual naming and otherwise from the FITS header.
+    """
+    filename = os.path.basename(path)
+    start_dt, end_dt = parse_file_date_range(filename)
+    # e.g. solo_L1_stix-sci-xray-cpd_20230101T000000-20230101T235959_V02_2301010001-12345.fits
+    match = re.search(r'_V\w+?_(\d+)', filename)
+    request_id = int(match.group(1)) if match else None
+
+    if start_dt is None or request_id is None:
+        header = fits.getheader(path)
+        if start_dt is None:
+            start_dt = parse_time(header.get("DATE-BEG", header.get("DATE_BEG"))).datetime
+            end_dt = parse_time(header.get("DATE-END", header.get("DATE_END"))).datetime
+        if request_id is None:
+            request_id = header.get("REQUEST_ID", header.get("RQST_ID"))
+
+    return start_dt, end_dt, request_id
@@ -7,24 +7,44 @@ from astropy import units as u
 from sunpy.net import Fido, attrs as a
 from sunpy.time import parse_time
 from stixpy.net.client import STIXClient
-from stixpy.product import Product
 from stixdcpy.net import Request as jreq
 from astropy.coordinates import SkyCoord
 from sunpy.coordinates import frames, SphericalScreen
+from xrayvision.imaging import vis_to_image
 import astrospice
 import warnings
 from datetime import datetime
 from sunpy.util import SunpyDeprecationWarning
 import glob
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
 import re
+import time
+from functools import partial
+from itertools import chain
 from datetime import datetime
 
 from flarelist_coord_utils import is_visible
-from flarelist_generate_utils import find_matching_files, search_remote_data
-from stx_estimate_flare_location import stx_estimate_flare_location
-
-
-def fetch_operational_flare_list(tstart, tend, save_csv=False):
+from flarelist_coord_transforms import transform_solo_hpc
+from flarelist_generate_utils import FileIntervalIndex, search_remote_data, search_remote_data_batched
+from flarelist_file_catalog import LocalFileCatalog
+from flarelist_download_manager import DownloadManager
+from flarelist_result_store import FlareResultStore
+from flarelist_attenuator_index import AttenuatorIndex
+from flarelist_parquet import (write_flarelist_parquet, read_flarelist_parquet, delete_flarelist_parquet_range,
+                               is_parquet_path)
+from stx_estimate_flare_location import (stx_estimate_flare_location, stx_estimate_flare_location_track,
+                                         prepare_flare_imaging, flare_location_from_image, back_project_batch)
+from stx_product_cache import get_product
+from stx_product_slice import read_product_slice
+from stx_pixel_counts import PixelDataCounts
+from stx_pointing_cache import pointing_cache, init_worker as init_pointing_worker
+
+# maximum number of flares the STIX Data Center returns for a single query
+FLARE_LIST_LIMIT = 5000
+
+
+def fetch_operational_flare_list(tstart, tend, save_csv=False, max_concurrent=1, cache_dir=None, settle_days=30,
+                                 window_days=180, min_window=1 * u.hour, output_format="csv"):
     """
     Fetches the STIX flare list from the Data Center using stixdcpy.
 
@@ -40,6 +60,21 @@ def fetch_operational_flare_list(tstart, tend, save_csv=False):
         End time of query
     save_csv : bool, default=False
         Save the dataframe to a csv file, optional
+    max_concurrent : int, default=1
+        Maximum number of query windows fetched from the Data Center at the same time.
+    cache_dir : str, optional
+        Directory in which to cache the flares of each query window. Only windows that ended
+        more than `settle_days` ago are cached, as the operational list can still change for recent times.
+        With a cache the query windows are single calendar months, so that only the recent months are
+        fetched again by later runs. Default is None (no caching).
+    settle_days : float, default=30
+        Number of days after which a query window is considered final and can be cached.
+    window_days : float, default=180
+        Length of the initial query windows in days, rounded to whole months.
+    min_window : `astropy.units.Quantity`, default=1 hour
+        Windows are not split below this length.
+    output_format : str, default="csv"
+        Format of the saved file, "csv" or "parquet" (a dataset partitioned by month, see `write_flarelist_parquet`).
 
     Return:
     ------
@@ -48,29 +83,43 @@ def fetch_operational_flare_list(tstart, tend, save_csv=False):
     Notes:
     -----
     The STIX Data Center has a limit of 5000 flares that can be returned from a single query.
-    To ensure no flares are missed, the search is broken into intervals of <= 60 days.
+    To ensure no flares are missed, the search is broken into windows of `window_days`, and any window
+    whose result reaches the limit is split in half and queried again, until the results are below the
+    limit or the window is shorter than `min_window` (in which case a warning is logged). This way the
+    number of queries follows the number of flares rather than the length of the time range.
+
+    The windows start on fixed UTC month boundaries rather than at `tstart`, so that the cached windows
+    are the same whatever time range is queried. Without a cache the first and last windows are cut to
+    `tstart` and `tend`. With a cache, settled windows are fetched whole and the flares outside
+    `tstart` to `tend` are dropped afterwards.
     """
     logging.info('Fetching flare list from Data Center...')
 
-    if (tend - tstart).datetime.days > 60:
-        times = [tstart.datetime]
-        tstart_new = tstart.copy()
-        while tstart_new < tend:
-            tstart_new += 60 * u.day
-            times.append(tstart_new.datetime)
-    else:
-        times = [tstart, tend]
+    settled_before = Time.now() - settle_days * u.day
+    n_months = 1 if cache_dir is not None else max(1, round(window_days / 30.44))
+    windows = []
+    for window_start, window_end in _month_windows(tstart, tend, n_months):
+        if cache_dir is None or window_end >= settled_before:
+            # only whole windows are cached, the others are only queried for the time range asked for
+            window_start, window_end = max(window_start, tstart), min(window_end, tend)
+        windows.append((window_start, window_end))
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
 
-    times[-1] = tend
-    flare_df_lists = []
+    def fetch_window(window):
+        return _fetch_flare_list_adaptive(*window, cache_dir=cache_dir, settled_before=settled_before,
+                                          min_window=min_window)
 
-    for i in range(len(times) - 1):
-        flares = jreq.fetch_flare_list(times[i], times[i + 1])
-        logging.info(f'Fetched {len(flares)} flares from {times[i]} to {times[i + 1]}')
-        f1 = pd.DataFrame(flares)
-        flare_df_lists.append(f1)
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrent)) as executor:
+        flare_df_lists = list(executor.map(fetch_window, windows))
 
     full_flare_list = pd.concat(flare_df_lists)
+    if cache_dir is not None and len(full_flare_list) > 0:
+        # whole windows were fetched, keep the flares in the time range
+        overlaps = ((pd.to_datetime(full_flare_list["end_UTC"], format="ISO8601") >= tstart.datetime) &
+                    (pd.to_datetime(full_flare_list["start_UTC"], format="ISO8601") <= tend.datetime))
+        full_flare_list = full_flare_list[overlaps.to_numpy()]
     full_flare_list.drop_duplicates(inplace=True)
     full_flare_list.sort_values(by="peak_UTC", inplace=True)
     full_flare_list.reset_index(inplace=True, drop=True)
@@ -79,13 +128,89 @@ def fetch_operational_flare_list(tstart, tend, save_csv=False):
 
     if save_csv:
         filename = f"stix_operational_list_{times_flares.min().strftime('%Y%m%d')}_{times_flares.max().strftime('%Y%m%d')}.csv"
-        full_flare_list.to_csv(filename, index_label=False)
-        logging.info(f'Saved flare list to {filename}')
+        _save_output(full_flare_list, filename, output_format, index_label=False)
 
     return full_flare_list
 
 
-def filter_and_associate_files(flare_list, local_files_path, threshold_counts=1000, save_csv=False):
+def _month_windows(tstart, tend, n_months):
+    """
+    Windows of `n_months` calendar months covering `tstart` to `tend`, starting on a multiple of
+    `n_months` months from January 2020 so that the same windows are used whatever `tstart` is.
+    """
+    start = pd.Timestamp(tstart.datetime)
+    month = ((start.year - 2020) * 12 + start.month - 1) // n_months * n_months
+    windows = []
+    while True:
+        window_start = Time(datetime(2020 + month // 12, month % 12 + 1, 1))
+        month += n_months
+        window_end = Time(datetime(2020 + month // 12, month % 12 + 1, 1))
+        windows.append((window_start, window_end))
+        if window_end >= tend:
+            return windows
+
+
+def _fetch_flare_list_adaptive(window_start, window_end, cache_dir=None, settled_before=None, min_window=1 * u.hour):
+    """
+    Fetches the flare list for a query window, splitting the window in half (recursively)
+    if the result reaches the Data Center limit of `FLARE_LIST_LIMIT` flares.
+    """
+    f1 = _fetch_flare_list_window(window_start, window_end, cache_dir=cache_dir, settled_before=settled_before)
+    if len(f1) < FLARE_LIST_LIMIT:
+        return f1
+
+    if window_end - window_start <= min_window:
+        logging.warning(f'{len(f1)} flares returned from {window_start} to {window_end}, which is at the '
+                        f'Data Center limit of {FLARE_LIST_LIMIT}, and the window cannot be split further. '
+                        f'Some flares may be missing.')
+        return f1
+
+    window_mid = window_start + (window_end - window_start) / 2
+    logging.info(f'Flare limit reached from {window_start} to {window_end}, splitting at {window_mid}')
+    return pd.concat([_fetch_flare_list_adaptive(window_start, window_mid, cache_dir, settled_before, min_window),
+                      _fetch_flare_list_adaptive(window_mid, window_end, cache_dir, settled_before, min_window)])
+
+
+def _fetch_flare_list_window(window_start, window_end, cache_dir=None, settled_before=None):
+    """
+    Fetches the flare list for a single query window, from the cache in `cache_dir` if available.
+
+    Windows ending before `settled_before` are written to the cache once fetched.
+    """
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, f"stix_operational_list_{window_start.strftime('%Y%m%dT%H%M%S')}_"
+                                             f"{window_end.strftime('%Y%m%dT%H%M%S')}.pkl")
+        if os.path.exists(cache_file):
+            logging.info(f'Loaded flares from {window_start} to {window_end} from cache')
+            return pd.read_pickle(cache_file)
+
+    flares = jreq.fetch_flare_list(window_start.datetime, window_end.datetime)
+    logging.info(f'Fetched {len(flares)} flares from {window_start} to {window_end}')
+    f1 = pd.DataFrame(flares)
+
+    # a window at the limit is truncated, so it isn't cached
+    if cache_file is not None and window_end < settled_before and len(f1) < FLARE_LIST_LIMIT:
+        f1.to_pickle(cache_file)
+
+    return f1
+
+
+def _save_output(output, filename, output_format="csv", time_column="peak_UTC", **csv_kwargs):
+    # save the output of a step, a Parquet dataset is written to a directory named as the csv file without `.csv`
+    if output_format == "parquet":
+        filename = os.path.splitext(filename)[0]
+        write_flarelist_parquet(output, filename, time_column=time_column)
+    elif output_format == "csv":
+        output.to_csv(filename, **csv_kwargs)
+    else:
+        raise ValueError(f"Unknown output format '{output_format}', use 'csv' or 'parquet'")
+    logging.info(f'Saved flare list to {filename}')
+
+
+def filter_and_associate_files(flare_list, local_files_path, threshold_counts=1000, save_csv=False,
+                               use_catalog=False, catalog_path=None, batch_remote=False, max_connections=1,
+                               result_store=None, attenuator_index=None, output_format="csv"):
     """
     Filters the flare list to only include events above a certain threshold
     and attempts to associate each event with a local or remote data file.
@@ -99,6 +224,28 @@ def filter_and_associate_files(flare_list, local_files_path, threshold_counts=10
     threshold_counts : float
         filter flares with counts in the 4-10keV channel above this value
         default = 1000
+    save_csv : bool, default=False
+        Save the dataframe to a csv file, optional
+    use_catalog : bool, default=False
+        Use the persistent `LocalFileCatalog` of `local_files_path` rather than globbing the directory.
+        Only new or changed files are read, and files whose names don't contain the time range are included.
+    catalog_path : str, optional
+        Path to the catalog database, defaults to `stix_file_catalog.sqlite` in `local_files_path`.
+    batch_remote : bool, default=False
+        Search for the remote data of all flares without a local file in merged time windows
+        (see `search_remote_data_batched`) rather than making one search per flare.
+    max_connections : int, default=1
+        Number of files to download at the same time. If > 1, downloads run in a `DownloadManager`
+        pool while the remaining flares are associated with files.
+    result_store : `FlareResultStore`, optional
+        Store in which the file of each flare is saved as soon as it is found. Flares that already have
+        a stored file are not searched for again, so that a stopped run can be resumed.
+    attenuator_index : `AttenuatorIndex`, optional
+        Index of the attenuator intervals, updated with the associated files. The attenuator status in the
+        ±20 s around each flare peak is then added as an `attenuator_in` column, which is used by
+        `estimate_flare_locations_and_attenuator` instead of checking the data of each flare.
+    output_format : str, default="csv"
+        Format of the saved file, "csv" or "parquet" (a dataset partitioned by month, see `write_flarelist_parquet`).
 
 
     Return:
@@ -111,44 +258,298 @@ def filter_and_associate_files(flare_list, local_files_path, threshold_counts=10
     flarelist_gt_1000 = flare_list[flare_list["LC0_PEAK_COUNTS_4S"] >= threshold_counts]
     flarelist_gt_1000.reset_index(inplace=True, drop=True)
 
-    local_files = glob.glob(f"{local_files_path}/*.fits")
-    file_names = []
-
-    for i, row in flarelist_gt_1000.iterrows():
-        peak_flare = row["peak_UTC"]
-        file = find_matching_files(local_files, peak_flare)
-        if file is None:
-            file = search_remote_data(row, path=local_files_path+"/{file}")
-            if file:
-                logging.info(f"Fetched remote file for flare {i+1}/{len(flarelist_gt_1000)}")
-            else:
-                file = "file_issue"
-        file_names.append(file)
-        logging.info(f"Processed flare to find files {i + 1}/{len(flarelist_gt_1000)}")
+    # build the index of local file time ranges once and match all flares in one go
+    catalog = None
+    download_manager = None
+    try:
+        if use_catalog:
+            catalog = LocalFileCatalog(local_files_path, catalog_path=catalog_path)
+            catalog.update()
+            local_files = catalog.interval_index()
+        else:
+            local_files = FileIntervalIndex(glob.glob(f"{local_files_path}/*.fits"))
+        local_matches = local_files.find_many(flarelist_gt_1000["peak_UTC"])
+        file_names = []
+
+        if result_store is not None:
+            stored_files = result_store.get_files()
+            for i in np.flatnonzero(pd.isnull(local_matches)):
+                local_matches[i] = stored_files.get(flarelist_gt_1000["flare_id"].iat[i])
+
+        download_manager = DownloadManager(max_connections=max_connections) if max_connections > 1 else None
+
+        if batch_remote:
+            missing = flarelist_gt_1000[pd.isnull(local_matches)]
+            remote_files = search_remote_data_batched(missing, path=local_files_path+"/{file}",
+                                                      local_files=local_files, download_manager=download_manager)
+            for i, file in remote_files.items():
+                local_matches[i] = file if file else "file_issue"
+                if file and catalog is not None:
+                    catalog.add(file)
+
+        for i, row in flarelist_gt_1000.iterrows():
+            file = local_matches[i]
+            if file is None:
+                # a file downloaded for an earlier flare may also contain this one
+                file = local_files.find(row["peak_UTC"])
+            if file is None and download_manager is not None:
+                # or a file queued for an earlier flare
+                file = download_manager.find_pending(row["peak_UTC"])
+            if file is None:
+                file = search_remote_data(row, path=local_files_path+"/{file}", download_manager=download_manager)
+                if isinstance(file, Future):
+                    # the download is resolved once all flares have been associated
+                    logging.info(f"Queued remote file for flare {i+1}/{len(flarelist_gt_1000)}")
+                elif file:
+                    local_files.add(file)
+                    if catalog is not None:
+                        catalog.add(file)
+                    logging.info(f"Fetched remote file for flare {i+1}/{len(flarelist_gt_1000)}")
+                else:
+                    file = "file_issue"
+            if result_store is not None and not isinstance(file, Future) and file != "file_issue":
+                result_store.put_file(row["flare_id"], file)
+            file_names.append(file)
+            logging.info(f"Processed flare to find files {i + 1}/{len(flarelist_gt_1000)}")
+
+        if download_manager is not None:
+            for i, file in enumerate(file_names):
+                if isinstance(file, Future):
+                    file_names[i] = _resolve_download(file, local_files, catalog)
+                    if result_store is not None and file_names[i] != "file_issue":
+                        result_store.put_file(flarelist_gt_1000["flare_id"].iat[i], file_names[i])
+    finally:
+        # all downloads have been resolved by now, unless there was an error, then the queued ones are dropped
+        if download_manager is not None:
+            download_manager.close(wait=False)
+        if catalog is not None:
+            catalog.close()
 
     flarelist_gt_1000["filenames"] = file_names
     times_flares = pd.to_datetime(flarelist_gt_1000["peak_UTC"])
 
+    if attenuator_index is not None:
+        # each file is only read the first time it is seen, then the status of all flares is one interval join
+        attenuator_index.update([file for file in file_names if file != "file_issue"])
+        attenuator_in = attenuator_index.attenuator_in(times_flares - pd.Timedelta(20, "s"),
+                                                       times_flares + pd.Timedelta(20, "s")).astype(object)
+        # flares whose file couldn't be indexed are left NaN, so their attenuator status is checked from the data
+        attenuator_in[~attenuator_index.indexed(file_names)] = np.nan
+        flarelist_gt_1000["attenuator_in"] = attenuator_in
+
     if save_csv:
         filename = f"stix_operational_list_with_file_info_{times_flares.min().strftime('%Y%m%d')}_{times_flares.max().strftime('%Y%m%d')}.csv"
-        flarelist_gt_1000.to_csv(filename, index=False, index_label=False)
-        logging.info(f'Saved flare list to {filename}')
+        _save_output(flarelist_gt_1000, filename, output_format, index=False, index_label=False)
 
     return flarelist_gt_1000
 
 
-def estimate_flare_locations_and_attenuator(flare_list_with_files, save_csv=False):
+def _estimate_single_flare_location(row, coarse_to_fine=False, lazy_load=False):
+    """
+    Estimates the flare location and attenuator status for a single row of the flare list.
+
+    This is the per-flare work of `estimate_flare_locations_and_attenuator()`, kept at module level
+    so that it can be sent to worker processes. Any error with the imaging is caught here and
+    flagged in the returned `error` entry rather than raised.
+
+    Parameters
+    ----------
+    row : pd.Series
+        Row of the flare list, needs `peak_UTC`, `filenames` and `flare_id`.
+    coarse_to_fine : bool, default=False
+        Use the coarse-to-fine peak search of `stx_estimate_flare_location()`.
+    lazy_load : bool, default=False
+        Only read the time bins of the file around the flare peak, see `_flare_imaging_inputs()`.
+
+    Returns
+    -------
+    dict
+        results for this flare with the keys `loc_x`, `loc_y`, `loc_x_stix`, `loc_y_stix`,
+        `sidelobes_ratio`, `flare_id`, `error` and `attenuator`.
+
+    """
+    att = False  # Default value for attenuator
+
+    try:
+        cpd_sci, time_range, energy_range, att = _flare_imaging_inputs(row, lazy_load=lazy_load)
+
+        # Estimate flare location
+        flare_loc_stix, flare_loc, sidelobe = stx_estimate_flare_location(cpd_sci, time_range, energy_range,
+                                                                          coarse_to_fine=coarse_to_fine)
+        return _location_result(row, att, flare_loc_stix, flare_loc, sidelobe)
+
+    except Exception as e:
+        logging.error(f"Error processing flare {row['flare_id']}: {e}")
+        return _location_result(row, att)
+
+
+def _estimate_flare_location_batch(rows, same_file=False, lazy_load=False):
+    """
+    Estimates the flare locations and attenuator status for a batch of rows of the flare list.
+
+    This gives the same results as `_estimate_single_flare_location()` for each row, but the back-projected
+    images of all the flares in the batch are made together with `back_project_batch()`.
+
+    Parameters
+    ----------
+    rows : list of pd.Series
+        Rows of the flare list, need `peak_UTC`, `filenames` and `flare_id`.
+    same_file : bool, default=False
+        All the rows are for the same file, so its counts are loaded once into a `PixelDataCounts`
+        and the meta pixels of each flare are cut from them.
+    lazy_load : bool, default=False
+        Only read the time bins of the files around each flare peak, see `_flare_imaging_inputs()`.
+        Can't be used with `same_file`.
+
+    Returns
+    -------
+    list of dict
+        results for each flare, as returned by `_estimate_single_flare_location()`.
+
+    """
+    flare_results = [None] * len(rows)
+    atts = [False] * len(rows)
+    imaging = {}
+    counts = None
+    for i, row in enumerate(rows):
+        try:
+            cpd_sci, time_range, energy_range, atts[i] = _flare_imaging_inputs(row, lazy_load=lazy_load)
+            if same_file and counts is None:
+                counts = PixelDataCounts(cpd_sci)
+            imaging[i] = prepare_flare_imaging(cpd_sci, time_range, energy_range, counts=counts)
+        except Exception as e:
+            logging.error(f"Error processing flare {row['flare_id']}: {e}")
+            flare_results[i] = _location_result(row, atts[i])
+
+    if imaging:
+        first = next(iter(imaging.values()))
+        try:
+            bp_images = list(back_project_batch([flare["vis"] for flare in imaging.values()], first["imsize"],
+                                                [flare["pixel"] for flare in imaging.values()]))
+        except Exception as e:
+            # e.g. flares with different u, v points, which are then imaged one at a time
+            logging.warning(f"Error back-projecting a batch of {len(imaging)} flares ({e}), imaging them separately")
+            bp_images = [None] * len(imaging)
+        for (i, flare), bp_image in zip(imaging.items(), bp_images):
+            try:
+                if bp_image is None:
+                    bp_image = vis_to_image(flare["vis"], flare["imsize"], pixel_size=flare["pixel"])
+                flare_loc_stix, flare_loc, sidelobe = flare_location_from_image(bp_image, flare)
+                flare_results[i] = _location_result(rows[i], atts[i], flare_loc_stix, flare_loc, sidelobe)
+            except Exception as e:
+                logging.error(f"Error processing flare {rows[i]['flare_id']}: {e}")
+                flare_results[i] = _location_result(rows[i], atts[i])
+
+    return flare_results
+
+
+def _flare_imaging_inputs(row, lazy_load=False):
+    """
+    The pixel data product, time range, energy range and attenuator status used to image a flare.
+
+    With `lazy_load`, only the time bins of the file around the peak are read with `read_product_slice()`
+    (which includes every time bin used for the attenuator check and the imaging), rather than the whole
+    file being decoded and cached.
+    """
+    energy_range = [4, 16] * u.keV
+
+    # Define a 20s time range around peak time
+    tstart = parse_time(row["peak_UTC"]) - 20 * u.s
+    tend = parse_time(row["peak_UTC"]) + 20 * u.s
+    time_range = [tstart.strftime("%Y-%m-%dT%H:%M:%S"), tend.strftime("%Y-%m-%dT%H:%M:%S")]
+
+    if lazy_load:
+        # a second either side covers the whole seconds of `time_range`
+        cpd_sci = read_product_slice(row["filenames"], [tstart - 1 * u.s, tend + 1 * u.s])
+    else:
+        # the product is cached so the file is only decoded once, even if shared between flares
+        cpd_sci = get_product(row["filenames"])
+
+    if "attenuator_in" in row.index and not pd.isnull(row["attenuator_in"]):
+        # already found from the `AttenuatorIndex` when the file was associated
+        att = bool(row["attenuator_in"])
+    else:
+        # Check for attenuator status by looking for any 'rcr' data points in the time range
+        # as the att_in column in the operational flarelist isnt working.
+        att = bool(np.any(cpd_sci.data[(cpd_sci.data["time"] >= tstart) & (cpd_sci.data["time"] <= tend)]["rcr"]))
+    if att:
+        energy_range = [4, 25] * u.keV
+
+    return cpd_sci, time_range, energy_range, att
+
+
+def _location_result(row, att, flare_loc_stix=None, flare_loc=None, sidelobe=np.nan):
+    """
+    The results dict of a flare, flagged as an error if there is no location.
+    """
+    if flare_loc is None:
+        return {"loc_x": np.nan, "loc_y": np.nan, "loc_x_stix": np.nan, "loc_y_stix": np.nan,
+                "sidelobes_ratio": np.nan, "flare_id": row["flare_id"], "error": True, "attenuator": att}
+    return {"loc_x": flare_loc.Tx.value, "loc_y": flare_loc.Ty.value,
+            "loc_x_stix": flare_loc_stix.Tx.value, "loc_y_stix": flare_loc_stix.Ty.value,
+            "sidelobes_ratio": sidelobe, "flare_id": row["flare_id"], "error": False, "attenuator": att}
+
+
+def _resolve_download(file, local_files, catalog):
+    """
+    Wait for a queued download and record the downloaded file.
+    """
+    file = file.result()
+    if not file:
+        return "file_issue"
+    local_files.add(file)
+    if catalog is not None:
+        catalog.add(file)
+    return file
+
+
+def estimate_flare_locations_and_attenuator(flare_list_with_files, save_csv=False, n_workers=1, result_store=None,
+                                            prefetch_pointing=False, coarse_to_fine=False, batch_size=None,
+                                            group_by_file=False, lazy_load=False, output_format="csv"):
     """
     Estimates flare locations and gets the attenuator status for each flare in the provided flare list.
 
     This function uses `stx_estimate_flare_location()` to estimate the flare location from the provided files,
-    checks the attenuator status by examining the `rcr` column of the data, and adjusts the energy range accordingly.
+    checks the attenuator status by examining the `rcr` column of the data (or takes it from the `attenuator_in`
+    column, if added by `filter_and_associate_files` from an `AttenuatorIndex`), and adjusts the energy range accordingly.
     Results are appended to the input DataFrame.
 
     Parameters
     ----------
     flare_list_with_files : pd.DataFrame
         DataFrame containing flare information including file paths (`filenames`) to associated `.fits` files.
+    save_csv : bool, default=False
+        Save the dataframe to a csv file, optional
+    n_workers : int, default=1
+        Number of processes used to image the flares. With `n_workers=1` the flares are processed
+        one after another in this process, otherwise they are spread over a process pool.
+        In both cases the results are returned in the same order as the input flare list.
+    result_store : `FlareResultStore`, optional
+        Store in which the results of each flare are saved as soon as they are available. Flares that
+        already have stored results are not imaged again, so that a stopped run can be resumed.
+    prefetch_pointing : bool, default=False
+        Load the STIX aux (pointing) data once per day for all flares into the shared `PointingCache`
+        before imaging, rather than downloading it for each flare.
+    coarse_to_fine : bool, default=False
+        Find the flare locations with the coarse-to-fine peak search of `stx_estimate_flare_location()`,
+        which only back-projects at full resolution around the candidate peaks and sidelobes.
+        See `coarse_to_fine_accuracy_report()` to check the results against full resolution imaging.
+    batch_size : int, optional
+        Make the back-projected images of this many flares at a time with `back_project_batch()`,
+        rather than one flare at a time. The results are the same, but the images are much quicker to make.
+        Each image in a batch takes ~4 MB while it is made. Can't be used with `coarse_to_fine`.
+    group_by_file : bool, default=False
+        Process the flares file by file: the counts of each file are loaded once and the meta pixels of
+        all its flares are cut from them, and their images are made together as with `batch_size`
+        (which, if given, limits how many flares of a file are imaged at a time). With worker
+        processes, each file is sent to one worker. Can't be used with `coarse_to_fine`.
+    lazy_load : bool, default=False
+        Only read the time bins of each file around the flare peak (with `read_product_slice()`) rather
+        than decoding and caching the whole file. This keeps the memory and I/O of each flare small for
+        long files, while the product cache is quicker when many flares share a file.
+        Can't be used with `group_by_file`.
+    output_format : str, default="csv"
+        Format of the saved file, "csv" or "parquet" (a dataset partitioned by month, see `write_flarelist_parquet`).
 
     """
 
@@ -156,50 +557,72 @@ def estimate_flare_locations_and_attenuator(flare_list_with_files, save_csv=Fals
     results = {"loc_x": [], "loc_y": [], "loc_x_stix": [], "loc_y_stix": [],
                "sidelobes_ratio": [], "flare_id": [], "error": [], "attenuator": []}
 
-    for i, row in flare_list_with_files.iterrows():
-        energy_range = [4, 16] * u.keV
-
-        # Define a 20s time range around peak time
-        tstart = parse_time(row["peak_UTC"]) - 20 * u.s
-        tend = parse_time(row["peak_UTC"]) + 20 * u.s
-        time_range = [tstart.strftime("%Y-%m-%dT%H:%M:%S"), tend.strftime("%Y-%m-%dT%H:%M:%S")]
-        cpd_file = row["filenames"]
-        att = False  # Default value for attenuator
-
-        try:
-            cpd_sci = Product(cpd_file)
-
-            # Check for attenuator status by looking for any 'rcr' data points in the time range
-            # as the att_in column in the operational flarelist isnt working.
-            if np.any(cpd_sci.data[(cpd_sci.data["time"] >= tstart) & (cpd_sci.data["time"] <= tend)]["rcr"]):
-                att = True
-                energy_range = [4, 25] * u.keV
-            print(att)
-            
-
-            # Estimate flare location
-            flare_loc_stix, flare_loc, sidelobe = stx_estimate_flare_location(cpd_file, time_range, energy_range)
-
-            # Store results
-            results["loc_x"].append(flare_loc.Tx.value)
-            results["loc_y"].append(flare_loc.Ty.value)
-            results["loc_x_stix"].append(flare_loc_stix.Tx.value)
-            results["loc_y_stix"].append(flare_loc_stix.Ty.value)
-            results["sidelobes_ratio"].append(sidelobe)
-            results["error"].append(False)
-            results["flare_id"].append(row["flare_id"])
-            results["attenuator"].append(att)
-
-        except Exception as e:
-            logging.error(f"Error processing flare {i}: {e}")
-            results["loc_x"].append(np.nan)
-            results["loc_y"].append(np.nan)
-            results["loc_x_stix"].append(np.nan)
-            results["loc_y_stix"].append(np.nan)
-            results["sidelobes_ratio"].append(np.nan)
-            results["error"].append(True)
-            results["flare_id"].append(row["flare_id"])
-            results["attenuator"].append(att)
+    rows = [row for _, row in flare_list_with_files.iterrows()]
+
+    stored = result_store.get_locations() if result_store is not None else {}
+    flare_results = [stored.get(row["flare_id"]) for row in rows]
+    to_process = [i for i, flare_result in enumerate(flare_results) if flare_result is None]
+    if stored:
+        logging.info(f'Using stored results for {len(rows) - len(to_process)} flares, imaging {len(to_process)}')
+
+    if prefetch_pointing and to_process:
+        # done before starting any workers so that they start with the loaded pointing data
+        pointing_cache.install()
+        pointing_cache.prefetch([rows[i]["peak_UTC"] for i in to_process])
+
+    if (batch_size is not None or group_by_file) and coarse_to_fine:
+        raise ValueError("batch_size and group_by_file can't be used with coarse_to_fine")
+    if group_by_file and lazy_load:
+        raise ValueError("lazy_load can't be used with group_by_file")
+    if group_by_file:
+        files = {}
+        for i in to_process:
+            files.setdefault(rows[i]["filenames"], []).append(i)
+        batch_size = batch_size or max([len(indices) for indices in files.values()], default=1)
+        batches = [indices[n:n + batch_size] for indices in files.values() for n in range(0, len(indices), batch_size)]
+        logging.info(f'Imaging {len(to_process)} flares from {len(files)} files')
+    elif batch_size is not None:
+        batches = [to_process[n:n + batch_size] for n in range(0, len(to_process), batch_size)]
+    if batch_size is not None:
+        # results come back in the order of the batches
+        to_process = [i for batch in batches for i in batch]
+        estimate_batch = partial(_estimate_flare_location_batch, same_file=group_by_file, lazy_load=lazy_load)
+        batches = [[rows[i] for i in batch] for batch in batches]
+
+    if n_workers is not None and n_workers > 1:
+        logging.info(f'Imaging {len(to_process)} flares with {n_workers} worker processes')
+        # chunk the rows so that each worker gets a batch of flares rather than one at a time
+        chunksize = max(1, len(to_process) // (n_workers * 4))
+        # the workers are given the cache and the prefetched days, as spawned workers don't inherit them
+        pool_kwargs = ({"initializer": init_pointing_worker, "initargs": (pointing_cache.loaded_days(),)}
+                       if prefetch_pointing else {})
+        with ProcessPoolExecutor(max_workers=n_workers, **pool_kwargs) as executor:
+            if batch_size is not None:
+                new_results = chain.from_iterable(executor.map(estimate_batch, batches))
+            else:
+                new_results = executor.map(partial(_estimate_single_flare_location, coarse_to_fine=coarse_to_fine,
+                                                   lazy_load=lazy_load),
+                                           [rows[i] for i in to_process],
+                                           chunksize=chunksize)
+            for n, (i, flare_result) in enumerate(zip(to_process, new_results)):
+                flare_results[i] = flare_result
+                if result_store is not None:
+                    result_store.put_location(flare_result)
+                logging.info(f"Processed flare locations {n + 1}/{len(to_process)}")
+    else:
+        if batch_size is not None:
+            new_results = chain.from_iterable(map(estimate_batch, batches))
+        else:
+            new_results = (_estimate_single_flare_location(rows[i], coarse_to_fine=coarse_to_fine, lazy_load=lazy_load)
+                           for i in to_process)
+        for i, flare_result in zip(to_process, new_results):
+            flare_results[i] = flare_result
+            if result_store is not None:
+                result_store.put_location(flare_result)
+
+    for flare_result in flare_results:
+        for key in results:
+            results[key].append(flare_result[key])
 
     results = pd.DataFrame(results)
     flare_list_with_locations = pd.concat([flare_list_with_files.reset_index(drop=True), results], axis=1)
@@ -208,14 +631,132 @@ def estimate_flare_locations_and_attenuator(flare_list_with_files, save_csv=Fals
 
     if save_csv:
         filename = f"stix_flarelist_w_locations_{times_flares.min().strftime('%Y%m%d')}_{times_flares.max().strftime('%Y%m%d')}.csv"
-        flare_list_with_locations.to_csv(filename, index=False, index_label=False)
-        logging.info(f'Saved flare list to {filename}')
+        _save_output(flare_list_with_locations, filename, output_format, index=False, index_label=False)
 
     return flare_list_with_locations
 
 
 
-def merge_and_process_data(flare_list_with_locations, save_csv=False):
+def estimate_flare_location_tracks(flare_list_with_files, window=40 * u.s, step=10 * u.s, save_csv=False,
+                                   output_format="csv"):
+    """
+    Estimates the flare location as a function of time over each flare, from `start_UTC` to `end_UTC`.
+
+    Each file is only loaded and summed once (into a `PixelDataCounts`), and the location track of each of its
+    flares is made with `stx_estimate_flare_location_track()` from sliding windows of `window` every `step`.
+    As for `estimate_flare_locations_and_attenuator()` the energy range is 4-16 keV, or 4-25 keV if the
+    attenuator is in at any time during the flare; windows in which the attenuator moves are flagged as errors.
+
+    Parameters
+    ----------
+    flare_list_with_files : pd.DataFrame
+        DataFrame containing flare information including file paths (`filenames`) to associated `.fits` files.
+    window : `astropy.units.Quantity`, default=40 s
+        Length of each time window.
+    step : `astropy.units.Quantity`, default=10 s
+        Time between the starts of consecutive windows.
+    save_csv : bool, default=False
+        Save the dataframe to a csv file, optional
+    output_format : str, default="csv"
+        Format of the saved file, "csv" or "parquet" (a dataset partitioned by the month of `start_UTC`).
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per flare and time window, with the `flare_id` and the columns returned by
+        `stx_estimate_flare_location_track()`.
+    """
+    flares = flare_list_with_files[flare_list_with_files["filenames"] != "file_issue"]
+    logging.info(f'Estimating flare location tracks for {len(flares)} flares...')
+
+    tracks = []
+    for cpd_file, file_flares in flares.groupby("filenames", sort=False):
+        try:
+            counts = PixelDataCounts(get_product(cpd_file))
+        except Exception as e:
+            logging.error(f"Error loading {cpd_file}: {e}")
+            continue
+        data = counts.pixel_data.data
+        for _, row in file_flares.iterrows():
+            tstart, tend = parse_time(row["start_UTC"]), parse_time(row["end_UTC"])
+            energy_range = [4, 16] * u.keV
+            if np.any(data[(data["time"] >= tstart) & (data["time"] <= tend)]["rcr"]):
+                energy_range = [4, 25] * u.keV
+            try:
+                track = stx_estimate_flare_location_track(counts.pixel_data, [tstart, tend], energy_range,
+                                                          window=window, step=step, counts=counts)
+            except Exception as e:
+                logging.error(f"Error processing flare {row['flare_id']}: {e}")
+                continue
+            track.insert(0, "flare_id", row["flare_id"])
+            tracks.append(track)
+
+    tracks = pd.concat(tracks, ignore_index=True) if tracks else pd.DataFrame()
+
+    if save_csv and len(tracks) > 0:
+        times_flares = pd.to_datetime(tracks["start_UTC"])
+        filename = f"stix_flare_location_tracks_{times_flares.min().strftime('%Y%m%d')}_{times_flares.max().strftime('%Y%m%d')}.csv"
+        _save_output(tracks, filename, output_format, time_column="start_UTC", index=False, index_label=False)
+
+    return tracks
+
+
+def coarse_to_fine_accuracy_report(flare_list_with_files, n_sample=None):
+    """
+    Compare the coarse-to-fine flare locations against full resolution imaging.
+
+    Each flare is imaged with both modes of `stx_estimate_flare_location()` (full resolution first, so
+    that the file and pointing data are already loaded for the coarse-to-fine run) and the differences
+    in location and sidelobes ratio, and the imaging times, are logged and returned.
+
+    Parameters
+    ----------
+    flare_list_with_files : pd.DataFrame
+        DataFrame of flares with their associated files (`filenames`), as given to
+        `estimate_flare_locations_and_attenuator()`.
+    n_sample : int, optional
+        Only compare a random sample of this many flares.
+
+    Returns
+    -------
+    pd.DataFrame
+        for each flare the `flare_id`, the distance between the two locations in the STIX imaging frame
+        (`offset_arcsec`), the sidelobes ratios of both modes and their difference, and the time
+        taken by each mode.
+    """
+    flares = flare_list_with_files[flare_list_with_files["filenames"] != "file_issue"]
+    if n_sample is not None and n_sample < len(flares):
+        flares = flares.sample(n_sample, random_state=0)
+
+    report = []
+    for _, row in flares.iterrows():
+        t0 = time.perf_counter()
+        full = _estimate_single_flare_location(row)
+        t1 = time.perf_counter()
+        fast = _estimate_single_flare_location(row, coarse_to_fine=True)
+        t2 = time.perf_counter()
+        if full["error"] or fast["error"]:
+            continue
+        report.append({"flare_id": row["flare_id"],
+                       "offset_arcsec": np.hypot(fast["loc_x_stix"] - full["loc_x_stix"],
+                                                 fast["loc_y_stix"] - full["loc_y_stix"]),
+                       "sidelobes_ratio_full": full["sidelobes_ratio"],
+                       "sidelobes_ratio_coarse_to_fine": fast["sidelobes_ratio"],
+                       "sidelobes_ratio_diff": fast["sidelobes_ratio"] - full["sidelobes_ratio"],
+                       "time_full": t1 - t0, "time_coarse_to_fine": t2 - t1})
+
+    report = pd.DataFrame(report)
+    if len(report) > 0:
+        logging.info(f"Coarse-to-fine vs full resolution for {len(report)} flares: "
+                     f"{np.count_nonzero(report['offset_arcsec'] > 0)} with a different location "
+                     f"(max offset {report['offset_arcsec'].max():.1f} arcsec), "
+                     f"max sidelobes ratio difference {report['sidelobes_ratio_diff'].abs().max():.4f}, "
+                     f"{report['time_full'].sum() / report['time_coarse_to_fine'].sum():.1f}x faster")
+    return report
+
+
+def merge_and_process_data(flare_list_with_locations, save_csv=False, ephemeris=None, fast_transforms=False,
+                           output_format="csv"):
     """
     Merges flare list with additional processing and visibility calculation.
 
@@ -223,6 +764,16 @@ def merge_and_process_data(flare_list_with_locations, save_csv=False):
     ----------
     flare_list_with_locations : pd.DataFrame
         Flare list with associated files and estimated locations.
+    save_csv : bool, default=False
+        Save the dataframe to a csv file, optional
+    ephemeris : `EphemerisCache`, optional
+        Get the Solar Orbiter and Earth positions from this cache rather than calculating them
+        with astrospice for every flare.
+    fast_transforms : bool, default=False
+        Use the NumPy transformations in `flarelist_coord_transforms` rather than sunpy `SkyCoord`
+        transformations for the Earth HPC, HGS and HGC coordinates and visibility.
+    output_format : str, default="csv"
+        Format of the saved file, "csv" or "parquet" (a dataset partitioned by month, see `write_flarelist_parquet`).
 
     Return:
     ------
@@ -231,39 +782,49 @@ def merge_and_process_data(flare_list_with_locations, save_csv=False):
     """
     logging.info('Merging and processing flare data...')
 
-    # Load kernels for Solar Orbiter position calculations
-    kernels = astrospice.registry.get_kernels("solar orbiter", "predict")
-    solo_coords_full = astrospice.generate_coords("SOLAR ORBITER", pd.to_datetime(flare_list_with_locations["peak_UTC"])).heliographic_stonyhurst
-    earth_coords_full = astrospice.generate_coords("earth", pd.to_datetime(flare_list_with_locations["peak_UTC"])).heliographic_stonyhurst
+    if ephemeris is not None:
+        solo_coords_full = ephemeris.positions("solar orbiter", flare_list_with_locations["peak_UTC"])
+        earth_coords_full = ephemeris.positions("earth", flare_list_with_locations["peak_UTC"])
+    else:
+        # Load kernels for Solar Orbiter position calculations
+        kernels = astrospice.registry.get_kernels("solar orbiter", "predict")
+        solo_coords_full = astrospice.generate_coords("SOLAR ORBITER", pd.to_datetime(flare_list_with_locations["peak_UTC"])).heliographic_stonyhurst
+        earth_coords_full = astrospice.generate_coords("earth", pd.to_datetime(flare_list_with_locations["peak_UTC"])).heliographic_stonyhurst
 
     # Add Solar Orbiter position information
     flare_list_with_locations.loc[:, "solo_position_lat"] = solo_coords_full.lat.value
     flare_list_with_locations.loc[:, "solo_position_lon"] = solo_coords_full.lon.value
     flare_list_with_locations.loc[:, "solo_position_AU_distance"] = solo_coords_full.radius.to_value(u.AU)
 
-    # Create SkyCoord objects from Solar Orbiter observer's perspective
-    flare_coords_solo_hpc = SkyCoord(flare_list_with_locations["loc_x"].values * u.arcsec, 
-                                     flare_list_with_locations["loc_y"].values * u.arcsec, 
-                                     frame=frames.Helioprojective(observer=solo_coords_full))
-
-    # Here we're are transforming these coordinates to HPC from earth, HGS and HGC. 
-    # For events off limb we are assuming a spherical screen to deal with the reprojection.
-    with SphericalScreen(flare_coords_solo_hpc.observer, only_off_disk=True):
-        flare_coords_earth_hpc = flare_coords_solo_hpc.transform_to(frames.Helioprojective(observer=earth_coords_full))
-        flare_coords_hgs = flare_coords_solo_hpc.transform_to(frames.HeliographicStonyhurst)
-        flare_coords_hgc = flare_coords_solo_hpc.transform_to(frames.HeliographicCarrington)
-
-    # Visibility check from Earth
-    visible_frame_earth = is_visible(flare_coords_earth_hpc)
-    flare_list_with_locations.loc[:, "visible_from_earth"] = visible_frame_earth
-
-    # Add transformed coordinates
-    flare_list_with_locations.loc[:, 'hpc_x_earth'] = flare_coords_earth_hpc.Tx.value
-    flare_list_with_locations.loc[:, 'hpc_y_earth'] = flare_coords_earth_hpc.Ty.value
-    flare_list_with_locations.loc[:, 'hgs_lon'] = flare_coords_hgs.lon.value
-    flare_list_with_locations.loc[:, 'hgs_lat'] = flare_coords_hgs.lat.value
-    flare_list_with_locations.loc[:, 'hgc_lon'] = flare_coords_hgc.lon.value
-    flare_list_with_locations.loc[:, 'hgc_lat'] = flare_coords_hgc.lat.value
+    if fast_transforms:
+        transformed = transform_solo_hpc(flare_list_with_locations["loc_x"].values, flare_list_with_locations["loc_y"].values,
+                                         solo_coords_full, earth_coords_full, solo_coords_full.obstime)
+        for column, values in transformed.items():
+            flare_list_with_locations.loc[:, column] = values
+    else:
+        # Create SkyCoord objects from Solar Orbiter observer's perspective
+        flare_coords_solo_hpc = SkyCoord(flare_list_with_locations["loc_x"].values * u.arcsec, 
+                                         flare_list_with_locations["loc_y"].values * u.arcsec, 
+                                         frame=frames.Helioprojective(observer=solo_coords_full))
+
+        # Here we're are transforming these coordinates to HPC from earth, HGS and HGC. 
+        # For events off limb we are assuming a spherical screen to deal with the reprojection.
+        with SphericalScreen(flare_coords_solo_hpc.observer, only_off_disk=True):
+            flare_coords_earth_hpc = flare_coords_solo_hpc.transform_to(frames.Helioprojective(observer=earth_coords_full))
+            flare_coords_hgs = flare_coords_solo_hpc.transform_to(frames.HeliographicStonyhurst)
+            flare_coords_hgc = flare_coords_solo_hpc.transform_to(frames.HeliographicCarrington)
+
+        # Visibility check from Earth
+        visible_frame_earth = is_visible(flare_coords_earth_hpc)
+        flare_list_with_locations.loc[:, "visible_from_earth"] = visible_frame_earth
+
+        # Add transformed coordinates
+        flare_list_with_locations.loc[:, 'hpc_x_earth'] = flare_coords_earth_hpc.Tx.value
+        flare_list_with_locations.loc[:, 'hpc_y_earth'] = flare_coords_earth_hpc.Ty.value
+        flare_list_with_locations.loc[:, 'hgs_lon'] = flare_coords_hgs.lon.value
+        flare_list_with_locations.loc[:, 'hgs_lat'] = flare_coords_hgs.lat.value
+        flare_list_with_locations.loc[:, 'hgc_lon'] = flare_coords_hgc.lon.value
+        flare_list_with_locations.loc[:, 'hgc_lat'] = flare_coords_hgc.lat.value
 
     # Set X, Y HPC earth to NaN if not visible from Earth
     flare_list_with_locations.loc[flare_list_with_locations['visible_from_earth'] == False, ['hpc_x_earth', 'hpc_y_earth']] = np.nan
@@ -314,15 +875,14 @@ def merge_and_process_data(flare_list_with_locations, save_csv=False):
 
     if save_csv:
         filename = f"stix_flarelist_w_locations_{times_flares.min().strftime('%Y%m%d')}_{times_flares.max().strftime('%Y%m%d')}.csv"
-        flarelist_final.to_csv(filename, index=False, index_label=False)
-        logging.info(f'Saved flare list to {filename}')
+        _save_output(flarelist_final, filename, output_format, index=False, index_label=False)
 
     return flarelist_final
 
 
 
 
-def get_flares(tstart, tend, local_files_path):
+def get_flares(tstart, tend, local_files_path, n_workers=1, resume_path=None, attenuator_index_path=None):
     """
     Fetches and returns a fully processed flare list with locations included.
 
@@ -334,6 +894,15 @@ def get_flares(tstart, tend, local_files_path):
         End time of the query in ISO format or as an Astropy Time object.
     local_files_path : str
         Path to the directory containing local .fits files.
+    n_workers : int, default=1
+        Number of processes used to image the flares in step 3.
+    resume_path : str, optional
+        Path to a `FlareResultStore` database. The results of steps 2 and 3 are saved to it for each
+        flare as they complete, and flares already in it are skipped, so a stopped run can be resumed
+        by calling `get_flares` again with the same `resume_path`.
+    attenuator_index_path : str, optional
+        Path to an `AttenuatorIndex` database. The attenuator intervals of each file are extracted once and
+        kept in it, and the attenuator status of all flares is found from it in step 2.
 
     Return:
     ------
@@ -358,20 +927,305 @@ def get_flares(tstart, tend, local_files_path):
 
     logging.info(f'Retrieving and processing flares between {tstart} and {tend}')
 
-    # step 1: Fetch the operational flare list
-    flare_list = fetch_operational_flare_list(tstart, tend)
+    result_store = FlareResultStore(resume_path) if resume_path is not None else None
+    attenuator_index = AttenuatorIndex(attenuator_index_path) if attenuator_index_path is not None else None
+
+    try:
+        # step 1: Fetch the operational flare list
+        flare_list = fetch_operational_flare_list(tstart, tend)
 
-    # step 2: filter to counts about 100 and get list of cpd files associated with each
-    flare_list_with_files = filter_and_associate_files(flare_list, local_files_path)
+        # step 2: filter to counts about 100 and get list of cpd files associated with each
+        flare_list_with_files = filter_and_associate_files(flare_list, local_files_path, result_store=result_store,
+                                                           attenuator_index=attenuator_index)
 
-    # step 3: estimate flare locations and get attenuator status
-    flare_list_with_locations = estimate_flare_locations_and_attenuator(flare_list_with_files)
+        # step 3: estimate flare locations and get attenuator status
+        flare_list_with_locations = estimate_flare_locations_and_attenuator(flare_list_with_files,
+                                                                            n_workers=n_workers,
+                                                                            result_store=result_store)
 
-    # step 4: get more coordinate information and tidy
-    final_flarelist_with_locations = merge_and_process_data(flare_list_with_locations)
+        # step 4: get more coordinate information and tidy
+        final_flarelist_with_locations = merge_and_process_data(flare_list_with_locations)
+    finally:
+        if attenuator_index is not None:
+            attenuator_index.close()
+        if result_store is not None:
+            result_store.close()
 
     logging.info('Flare processing completed successfully.')
 
     return final_flarelist_with_locations
 
 
+def iter_flares(tstart, tend, local_files_path, chunk_freq="MS", n_workers=1, resume_path=None,
+                attenuator_index_path=None):
+    """
+    Fetches and processes the flare list in chunks of time, yielding each chunk as soon as it is done.
+
+    `get_flares` runs each of its four steps over the whole time range before starting the next, so all
+    the intermediate lists of the whole time range are held in memory at once, and nothing is available
+    until the end. Here the time range is split at `chunk_freq` boundaries (every month by default), and
+    each chunk is run through all four steps and yielded before the next is fetched. The memory used is
+    then that of one chunk, whatever the length of the time range.
+
+    A flare returned by the Data Center for two neighbouring chunks (e.g. one that starts before a chunk
+    boundary and ends after it) is only processed with the first of them: flares whose `flare_id` was in
+    the previous chunk are dropped. Together the chunks give the same flares as `get_flares` over the whole
+    time range, whichever time the Data Center selects flares by.
+
+    Parameters:
+    ----------
+    tstart : str or `~astropy.time.Time`
+        Start time of the query in ISO format or as an Astropy Time object.
+    tend : str or `~astropy.time.Time`
+        End time of the query in ISO format or as an Astropy Time object.
+    local_files_path : str
+        Path to the directory containing local .fits files.
+    chunk_freq : str, default="MS"
+        pandas frequency string of the chunk boundaries, e.g. "MS" for the start of each month or "7D".
+    n_workers : int, default=1
+        Number of processes used to image the flares.
+    resume_path : str, optional
+        Path to a `FlareResultStore` database, see `get_flares`. A stopped run can be resumed from the
+        flares processed in the chunk it stopped in.
+    attenuator_index_path : str, optional
+        Path to an `AttenuatorIndex` database, see `get_flares`.
+
+    Yields:
+    ------
+    pd.DataFrame
+        The processed flares of each chunk that has any, as returned by `get_flares`, in time order.
+
+    Example Usage:
+    -------------
+    >>> from flarelist_generate import iter_flares
+    >>> for flares in iter_flares('2023-01-01', '2024-01-01', '/path/to/local/files'):
+    ...     print(len(flares))
+
+    """
+    warnings.filterwarnings("ignore", category=SunpyDeprecationWarning)
+
+    tstart, tend = Time(tstart), Time(tend)
+    inner = pd.date_range(tstart.datetime, tend.datetime, freq=chunk_freq)
+    inner = inner[(inner > tstart.datetime) & (inner < tend.datetime)]
+    boundaries = [tstart] + [Time(t.to_pydatetime()) for t in inner] + [tend]
+    logging.info(f'Retrieving and processing flares between {tstart} and {tend} in {len(boundaries) - 1} chunks')
+
+    result_store = FlareResultStore(resume_path) if resume_path is not None else None
+    attenuator_index = AttenuatorIndex(attenuator_index_path) if attenuator_index_path is not None else None
+    try:
+        previous_ids = set()
+        for chunk_start, chunk_end in zip(boundaries[:-1], boundaries[1:]):
+            flare_list = fetch_operational_flare_list(chunk_start, chunk_end)
+            if len(flare_list) == 0:
+                continue
+            # flares at the boundaries can be returned for both chunks, keep them in the first one
+            chunk_ids = set(flare_list["flare_id"])
+            flare_list = flare_list[~flare_list["flare_id"].isin(previous_ids)].reset_index(drop=True)
+            previous_ids = chunk_ids
+            if len(flare_list) == 0:
+                continue
+
+            flare_list_with_files = filter_and_associate_files(flare_list, local_files_path, result_store=result_store,
+                                                               attenuator_index=attenuator_index)
+            if len(flare_list_with_files) == 0:
+                continue
+            flare_list_with_locations = estimate_flare_locations_and_attenuator(flare_list_with_files,
+                                                                                n_workers=n_workers,
+                                                                                result_store=result_store)
+            del flare_list, flare_list_with_files
+            flares = merge_and_process_data(flare_list_with_locations)
+            del flare_list_with_locations
+            logging.info(f'Processed {len(flares)} flares between {chunk_start} and {chunk_end}')
+            yield flares
+    finally:
+        if attenuator_index is not None:
+            attenuator_index.close()
+        if result_store is not None:
+            result_store.close()
+
+
+def write_flares_csv(tstart, tend, local_files_path, filename, **kwargs):
+    """
+    Processes the flares between `tstart` and `tend` with `iter_flares`, appending each chunk to the
+    csv file `filename` as soon as it is done.
+
+    Any other keyword arguments are passed to `iter_flares`.
+
+    Return:
+    ------
+    int
+        The number of flares written.
+
+    Example Usage:
+    -------------
+    >>> from flarelist_generate import write_flares_csv
+    >>> write_flares_csv('2021-02-14', '2025-03-01', '/path/to/local/files', 'stix_flarelist_w_locations.csv')
+
+    """
+    n_flares = 0
+    for flares in iter_flares(tstart, tend, local_files_path, **kwargs):
+        flares.to_csv(filename, mode="w" if n_flares == 0 else "a", header=n_flares == 0, index=False)
+        n_flares += len(flares)
+        logging.info(f'Written {n_flares} flares to {filename}')
+    return n_flares
+
+
+def write_flares_parquet(tstart, tend, local_files_path, path, **kwargs):
+    """
+    Processes the flares between `tstart` and `tend` with `iter_flares`, writing each chunk to the
+    Parquet dataset `path` (partitioned by month, see `write_flarelist_parquet`) as soon as it is done.
+
+    The flares of an existing dataset that peak between `tstart` and `tend` are replaced, and all the
+    other flares are kept, including those of the same months outside the time range. A dataset can
+    then be extended, or a time range reprocessed, without rewriting the rest of it.
+
+    Any other keyword arguments are passed to `iter_flares`.
+
+    Return:
+    ------
+    int
+        The number of flares written.
+
+    Example Usage:
+    -------------
+    >>> from flarelist_generate import write_flares_parquet
+    >>> write_flares_parquet('2021-02-14', '2025-03-01', '/path/to/local/files', 'stix_flarelist_w_locations')
+    >>> flares = read_flarelist_parquet('stix_flarelist_w_locations', start='2024-05-01', end='2024-06-01')
+
+    """
+    tstart, tend = Time(tstart), Time(tend)
+    n_deleted = delete_flarelist_parquet_range(path, tstart.datetime, tend.datetime)
+    if n_deleted:
+        logging.info(f'Deleted {n_deleted} flares between {tstart} and {tend} from {path} to be reprocessed')
+
+    n_flares = 0
+    for flares in iter_flares(tstart, tend, local_files_path, **kwargs):
+        # merged with the flares already written for the same months
+        write_flarelist_parquet(flares, path)
+        n_flares += len(flares)
+        logging.info(f'Written {n_flares} flares to {path}')
+    return n_flares
+
+
+
+
+# columns of the final flarelist that are compared with the operational list to find changed flares
+_OPERATIONAL_COLUMNS_IN_FINAL = {"start_UTC": "start_UTC", "end_UTC": "end_UTC", "peak_UTC": "peak_UTC",
+                                 "LC0_PEAK_COUNTS_4S": "4-10 keV"}
+
+
+def update_flares(existing_flarelist, tend, local_files_path, lookback_days=7, n_workers=1, resume_path=None,
+                  save_csv=False, output_format="csv", threshold_counts=1000):
+    """
+    Incrementally updates an existing final flare list with new or changed flares from the operational list.
+
+    The operational flare list is fetched from `lookback_days` before the last flare in `existing_flarelist`
+    up to `tend`. Flares above `threshold_counts` whose `flare_id` is not in the existing list, or whose times
+    or 4-10 keV counts have changed, are run through steps 2-4 of `get_flares`, and the results are upserted
+    into the existing list (replacing any rows with the same `flare_id`). Flares of the existing list whose
+    counts have dropped below `threshold_counts` are removed from it.
+
+    Parameters:
+    ----------
+    existing_flarelist : pd.DataFrame or str
+        The final flare list (as returned by `get_flares`), or the path to its csv file or Parquet dataset.
+    tend : str or `~astropy.time.Time`
+        End time of the update.
+    local_files_path : str
+        Path to the directory containing local .fits files.
+    lookback_days : float, default=7
+        Number of days before the last flare in `existing_flarelist` to check for new or changed flares,
+        as the operational list can be updated after the fact.
+    n_workers : int, default=1
+        Number of processes used to image the flares.
+    resume_path : str, optional
+        Path to a `FlareResultStore` database, see `get_flares`. Stored results of changed flares are
+        discarded before they are processed again.
+    save_csv : bool, default=False
+        Save the updated flare list to a csv file, optional
+    output_format : str, default="csv"
+        Format of the saved file, "csv" or "parquet" (a dataset partitioned by month, see `write_flarelist_parquet`).
+    threshold_counts : float, default=1000
+        Only flares with counts in the 4-10 keV channel above this value are in the flare list,
+        as in `filter_and_associate_files`.
+
+    Return:
+    ------
+    pd.DataFrame
+        The updated flare list, sorted by peak time.
+
+    Example Usage:
+    -------------
+    >>> from flarelist_generate import update_flares
+    >>> flares = update_flares('stix_flarelist_w_locations_20210214_20250228.csv', '2025-03-01', '/path/to/local/files')
+
+    """
+    warnings.filterwarnings("ignore", category=SunpyDeprecationWarning)
+
+    if isinstance(existing_flarelist, str):
+        if is_parquet_path(existing_flarelist):
+            existing_flarelist = read_flarelist_parquet(existing_flarelist)
+        else:
+            existing_flarelist = pd.read_csv(existing_flarelist)
+    if isinstance(tend, str):
+        tend = Time(tend)
+
+    tstart = Time(pd.to_datetime(existing_flarelist["peak_UTC"]).max().to_pydatetime()) - lookback_days * u.day
+    logging.info(f'Updating flare list with flares between {tstart} and {tend}')
+
+    flare_list = fetch_operational_flare_list(tstart, tend)
+
+    # compare with the existing list to find new flares and flares that have changed
+    # the final list only has the flares above the threshold, so only those can be new
+    existing = existing_flarelist.set_index("flare_id")
+    is_known = flare_list["flare_id"].isin(existing.index)
+    above_threshold = flare_list["LC0_PEAK_COUNTS_4S"] >= threshold_counts
+    is_new = ~is_known & above_threshold
+    is_changed = pd.Series(False, index=flare_list.index)
+    known = flare_list[is_known]
+    for operational_col, final_col in _OPERATIONAL_COLUMNS_IN_FINAL.items():
+        old_values = existing.loc[known["flare_id"], final_col].to_numpy()
+        new_values = known[operational_col].to_numpy()
+        if operational_col.endswith("_UTC"):
+            old_values = pd.to_datetime(old_values, format="ISO8601")
+            new_values = pd.to_datetime(new_values, format="ISO8601")
+        is_changed[known.index] |= np.asarray(old_values != new_values)
+
+    # changed flares that are now below the threshold are removed rather than processed again
+    is_dropped = is_changed & ~above_threshold
+    is_changed &= above_threshold
+    flare_list_update = flare_list[is_new | is_changed].reset_index(drop=True)
+    logging.info(f'Found {is_new.sum()} new and {is_changed.sum()} changed flares, '
+                 f'and {is_dropped.sum()} flares now below the threshold')
+    existing_flarelist = existing_flarelist[~existing_flarelist["flare_id"].isin(flare_list[is_dropped]["flare_id"])]
+
+    result_store = FlareResultStore(resume_path) if resume_path is not None else None
+    if result_store is not None:
+        result_store.delete(flare_list[is_changed | is_dropped]["flare_id"])
+
+    flare_list_with_files = filter_and_associate_files(flare_list_update, local_files_path,
+                                                       threshold_counts=threshold_counts, result_store=result_store)
+    if len(flare_list_with_files) > 0:
+        flare_list_with_locations = estimate_flare_locations_and_attenuator(flare_list_with_files, n_workers=n_workers,
+                                                                            result_store=result_store)
+        updated_flares = merge_and_process_data(flare_list_with_locations)
+        # upsert: replace any existing rows of the updated flares
+        existing_flarelist = existing_flarelist[~existing_flarelist["flare_id"].isin(updated_flares["flare_id"])]
+        for name in updated_flares.columns:
+            # times read from Parquet are datetimes rather than strings
+            if name.endswith("_UTC") and pd.api.types.is_datetime64_any_dtype(existing_flarelist.get(name)):
+                updated_flares[name] = pd.to_datetime(updated_flares[name], format="ISO8601")
+        existing_flarelist = pd.concat([existing_flarelist, updated_flares])
+
+    if result_store is not None:
+        result_store.close()
+
+    flarelist_final = existing_flarelist.sort_values(by="peak_UTC", key=lambda t: pd.to_datetime(t, format="ISO8601")).reset_index(drop=True)
+    logging.info(f'Flare list updated with {len(flare_list_with_files)} flares.')
+
+    if save_csv:
+        times_flares = pd.to_datetime(flarelist_final["peak_UTC"])
+        filename = f"stix_flarelist_w_locations_{times_flares.min().strftime('%Y%m%d')}_{times_flares.max().strftime('%Y%m%d')}.csv"
+        _save_output(flarelist_final, filename, output_format, index=False, index_label=False)
+
+    return flarelist_final
@@ -1,10 +1,12 @@
 from astropy.time import Time
+import numpy as np
 import pandas as pd 
 from sunpy.net import Fido, attrs as a 
 from sunpy.time import parse_time, TimeRange
 from stixpy.net.client import STIXClient
 from datetime import datetime
 import re
+import logging
 from astropy import units as u 
 
 def parse_file_date_range(filename: str):
@@ -48,7 +50,153 @@ def find_matching_files(files, flare_time):
 
     return None  
 
-def search_remote_data(flare_row, path="/Users/laurahayes/esa_backup/flare_ana/stix_flarelists/generate_flarelist/pixel_data/{file}"):
+class FileIntervalIndex:
+    """
+    Sorted index of the time ranges covered by a set of STIX cpd files.
+
+    The time range of each file is parsed from its filename once, when the index is built,
+    and the files are sorted by start time. A flare time can then be matched to a file with a
+    binary search rather than parsing every filename for every flare.
+
+    Parameters
+    ----------
+    files : `list`
+        List of filenames. Files without a time range in the filename are ignored.
+
+    """
+
+    def __init__(self, files=()):
+        parsed = []
+        for file in files:
+            start_dt, end_dt = parse_file_date_range(file)
+            if start_dt and end_dt:
+                parsed.append((start_dt, end_dt, file))
+        self._build(parsed)
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        """
+        Build the index from already known time ranges (e.g. from the local file catalog)
+        rather than parsing the filenames.
+
+        Parameters
+        ----------
+        ranges : iterable of (datetime.datetime, datetime.datetime, str)
+            start time, end time and filename of each file.
+
+        """
+        index = cls()
+        index._build(list(ranges))
+        return index
+
+    def __len__(self):
+        return len(self.files)
+
+    def _build(self, parsed):
+        parsed = sorted(parsed, key=lambda p: p[0])
+        self.starts = np.array([p[0] for p in parsed], dtype="datetime64[ns]")
+        self.ends = np.array([p[1] for p in parsed], dtype="datetime64[ns]")
+        self.files = np.array([p[2] for p in parsed], dtype=object)
+        # running maximum of the end times - files can overlap, so this is used to know
+        # how far back from the search position a file could still contain a given time.
+        self._max_ends = np.maximum.accumulate(self.ends) if len(parsed) else self.ends
+        self._file_set = set(self.files)
+
+    def add(self, file):
+        """
+        Add a file (e.g. one that has just been downloaded) to the index.
+
+        The file is inserted at its position in the sorted index, rather than the index being rebuilt.
+        """
+        start_dt, end_dt = parse_file_date_range(file)
+        if not (start_dt and end_dt) or file in self._file_set:
+            return
+        start, end = np.datetime64(start_dt, "ns"), np.datetime64(end_dt, "ns")
+        i = np.searchsorted(self.starts, start, side="right")
+        self.starts = np.insert(self.starts, i, start)
+        self.ends = np.insert(self.ends, i, end)
+        self.files = np.insert(self.files, i, file)
+        # the running maximum up to the new file, which only changes after it where the new end is later
+        max_end = max(self._max_ends[i - 1], end) if i > 0 else end
+        self._max_ends = np.insert(self._max_ends, i, max_end)
+        self._max_ends[i + 1:] = np.maximum(self._max_ends[i + 1:], end)
+        self._file_set.add(file)
+
+    def find(self, flare_time):
+        """
+        Find a file that contains `flare_time`.
+
+        Parameters
+        ----------
+        flare_time : str or datetime.datetime
+            Time for which to find the matching file
+
+        Returns
+        ------
+        file : str or None
+
+        """
+        flare_dt = np.datetime64(pd.Timestamp(flare_time).to_datetime64(), "ns")
+        i = np.searchsorted(self.starts, flare_dt, side="right") - 1
+        # walk back over files starting before the flare time while any of them could still cover it
+        while i >= 0 and self._max_ends[i] >= flare_dt:
+            if self.ends[i] >= flare_dt:
+                return self.files[i]
+            i -= 1
+        return None
+
+    def find_many(self, flare_times):
+        """
+        Find a matching file for each time in `flare_times`.
+
+        Parameters
+        ----------
+        flare_times : array-like
+            Times (e.g. the `peak_UTC` column of the flarelist) for which to find matching files.
+
+        Returns
+        ------
+        `numpy.ndarray`
+            object array of filenames, with None where no file contains the time.
+
+        """
+        flare_dts = pd.to_datetime(pd.Series(flare_times)).to_numpy(dtype="datetime64[ns]")
+        matches = np.full(len(flare_dts), None, dtype=object)
+        if len(self) == 0:
+            return matches
+
+        idx = np.searchsorted(self.starts, flare_dts, side="right") - 1
+        has_candidate = idx >= 0
+        idx_clipped = np.clip(idx, 0, None)
+
+        # most files don't overlap, so the file starting just before the flare time is checked first
+        in_file = has_candidate & (self.ends[idx_clipped] >= flare_dts)
+        matches[in_file] = self.files[idx_clipped[in_file]]
+
+        # only need to search further back where an earlier (overlapping) file could contain the time
+        check_earlier = has_candidate & ~in_file & (self._max_ends[idx_clipped] >= flare_dts)
+        for j in np.flatnonzero(check_earlier):
+            matches[j] = self.find(flare_dts[j])
+
+        return matches
+
+
+def _flare_search_time_range(flare_row):
+    """
+    Time range to search for data of a flare, from the start to end time of the flare.
+    """
+    start_time = Time(flare_row["start_UTC"])
+    end_time = Time(flare_row["end_UTC"])
+
+    # adjusting the start time to pull from day before too if before 1am.
+    if int(start_time.strftime("%H")) <= 1:
+        start_time = start_time - 2 * u.hour
+
+    return start_time, end_time
+
+
+def search_remote_data(flare_row, path="/Users/laurahayes/esa_backup/flare_ana/stix_flarelists/generate_flarelist/pixel_data/{file}",
+                       download_manager=None):
     """
     Searches for remote data using Fido and returns the file if found, else None.
 
@@ -57,18 +205,17 @@ def search_remote_data(flare_row, path="/Users/laurahayes/esa_backup/flare_ana/s
     A row in the flarelist pandas dataframe for which it has the start, peak and end times
     named start_UTC, peak_UTC, end_UTC
 
+    download_manager : `DownloadManager`, optional
+        if given, the file is queued for download on the manager and a future is returned
+        instead of waiting for the download. If the download fails, the other matching files are tried.
+
     Returns:
     ------
     file : str or None
-        the downloaded file
+        the downloaded file (or a `concurrent.futures.Future` of it with a `download_manager`)
     """
 
-    start_time = Time(flare_row["start_UTC"])
-    end_time = Time(flare_row["end_UTC"])
-    
-    # adjusting the start time to pull from day before too if before 1am.
-    if int(start_time.strftime("%H")) <= 1:
-        start_time = start_time - 2 * u.hour
+    start_time, end_time = _flare_search_time_range(flare_row)
 
     res_sci = Fido.search(a.Time(start_time, end_time), a.Instrument.stix, a.stix.DataProduct.sci_xray_cpd)
     
@@ -76,15 +223,229 @@ def search_remote_data(flare_row, path="/Users/laurahayes/esa_backup/flare_ana/s
         return None
 
     # for each file, check whether the flare peak time is in the file
-    for j in range(len(res_sci["stix"])):
-        file_tr = TimeRange(res_sci["stix"][j][["Start Time", "End Time"]])
-        
-        if parse_time(flare_row["peak_UTC"]) in file_tr:
-            f = Fido.fetch(res_sci["stix"][j], path=path)
-
-            if f:
-                # there could be several files that satisfy this, but only need one. 
-                return f[0]  
+    matching = [res_sci["stix"][j] for j in range(len(res_sci["stix"]))
+                if parse_time(flare_row["peak_UTC"]) in TimeRange(res_sci["stix"][j][["Start Time", "End Time"]])]
+    if download_manager is not None:
+        return download_manager.submit_any(matching, path=path) if matching else None
+
+    for record in matching:
+        f = Fido.fetch(record, path=path)
+
+        if f:
+            # there could be several files that satisfy this, but only need one. 
+            return f[0]  
     
 
-    return None
\ No newline at end of file
+    return None
+
+
+def group_search_windows(flare_rows, max_gap=1 * u.day, max_window=1 * u.day):
+    """
+    Group flares into merged time windows so that they can be searched for together.
+
+    The search time range of each flare (see `search_remote_data`) is merged with the current
+    window if it starts within `max_gap` of the end of the window, as long as the window stays
+    shorter than `max_window`.
+
+    Parameters
+    ----------
+    flare_rows : pd.DataFrame
+        flares to group, with columns start_UTC, peak_UTC, end_UTC
+    max_gap : `astropy.units.Quantity`, optional
+        maximum gap between flares in the same window, default 1 day
+    max_window : `astropy.units.Quantity`, optional
+        maximum length of a window, default 1 day
+
+    Returns
+    -------
+    list of (`~astropy.time.Time`, `~astropy.time.Time`, list)
+        start, end and the index labels of the flares in each window.
+    """
+    ranges = sorted(((*_flare_search_time_range(row), i) for i, row in flare_rows.iterrows()),
+                    key=lambda r: r[0])
+
+    windows = []
+    for start_time, end_time, i in ranges:
+        if windows:
+            w_start, w_end, w_flares = windows[-1]
+            if start_time <= w_end + max_gap and max(end_time, w_end) - w_start <= max_window:
+                windows[-1] = (w_start, max(end_time, w_end), w_flares + [i])
+                continue
+        windows.append((start_time, end_time, [i]))
+
+    return windows
+
+
+def search_remote_data_batched(flare_rows, path, max_gap=1 * u.day, max_window=1 * u.day, client=Fido,
+                               local_files=None, download_manager=None):
+    """
+    Searches for remote data for many flares at once, making one search per merged time window
+    rather than one per flare.
+
+    The flares are grouped into time windows (see `group_search_windows`) and the cpd records returned
+    for all windows are collected. A download plan (see `plan_downloads`) then picks the smallest set
+    of files that contain the peak times of the flares, using the same rule as `search_remote_data`,
+    and each of these files is fetched only once. If a file fails to download, its flares are planned
+    again with the other files that contain them, as `search_remote_data` tries the next matching file.
+
+    Parameters
+    ----------
+    flare_rows : pd.DataFrame
+        flares to search data for, with columns start_UTC, peak_UTC, end_UTC
+    path : str
+        path to download files to, e.g. "./pixel_data/{file}"
+    max_gap : `astropy.units.Quantity`, optional
+        maximum gap between flares searched together, default 1 day
+    max_window : `astropy.units.Quantity`, optional
+        maximum length of a search window, default 1 day
+    client : optional
+        object with `search` and `fetch` methods like `sunpy.net.Fido`, defaults to `Fido`.
+        Useful to pass a local stand-in for testing.
+    local_files : `FileIntervalIndex`, optional
+        files already on disk, which are used in preference to remote files.
+    download_manager : `DownloadManager`, optional
+        fetch the files concurrently with this download manager.
+
+    Returns
+    -------
+    dict
+        mapping of flare index label to the file, or None if no file was found.
+    """
+    windows = group_search_windows(flare_rows, max_gap=max_gap, max_window=max_window)
+    logging.info(f"Searching remote data for {len(flare_rows)} flares in {len(windows)} windows")
+
+    records = []
+    for start_time, end_time, flare_ids in windows:
+        res_sci = client.search(a.Time(start_time, end_time), a.Instrument.stix, a.stix.DataProduct.sci_xray_cpd)
+        if len(res_sci) == 0 or len(res_sci["stix"]) == 0:
+            continue
+        records.extend(res_sci["stix"][j] for j in range(len(res_sci["stix"])))
+
+    plan = plan_downloads(flare_rows, records, local_files=local_files)
+    files = {i: None for i in flare_rows.index}
+    files.update(execute_download_plan(plan, path, client=client, download_manager=download_manager))
+
+    # replan the flares of failed downloads without the failed files, until all are covered or no file is left
+    failed_keys = set()
+    while True:
+        uncovered = [label for label, key in plan["remote"].items() if files[label] is None]
+        if not uncovered:
+            break
+        failed_keys.update(plan["remote"][label] for label in uncovered)
+        logging.warning(f"{len(failed_keys)} downloads failed, replanning {len(uncovered)} flares with other files")
+        records = [record for record in records if _record_key(record)[0] not in failed_keys]
+        plan = plan_downloads(flare_rows.loc[uncovered], records)
+        if not plan["records"]:
+            break
+        files.update(execute_download_plan(plan, path, client=client, download_manager=download_manager))
+    return files
+
+
+def _record_key(record):
+    # a remote file is identified by its request ID and start time
+    file_tr = TimeRange(record[["Start Time", "End Time"]])
+    return (record["Request ID"], file_tr.start.isot), file_tr
+
+
+def plan_downloads(flare_rows, records, local_files=None):
+    """
+    Work out the smallest set of cpd files needed to cover the peak times of a set of flares.
+
+    Flares with a peak time inside a file already on disk are assigned to that file. The remaining
+    peak times are covered with the fewest remote files: going through the peak times in order,
+    the first uncovered peak is assigned to the file containing it that extends furthest, which
+    then also covers all the following peaks up to its end. This greedy choice gives the minimal
+    number of files for covering points with intervals.
+
+    Parameters
+    ----------
+    flare_rows : pd.DataFrame
+        flares needing data, with a peak_UTC column
+    records : iterable
+        search result rows (e.g. from `Fido.search`) with "Start Time", "End Time" and "Request ID".
+        The same file may appear several times (e.g. from overlapping searches).
+    local_files : `FileIntervalIndex`, optional
+        files already on disk.
+
+    Returns
+    -------
+    dict
+        the download plan with keys:
+        "local" : mapping of flare index label to the local file,
+        "remote" : mapping of flare index label to the key of the record to fetch,
+        "records" : mapping of record key to the record, each file to fetch appearing once.
+    """
+    plan = {"local": {}, "remote": {}, "records": {}}
+
+    peak_times = pd.to_datetime(flare_rows["peak_UTC"]).to_numpy(dtype="datetime64[ns]")
+    labels = np.asarray(flare_rows.index)
+
+    if local_files is not None and len(local_files) > 0:
+        local_matches = local_files.find_many(flare_rows["peak_UTC"].to_numpy())
+        for label, file in zip(labels, local_matches):
+            if file is not None:
+                plan["local"][label] = file
+        need_remote = pd.isnull(local_matches)
+        peak_times, labels = peak_times[need_remote], labels[need_remote]
+
+    # unique remote files, keyed on request ID and start time
+    unique_records = {}
+    for record in records:
+        key, file_tr = _record_key(record)
+        unique_records.setdefault(key, (file_tr, record))
+
+    keys = list(unique_records)
+    starts = np.array([unique_records[k][0].start.datetime for k in keys], dtype="datetime64[ns]")
+    ends = np.array([unique_records[k][0].end.datetime for k in keys], dtype="datetime64[ns]")
+
+    order = np.argsort(peak_times, kind="stable")
+    current = None
+    for j in order:
+        peak_time = peak_times[j]
+        if current is None or ends[current] < peak_time:
+            covering = np.flatnonzero((starts <= peak_time) & (ends >= peak_time))
+            if len(covering) == 0:
+                continue
+            current = covering[np.argmax(ends[covering])]
+            plan["records"][keys[current]] = unique_records[keys[current]][1]
+        plan["remote"][labels[j]] = keys[current]
+
+    logging.info(f"Download plan: {len(plan['local'])} flares with local files, {len(plan['remote'])} flares "
+                 f"covered by {len(plan['records'])} remote files from {len(keys)} available")
+    return plan
+
+
+def execute_download_plan(plan, path, client=Fido, download_manager=None):
+    """
+    Fetch the files of a download plan (see `plan_downloads`), each exactly once.
+
+    Parameters
+    ----------
+    plan : dict
+        the download plan
+    path : str
+        path to download files to, e.g. "./pixel_data/{file}"
+    client : optional
+        object with a `fetch` method like `sunpy.net.Fido`, defaults to `Fido`.
+        Not used if a `download_manager` is given.
+    download_manager : `DownloadManager`, optional
+        fetch the files concurrently with this download manager.
+
+    Returns
+    -------
+    dict
+        mapping of flare index label to the file, or None if the download failed.
+    """
+    fetched = {}
+    if download_manager is not None:
+        futures = {key: download_manager.submit(record, path=path) for key, record in plan["records"].items()}
+        fetched = {key: future.result() for key, future in futures.items()}
+    else:
+        for key, record in plan["records"].items():
+            f = client.fetch(record, path=path)
+            fetched[key] = f[0] if f else None
+
+    files = dict(plan["local"])
+    for label, key in plan["remote"].items():
+        files[label] = fetched[key]
+    return files
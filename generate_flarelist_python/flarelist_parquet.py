@@ -0,0 +1,219 @@
+import os
+import shutil
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+
+# types of the flare list columns, where they differ from (or are wrongly inferred from) the csv files
+FLOAT32_COLUMNS = ["hpc_x_solo", "hpc_y_solo", "hpc_x_earth", "hpc_y_earth", "hgs_lon", "hgs_lat", "hgc_lon", "hgc_lat",
+                   "solo_position_lat", "solo_position_lon", "solo_position_AU_distance", "sidelobes_ratio",
+                   "loc_x", "loc_y", "loc_x_stix", "loc_y_stix"]
+CATEGORY_COLUMNS = ["GOES_class", "GOES_class_time_of_flare", "goes_estimated_min_class", "goes_estimated_max_class",
+                    "goes_estimated_mean_class"]
+BOOL_COLUMNS = ["visible_from_earth", "att_in", "attenuator", "attenuator_in", "error", "error_with_imaging"]
+
+PARTITION_COLUMN = "month"
+_PARTITIONING = ds.partitioning(pa.schema([(PARTITION_COLUMN, pa.string())]), flavor="hive")
+
+
+def flarelist_schema(flarelist):
+    """
+    Arrow schema of a flare list (or of the output of any step of `get_flares`).
+
+    The time columns (ending in `_UTC`) are timestamps, the coordinates float32, the GOES classes
+    categorical (dictionary encoded) and the flags booleans. The types of other columns are inferred.
+
+    Parameters
+    ----------
+    flarelist : pd.DataFrame
+
+    Returns
+    -------
+    `pyarrow.Schema`
+    """
+    inferred = pa.Schema.from_pandas(flarelist, preserve_index=False)
+    fields = []
+    for field in inferred:
+        if field.name.endswith("_UTC"):
+            field = field.with_type(pa.timestamp("ms"))
+        elif field.name in FLOAT32_COLUMNS:
+            field = field.with_type(pa.float32())
+        elif field.name in CATEGORY_COLUMNS:
+            field = field.with_type(pa.dictionary(pa.int32(), pa.string()))
+        elif field.name in BOOL_COLUMNS:
+            field = field.with_type(pa.bool_())
+        fields.append(field)
+    return pa.schema(fields)
+
+
+def to_arrow_table(flarelist, time_column="peak_UTC"):
+    """
+    Convert a flare list to an Arrow table with the `flarelist_schema` types, sorted by `time_column`
+    and with the `month` (YYYY-MM) of `time_column` added to partition it by.
+    """
+    flarelist = _normalise(flarelist).sort_values(time_column, kind="stable").reset_index(drop=True)
+    schema = flarelist_schema(flarelist)
+    flarelist[PARTITION_COLUMN] = flarelist[time_column].dt.strftime("%Y-%m")
+    return pa.Table.from_pandas(flarelist, schema=schema.append(pa.field(PARTITION_COLUMN, pa.string())),
+                                preserve_index=False)
+
+
+def write_flarelist_parquet(flarelist, path, time_column="peak_UTC", append=False, key="flare_id"):
+    """
+    Write a flare list to a Parquet dataset at `path`, partitioned by the month of `time_column`.
+
+    The dataset is a directory with a `month=YYYY-MM` directory for each month, holding the flares of
+    that month sorted by time. Readers can then skip the months (and the row groups within them) outside
+    a time range, and only read the columns they need (see `read_flarelist_parquet`).
+
+    The flares are merged with those already in the dataset for their months: existing rows with the
+    same `key` as a new row are replaced, and the other existing rows are kept, so writing part of a
+    month doesn't lose the rest of it. Without a `key` column, the existing rows from the first to the
+    last time of the new rows are replaced instead. To also remove flares that are no longer in a time
+    range, see `delete_flarelist_parquet_range`.
+
+    Parameters
+    ----------
+    flarelist : pd.DataFrame
+        The flare list, or the output of any step of `get_flares`.
+    path : str
+        Directory of the dataset.
+    time_column : str, default="peak_UTC"
+        Column of the times the flare list is partitioned by.
+    append : bool, default=False
+        Add the flares to those already in the dataset for their months without merging them,
+        e.g. for flares known not to be in the dataset yet.
+    key : str, default="flare_id"
+        Column identifying the flares, to find the existing rows that are replaced.
+
+    Example Usage:
+    -------------
+    >>> write_flarelist_parquet(flares, 'stix_flarelist_w_locations')
+    >>> flares = read_flarelist_parquet('stix_flarelist_w_locations', columns=['peak_UTC', 'hpc_x_solo'],
+    ...                                 start='2023-01-01', end='2023-02-01')
+
+    """
+    flarelist = _normalise(flarelist)
+    existing = pd.DataFrame() if append else _read_months(path, flarelist[time_column].dt.strftime("%Y-%m").unique())
+    if len(existing) > 0:
+        if key in existing.columns and key in flarelist.columns:
+            replaced = existing[key].isin(flarelist[key])
+        else:
+            replaced = existing[time_column].between(flarelist[time_column].min(), flarelist[time_column].max())
+        flarelist = pd.concat([_normalise(existing[~replaced.to_numpy()]), flarelist], ignore_index=True)
+    _write_months(flarelist, path, time_column=time_column, append=append)
+
+
+def delete_flarelist_parquet_range(path, start, end, time_column="peak_UTC"):
+    """
+    Delete the flares with `start <= time_column < end` from a dataset written with `write_flarelist_parquet`,
+    keeping the other flares of the months they are in.
+
+    Returns
+    -------
+    int
+        the number of flares deleted.
+    """
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    if not os.path.isdir(path) or start >= end:
+        return 0
+    months = pd.period_range(start, end - pd.Timedelta(1, "ms"), freq="M").strftime("%Y-%m")
+    existing = _read_months(path, months)
+    if len(existing) == 0:
+        return 0
+    in_range = ((existing[time_column] >= start) & (existing[time_column] < end)).to_numpy()
+    if in_range.any():
+        kept = existing[~in_range]
+        # months left without flares aren't rewritten, so their directories are removed
+        for month in set(existing.loc[in_range, time_column].dt.strftime("%Y-%m")):
+            shutil.rmtree(os.path.join(path, f"{PARTITION_COLUMN}={month}"), ignore_errors=True)
+        if len(kept) > 0:
+            _write_months(kept, path, time_column=time_column)
+    return int(in_range.sum())
+
+
+def read_flarelist_parquet(path, columns=None, start=None, end=None, time_column="peak_UTC"):
+    """
+    Read a flare list written with `write_flarelist_parquet`.
+
+    Only the `columns` asked for are read, and with a `start` and/or `end` time only the months that
+    overlap them are opened, and within those only the row groups whose `time_column` range overlaps them.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the dataset.
+    columns : list of str, optional
+        Columns to read, default is all (without the `month` partition column).
+    start, end : str or datetime, optional
+        Only read the flares with `start <= time_column < end`.
+    time_column : str, default="peak_UTC"
+        Column of the times the flare list is partitioned by.
+
+    Returns
+    -------
+    pd.DataFrame
+        the flares sorted by `time_column`.
+    """
+    dataset = ds.dataset(path, format="parquet", partitioning=_PARTITIONING)
+    conditions = []
+    if start is not None:
+        start = pd.Timestamp(start)
+        conditions += [ds.field(PARTITION_COLUMN) >= start.strftime("%Y-%m"),
+                       ds.field(time_column) >= pa.scalar(start.to_pydatetime(), type=pa.timestamp("ms"))]
+    if end is not None:
+        end = pd.Timestamp(end)
+        conditions += [ds.field(PARTITION_COLUMN) <= end.strftime("%Y-%m"),
+                       ds.field(time_column) < pa.scalar(end.to_pydatetime(), type=pa.timestamp("ms"))]
+    if columns is None:
+        columns = [name for name in dataset.schema.names if name != PARTITION_COLUMN]
+
+    flare_filter = None
+    for condition in conditions:
+        flare_filter = condition if flare_filter is None else flare_filter & condition
+    flarelist = dataset.to_table(columns=list(columns), filter=flare_filter).to_pandas()
+
+    if time_column in flarelist.columns:
+        flarelist = flarelist.sort_values(time_column, kind="stable").reset_index(drop=True)
+    return flarelist
+
+
+def _normalise(flarelist):
+    # the `flarelist_schema` types as pandas types, so flare lists read from csv and Parquet can be combined
+    flarelist = flarelist.loc[:, ~flarelist.columns.duplicated()].copy()
+    for name in flarelist.columns:
+        if name.endswith("_UTC"):
+            # times are UTC, stored without a time zone
+            flarelist[name] = pd.to_datetime(flarelist[name], format="ISO8601", utc=True).dt.tz_localize(None)
+        elif name in CATEGORY_COLUMNS:
+            flarelist[name] = flarelist[name].astype("string")
+        elif name in BOOL_COLUMNS:
+            flarelist[name] = flarelist[name].astype("boolean")
+    return flarelist
+
+
+def _read_months(path, months):
+    # all the rows of the `months` partitions of a dataset, empty if it doesn't exist yet
+    if not os.path.isdir(path) or len(months) == 0:
+        return pd.DataFrame()
+    dataset = ds.dataset(path, format="parquet", partitioning=_PARTITIONING)
+    columns = [name for name in dataset.schema.names if name != PARTITION_COLUMN]
+    return dataset.to_table(columns=columns, filter=ds.field(PARTITION_COLUMN).isin(list(months))).to_pandas()
+
+
+def _write_months(flarelist, path, time_column="peak_UTC", append=False):
+    # write the rows of each month, replacing the files of those months unless appending
+    table = to_arrow_table(flarelist, time_column=time_column)
+    ds.write_dataset(table, path, format="parquet", partitioning=_PARTITIONING,
+                     basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+                     existing_data_behavior="overwrite_or_ignore" if append else "delete_matching")
+
+
+def is_parquet_path(path):
+    """
+    Whether `path` is a flare list Parquet dataset (a directory, or a path ending in `.parquet`) rather than a csv file.
+    """
+    return os.path.isdir(path) or str(path).endswith(".parquet")
@@ -0,0 +1,106 @@
+import sqlite3
+
+import numpy as np
+
+
+LOCATION_COLUMNS = ["loc_x", "loc_y", "loc_x_stix", "loc_y_stix", "sidelobes_ratio", "error", "attenuator"]
+
+
+class FlareResultStore:
+    """
+    Durable store of per-flare pipeline results, keyed by `flare_id`, in a SQLite database.
+
+    The file association (step 2) and location/attenuator results (step 3) of `get_flares` are written
+    to the store as each flare is processed, so that if a run is stopped it can be resumed and only the
+    flares without stored results are processed again. Failed results (with `error` set) aren't stored,
+    so that those flares are retried on resume.
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite database, created if it does not exist.
+
+    Example Usage:
+    -------------
+    >>> store = FlareResultStore('stix_flarelist_results.sqlite')
+    >>> store.put_file(1234, '/path/to/file.fits')
+    >>> store.get_files()
+    {1234: '/path/to/file.fits'}
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # can be used from another thread (one at a time), e.g. off the event loop in `locate_flares_async`
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS files (flare_id PRIMARY KEY, filename TEXT)")
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS locations (flare_id PRIMARY KEY, "
+                           f"{', '.join(LOCATION_COLUMNS)})")
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+    def get_files(self):
+        """
+        Return the stored file associations as a dict of flare_id to filename.
+        """
+        return dict(self._conn.execute("SELECT flare_id, filename FROM files"))
+
+    def put_file(self, flare_id, filename):
+        """
+        Store the file associated with a flare.
+        """
+        with self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?)", (_to_key(flare_id), filename))
+
+    def get_locations(self):
+        """
+        Return the stored location results as a dict of flare_id to a dict of the results,
+        in the same form as returned for each flare by `estimate_flare_locations_and_attenuator`.
+        """
+        locations = {}
+        # failed results stored by earlier versions are left out, so that those flares are retried
+        for flare_id, *values in self._conn.execute(f"SELECT flare_id, {', '.join(LOCATION_COLUMNS)} FROM locations "
+                                                    f"WHERE NOT error"):
+            result = {"flare_id": flare_id}
+            for key, value in zip(LOCATION_COLUMNS, values):
+                if key in ("error", "attenuator"):
+                    result[key] = bool(value)
+                else:
+                    # NaN is stored as NULL by SQLite
+                    result[key] = np.nan if value is None else value
+            locations[flare_id] = result
+        return locations
+
+    def put_location(self, result):
+        """
+        Store the location results of a flare, given as a dict with `flare_id` and the `LOCATION_COLUMNS`.
+
+        Failed results (with `error` set) aren't stored, and replace any stored result of the flare,
+        so that a transient imaging or download failure is retried when the run is resumed.
+        """
+        if result["error"]:
+            with self._conn:
+                self._conn.execute("DELETE FROM locations WHERE flare_id = ?", (_to_key(result["flare_id"]),))
+            return
+        values = [_to_key(result["flare_id"])]
+        for key in LOCATION_COLUMNS:
+            value = result[key]
+            values.append(bool(value) if key in ("error", "attenuator") else float(value))
+        with self._conn:
+            self._conn.execute(f"INSERT OR REPLACE INTO locations VALUES ({', '.join(['?'] * len(values))})", values)
+
+    def delete(self, flare_ids):
+        """
+        Remove all stored results for the given flare_ids.
+        """
+        keys = [(_to_key(flare_id),) for flare_id in flare_ids]
+        with self._conn:
+            self._conn.executemany("DELETE FROM files WHERE flare_id = ?", keys)
+            self._conn.executemany("DELETE FROM locations WHERE flare_id = ?", keys)
+
+
+def _to_key(flare_id):
+    # numpy scalars (e.g. from a DataFrame row) can't be stored directly by sqlite3
+    return flare_id.item() if isinstance(flare_id, np.generic) else flare_id
@@ -1,14 +1,13 @@
 from astropy.time import Time
 from sunpy.time import parse_time, TimeRange
 from astropy import units as u 
-from stixdcpy.net import Request as jreq
 from stixpy.net.client import STIXClient
-import pandas as pd
-from astropy import units as u
 from sunpy.net import Fido, attrs as a 
 import sunpy.map
 import numpy as np 
 
+from flarelist_generate import fetch_operational_flare_list
+
 
 
 tstart = Time("2021-01-01")
@@ -42,34 +41,9 @@ def get_flarelist_from_datacenter(tstart, tend, save_csv=False):
 
     # theres a limit of 5000 flares that will be returned
     # from the stixdcpy API, so to take make sure we dont miss some
-    # we'll break up the times into intervals and make several searches and the
-    # concatentae together
-
-    # check if the time between start and end times is > 60 days
-    if (tend - tstart).datetime.days > 60:
-        times = [tstart.datetime]
-        tstart_new = tstart.copy()
-        while tstart_new<tend:
-            tstart_new += 60*u.day
-            times.append(tstart_new.datetime)
-    else:
-        times = [tstart, tend]
-
-    times[-1] = tend
-
-    flare_df_lists = []
-    for i in range(len(times)-1):
-        flares=jreq.fetch_flare_list(times[i], times[i+1])
-        print(len(flares))
-        f1 = pd.DataFrame(flares)
-        flare_df_lists.append(f1)
-
-
-    full_flare_list = pd.concat(flare_df_lists)
-
-    full_flare_list.drop_duplicates(inplace=True)
-    full_flare_list.sort_values(by="peak_UTC", inplace=True)
-    full_flare_list.reset_index(inplace=True, drop=True)
+    # the search is made in windows that are split in half whenever
+    # they hit the limit (see fetch_operational_flare_list)
+    full_flare_list = fetch_operational_flare_list(tstart, tend)
 
     if save_csv:
         full_flare_list.to_csv("stix_operational_flare_list_{:s}_{:s}.csv".format(tstart.strftime("%Y%m%d"), 
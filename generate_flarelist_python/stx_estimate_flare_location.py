@@ -1,9 +1,11 @@
+import os
+import logging
 from stixpy.map.stix import STIXMap  
-from stixpy.product import Product
 from stixpy.calibration.visibility import calibrate_visibility, create_meta_pixels, create_visibility
 from stixpy.coordinates.frames import STIXImaging
 from stixpy.coordinates.transforms import get_hpc_info
-from xrayvision.imaging import vis_to_image, vis_to_map
+from xrayvision.imaging import vis_to_image, vis_to_map, get_weights
+from scipy.ndimage import maximum_filter
 
 from sunpy.time import TimeRange, parse_time
 from sunpy.coordinates import frames, SphericalScreen
@@ -13,10 +15,15 @@ import matplotlib.pyplot as plt
 from astropy import units as u 
 from astropy.coordinates import SkyCoord
 import numpy as np 
+import pandas as pd
 from flarelist_coord_utils import get_rsun_obs
+from stx_product_cache import get_product
+from stx_product_slice import read_product_slice
+from stx_pixel_counts import PixelDataCounts
 
 
-def stx_estimate_flare_location(pixel_path, time_range, energy_range, plot=False):
+def stx_estimate_flare_location(pixel_path, time_range, energy_range, plot=False, validate_sidelobes=False,
+                                coarse_to_fine=False, coarse_factor=None, n_candidates=20, lazy_load=False):
     """
     Estimate the flare location using STIX imaging data.
 
@@ -29,8 +36,9 @@ def stx_estimate_flare_location(pixel_path, time_range, energy_range, plot=False
 
     Parameters
     ----------
-    pixel_path : str
-        Path to the STIX pixel data product file.
+    pixel_path : str or `stixpy.product.Product`
+        Path to the STIX pixel data product file, or an already loaded pixel data product.
+        Paths are opened through the shared product cache.
     time_range : `sunpy.time.TimeRange`
         The time range over which to estimate the flare location.
     energy_range : `astropy.units.Quantity`
@@ -38,6 +46,22 @@ def stx_estimate_flare_location(pixel_path, time_range, energy_range, plot=False
     plot : bool, optional
         If True, the function plots the back-projected images in both STIX and Helioprojective frames. 
         Default is False.
+    validate_sidelobes : bool, optional
+        If True, check the fast pixel-space sidelobes ratio against the `SkyCoord` calculation
+        (see `calculate_sidelobes_ratio`). Default is False.
+    coarse_to_fine : bool, optional
+        If True, find the peak with a back-projection on a `coarse_factor` times coarser grid, and only
+        back-project at full resolution in small windows around the candidate peaks and sidelobes
+        (see `_coarse_to_fine_image`). The rest of the full resolution image is left as NaN. Default is False.
+    coarse_factor : int, optional
+        Factor by which the pixels of the coarse image are larger. By default it is chosen from the
+        finest fringe period of the visibilities and the full resolution pixel size.
+    n_candidates : int, optional
+        Number of local maxima of the coarse image refined at full resolution, for both the peak and
+        the sidelobes. Default is 20.
+    lazy_load : bool, optional
+        If True and `pixel_path` is a path, only read the time bins of the file in `time_range`
+        (see `stx_product_slice.read_product_slice`) rather than the whole file. Default is False.
 
     Returns
     -------
@@ -58,44 +82,135 @@ def stx_estimate_flare_location(pixel_path, time_range, energy_range, plot=False
     
     """
 
-    cpd_sci = Product(pixel_path)
-    meta_pixels_sci = create_meta_pixels(cpd_sci, 
-                                         time_range=time_range, 
-                                         energy_range=energy_range, 
-                                         flare_location=[0, 0] * u.arcsec, 
-                                         no_shadowing=True)
+    imaging = prepare_flare_imaging(pixel_path, time_range, energy_range, lazy_load=lazy_load)
 
+    # get back projection image
+    if coarse_to_fine:
+        bp_image = _coarse_to_fine_image(imaging["vis"], imaging["imsize"], imaging["pixel"],
+                                         coarse_factor=coarse_factor, n_candidates=n_candidates)
+    else:
+        bp_image = vis_to_image(imaging["vis"], imaging["imsize"], pixel_size=imaging["pixel"])
+
+    return flare_location_from_image(bp_image, imaging, plot=plot, validate_sidelobes=validate_sidelobes)
+
+
+def prepare_flare_imaging(pixel_path, time_range, energy_range, counts=None, lazy_load=False):
+    """
+    Calibrated visibilities and image set up for the back-projection of a flare.
+
+    This is everything `stx_estimate_flare_location` does before making the back-projected image,
+    split out so the images of many flares can be made together (see `back_project_batch`).
+
+    Parameters
+    ----------
+    pixel_path : str or `stixpy.product.Product`
+        Path to the STIX pixel data product file, or an already loaded pixel data product.
+    time_range : `sunpy.time.TimeRange`
+        The time range over which to estimate the flare location.
+    energy_range : `astropy.units.Quantity`
+        The energy range (e.g., in keV) for the analysis.
+    counts : `stx_pixel_counts.PixelDataCounts`, optional
+        The counts of the pixel data product already held in memory, to cut the meta pixels from
+        rather than calling `create_meta_pixels` on the whole product.
+    lazy_load : bool, optional
+        If True and `pixel_path` is a path, only read the time bins of the file in `time_range`
+        rather than the whole file. Default is False.
+
+    Returns
+    -------
+    dict
+        with the calibrated visibilities of sub-collimators 7-10 (`vis`), the image size (`imsize`) and
+        pixel size (`pixel`), and the `solo` observer, `roll`, `center_coord` and `vis_tr` time range
+        needed to turn the image into a location with `flare_location_from_image`.
+    """
+    # `Product` is a factory rather than a class, so check for a path instead
+    if isinstance(pixel_path, (str, os.PathLike)):
+        cpd_sci = read_product_slice(pixel_path, time_range) if lazy_load else get_product(pixel_path)
+    else:
+        cpd_sci = pixel_path
+    if counts is not None:
+        meta_pixels_sci = counts.meta_pixels(time_range, energy_range)
+    else:
+        meta_pixels_sci = create_meta_pixels(cpd_sci, 
+                                             time_range=time_range, 
+                                             energy_range=energy_range, 
+                                             flare_location=[0, 0] * u.arcsec, 
+                                             no_shadowing=True)
+
+    return _prepare_imaging_from_meta_pixels(meta_pixels_sci)
+
+
+def _prepare_imaging_from_meta_pixels(meta_pixels_sci):
+    """
+    The imaging set up of `prepare_flare_imaging` from the meta pixels.
+    """
     # create visibilities
     vis = create_visibility(meta_pixels_sci)
     vis_tr = TimeRange(vis.meta["time_range"])
 
+    imaging = _imaging_frame(vis_tr)
+
+    # get calibrated visibilities - use center of Sun as phase center
+    imaging["vis"] = _imaging_visibilities(vis, imaging["center_coord"])
+    return imaging
+
+
+def _imaging_frame(vis_tr):
+    """
+    Observer, STIX imaging frame and image grid for back-projections over `vis_tr`.
+    """
     roll, solo_xyz, pointing = get_hpc_info(vis_tr.start, vis_tr.end)
     solo = frames.HeliographicStonyhurst(*solo_xyz, obstime=vis_tr.center, representation_type="cartesian")
 
     center_map = SkyCoord(0*u.arcsec, 0*u.arcsec, frame=frames.Helioprojective(observer=solo, obstime=solo.obstime))
     center_coord = center_map.transform_to(STIXImaging(obstime=vis_tr.start, obstime_end=vis_tr.end, observer=solo))
-    
-    # get calibrated visibilities - use center of Sun as phase center
-    cal_vis = calibrate_visibility(vis, flare_location=center_coord)
+
+    # set up image size
+    imsize = [512, 512] * u.pixel  
+
+    # to make sure the full Sun is within FOV - the 2.6 is taken to be the same as the IDL software
+    pixel = get_rsun_obs(solo) * 2.6 / imsize 
+
+    return {"imsize": imsize, "pixel": pixel, "solo": solo, "roll": roll, "center_coord": center_coord,
+            "vis_tr": vis_tr}
+
+
+def _imaging_visibilities(vis, phase_center):
+    """
+    Visibilities calibrated with `phase_center` as the phase center, of the sub-collimators used for imaging.
+    """
+    cal_vis = calibrate_visibility(vis, flare_location=phase_center)
     
     # order by sub-collimator e.g. 10a, 10b, 10c, 9a, 9b, 9c ....
     isc_10_7 = [3, 20, 22, 16, 14, 32, 21, 26, 4, 24, 8, 28]
     idx = np.argwhere(np.isin(cal_vis.meta["isc"], isc_10_7)).ravel()
 
     # only use subcolimators 7 - 10
-    vis10_7 = cal_vis[idx]
-    
+    return cal_vis[idx]
 
-    # set up image size
-    imsize = [512, 512] * u.pixel  
-
-    # to make sure the full Sun is within FOV - the 2.6 is taken to be the same as the IDL software
-    pixel = get_rsun_obs(solo) * 2.6 / imsize 
 
+def flare_location_from_image(bp_image, imaging, plot=False, validate_sidelobes=False):
+    """
+    Flare location and sidelobes ratio from the back-projected image of a flare.
 
-    # get back projection image
-    bp_image = vis_to_image(vis10_7, imsize, pixel_size=pixel)
+    Parameters
+    ----------
+    bp_image : `numpy.ndarray` or `astropy.units.Quantity`
+        The back-projected image, on the grid given by `imaging`.
+    imaging : dict
+        The imaging set up of the flare, as returned by `prepare_flare_imaging`.
+    plot : bool, optional
+        If True, plot the back-projected images in both STIX and Helioprojective frames. Default is False.
+    validate_sidelobes : bool, optional
+        If True, check the fast pixel-space sidelobes ratio against the `SkyCoord` calculation.
 
+    Returns
+    -------
+    max_stix, max_hpc, sidelobes_ratio
+        as returned by `stx_estimate_flare_location`.
+    """
+    pixel, solo, roll = imaging["pixel"], imaging["solo"], imaging["roll"]
+    center_coord, vis_tr = imaging["center_coord"], imaging["vis_tr"]
 
     # Make a sunpy map from the bp_image, in STIX imaging frame
     header = sunpy.map.make_fitswcs_header(
@@ -104,15 +219,15 @@ def stx_estimate_flare_location(pixel_path, time_range, energy_range, plot=False
     fd_bp_map = sunpy.map.Map((bp_image, header))
 
 
-    sidelobes_ratio = calculate_sidelobes_ratio(fd_bp_map)
+    sidelobes_ratio = calculate_sidelobes_ratio(fd_bp_map, validate=validate_sidelobes)
 
     # Make a sunpy map from the bp_image, in HPC from STIX observer
     hpc_ref = center_coord.transform_to(frames.Helioprojective(observer=solo, obstime=vis_tr.center)) 
     header_hp = sunpy.map.make_fitswcs_header(bp_image, hpc_ref, scale=pixel, rotation_angle=90 * u.deg + roll)
     hp_map = sunpy.map.Map((bp_image, header_hp))
 
-    # get the position of the max pixel
-    max_pixel = np.argwhere(fd_bp_map.data == fd_bp_map.data.max()).ravel() * u.pixel
+    # get the position of the max pixel (the coarse-to-fine image is NaN outside the refined windows)
+    max_pixel = np.argwhere(fd_bp_map.data == np.nanmax(fd_bp_map.data)).ravel() * u.pixel
     # get the world coord of the max pixel - (note WCS axes and array are reversed)
     max_stix = fd_bp_map.pixel_to_world(max_pixel[1], max_pixel[0])
 
@@ -145,7 +260,177 @@ def stx_estimate_flare_location(pixel_path, time_range, energy_range, plot=False
     return max_stix, max_hpc, sidelobes_ratio
 
 
-def calculate_sidelobes_ratio(bp_nat_map, threshold=200*u.arcsec):
+def stx_estimate_flare_location_track(pixel_path, time_range, energy_range, window=40 * u.s, step=10 * u.s,
+                                      counts=None):
+    """
+    Estimate the flare location as a function of time, from back-projections of sliding time windows.
+
+    The meta pixels of every window are made from the cumulative sums of the counts along the time axis
+    (see `PixelDataCounts.window_meta_pixels`), so each window costs the same however long it is, and the
+    file is only read and summed once. The pointing, observer and imaging frame are set up once for the
+    whole `time_range` (the roll and position of Solar Orbiter change by far less than the image pixel
+    size over a flare), the images of all windows are made together with `back_project_batch`, and all
+    the peaks are transformed to Helioprojective coordinates together. A location track therefore costs
+    little more than the single image of `stx_estimate_flare_location`.
+
+    Parameters
+    ----------
+    pixel_path : str or `stixpy.product.Product`
+        Path to the STIX pixel data product file, or an already loaded pixel data product.
+    time_range : list
+        Start and end of the track, e.g. the start and end of the flare.
+    energy_range : `astropy.units.Quantity`
+        The energy range (e.g., in keV) for the analysis.
+    window : `astropy.units.Quantity`, optional
+        Length of each time window. Default is 40 s, as used around the peak for the flarelist.
+    step : `astropy.units.Quantity`, optional
+        Time between the starts of consecutive windows. Default is 10 s.
+    counts : `stx_pixel_counts.PixelDataCounts`, optional
+        The counts of the pixel data product already held in memory.
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per window with the time range covered by its time bins (`start_UTC`, `end_UTC`), the location
+        in HPC (`loc_x`, `loc_y`) and STIX imaging (`loc_x_stix`, `loc_y_stix`) coordinates, the `sidelobes_ratio`,
+        and `error`, which is True (with NaN locations) for windows that can't be imaged, e.g. because
+        the attenuator moved during the window.
+    """
+    if counts is None:
+        # `Product` is a factory rather than a class, so check for a path instead
+        counts = PixelDataCounts(get_product(pixel_path) if isinstance(pixel_path, (str, os.PathLike)) else pixel_path)
+
+    windows = counts.window_indices(time_range, window, step)
+    pixel_data = counts.pixel_data
+    track = pd.DataFrame({"start_UTC": (pixel_data.times[windows[:, 0]] - pixel_data.duration[windows[:, 0]] / 2).isot,
+                          "end_UTC": (pixel_data.times[windows[:, 1]] + pixel_data.duration[windows[:, 1]] / 2).isot,
+                          "loc_x": np.nan, "loc_y": np.nan, "loc_x_stix": np.nan, "loc_y_stix": np.nan,
+                          "sidelobes_ratio": np.nan, "error": True})
+    if len(windows) == 0:
+        return track
+
+    imaging = _imaging_frame(TimeRange(time_range[0], time_range[1]))
+    center_coord, solo = imaging["center_coord"], imaging["solo"]
+
+    vis_list = {}
+    for n, (first, last) in enumerate(windows):
+        try:
+            vis = create_visibility(counts.window_meta_pixels(first, last, energy_range))
+            # phase center already in the STIX frame at the center of the window, so that
+            # `calibrate_visibility` doesn't look up the pointing and transform it again
+            vis_tr = TimeRange(vis.meta["time_range"])
+            phase_center = SkyCoord(center_coord.Tx, center_coord.Ty,
+                                    frame=STIXImaging(obstime=vis_tr.center, observer=solo))
+            vis_list[n] = _imaging_visibilities(vis, phase_center)
+        except Exception as e:
+            logging.debug(f"Can't image window {track['start_UTC'][n]} - {track['end_UTC'][n]}: {e}")
+
+    if vis_list:
+        bp_images = back_project_batch(list(vis_list.values()), imaging["imsize"],
+                                       [imaging["pixel"]] * len(vis_list))
+        max_stix, max_hpc, sidelobes_ratio = _locations_from_images(bp_images, imaging)
+        rows = list(vis_list)
+        track.loc[rows, "loc_x"] = max_hpc.Tx.value
+        track.loc[rows, "loc_y"] = max_hpc.Ty.value
+        track.loc[rows, "loc_x_stix"] = max_stix.Tx.value
+        track.loc[rows, "loc_y_stix"] = max_stix.Ty.value
+        track.loc[rows, "sidelobes_ratio"] = sidelobes_ratio
+        track.loc[rows, "error"] = False
+
+    return track
+
+
+def _locations_from_images(bp_images, imaging):
+    """
+    Locations and sidelobes ratios from back-projected images that are all on the grid and in the frame of
+    `imaging`, e.g. the time windows of a track.
+
+    The same as `flare_location_from_image` for each image, but the map headers are made once and the
+    peaks of all the images are transformed to Helioprojective coordinates together.
+    """
+    pixel, solo, roll = imaging["pixel"], imaging["solo"], imaging["roll"]
+    center_coord, vis_tr = imaging["center_coord"], imaging["vis_tr"]
+
+    header = sunpy.map.make_fitswcs_header(
+        bp_images[0], center_coord, telescope="STIX", observatory="Solar Orbiter", scale=pixel
+    )
+    hpc_ref = center_coord.transform_to(frames.Helioprojective(observer=solo, obstime=vis_tr.center))
+    header_hp = sunpy.map.make_fitswcs_header(bp_images[0], hpc_ref, scale=pixel, rotation_angle=90 * u.deg + roll)
+    hp_map = sunpy.map.Map((bp_images[0], header_hp))
+
+    sidelobes_ratio, max_pixels = [], []
+    for bp_image in bp_images:
+        fd_bp_map = sunpy.map.Map((bp_image, header))
+        sidelobes_ratio.append(calculate_sidelobes_ratio(fd_bp_map))
+        max_pixels.append(np.argwhere(fd_bp_map.data == np.nanmax(fd_bp_map.data))[0])
+    max_pixels = np.array(max_pixels) * u.pixel
+
+    # (note WCS axes and array are reversed)
+    max_stix = fd_bp_map.pixel_to_world(max_pixels[:, 1], max_pixels[:, 0])
+    with SphericalScreen(hp_map.observer_coordinate, only_off_disk=True):
+        max_hpc = max_stix.transform_to(hp_map.coordinate_frame)
+
+    return max_stix, max_hpc, np.array(sidelobes_ratio)
+
+
+def back_project_batch(vis_list, imsize, pixel_sizes):
+    """
+    Natural weighted back-projections of many flares at once.
+
+    All the visibilities must be of the same sub-collimators (the same u, v points), as is the case for
+    the flares imaged by `stx_estimate_flare_location`. The phase of each visibility at each image row and
+    column is then the same for all flares apart from a scaling by the pixel size, so it is calculated once
+    as a basis for the unit pixel, and each image is a product of two (image size x n visibilities) matrices:
+
+        image = Re( exp(-i p_y * basis_y) @ diag(vis * weights) @ exp(-i p_x * basis_x).T )
+
+    which is evaluated for all the flares with a single stacked `numpy.matmul`. This gives the same images
+    as `xrayvision.imaging.vis_to_image` (up to floating point rounding), but only needs
+    (rows + columns) x n visibilities complex exponentials per flare rather than rows x columns x n visibilities.
+
+    Parameters
+    ----------
+    vis_list : list of `xrayvision.visibility.Visibilities`
+        The (calibrated) visibilities of each flare.
+    imsize : `astropy.units.Quantity`
+        Shape of the images, in pixels.
+    pixel_sizes : list of `astropy.units.Quantity`
+        Pixel size of the image of each flare, as given to `vis_to_image`.
+
+    Returns
+    -------
+    `numpy.ndarray` or `astropy.units.Quantity`
+        images with shape (number of flares, rows, columns).
+    """
+    if len(vis_list) == 0:
+        return np.empty((0, *imsize.to_value(u.pixel).astype(int)))
+
+    uu = vis_list[0].u.to_value(1 / u.arcsec)
+    vv = vis_list[0].v.to_value(1 / u.arcsec)
+    for vis in vis_list[1:]:
+        same_uv = np.array_equal(vis.u.to_value(1 / u.arcsec), uu) and np.array_equal(vis.v.to_value(1 / u.arcsec), vv)
+        if not same_uv:
+            raise ValueError("All visibilities must have the same u, v points to be back-projected together")
+
+    n_rows, n_cols = imsize.to_value(u.pixel).astype(int)
+    # pixel offsets of the rows and columns from the centre, as in `xrayvision.transform.generate_xy`
+    basis_x = 2 * np.pi * (np.arange(n_cols) - n_cols / 2 + 0.5)[:, np.newaxis] * uu[np.newaxis, :]
+    basis_y = 2 * np.pi * (np.arange(n_rows) - n_rows / 2 + 0.5)[:, np.newaxis] * vv[np.newaxis, :]
+
+    # rows are y, with pixel_size[0], as in `vis_to_image`
+    pixel_sizes = np.array([np.broadcast_to(pixel.to_value(u.arcsec / u.pixel), 2) for pixel in pixel_sizes])
+    phase_y = np.exp(-1j * pixel_sizes[:, 0, np.newaxis, np.newaxis] * basis_y)
+    phase_x = np.exp(-1j * pixel_sizes[:, 1, np.newaxis, np.newaxis] * basis_x)
+
+    unit = getattr(vis_list[0].visibilities, "unit", None)
+    weighted = np.array([np.asarray(vis.visibilities.to_value(unit) if unit is not None else vis.visibilities)
+                         * get_weights(vis, scheme="natural") for vis in vis_list])
+
+    images = np.real(np.matmul(phase_y * weighted[:, np.newaxis, :], np.swapaxes(phase_x, 1, 2)))
+    return images * unit if unit is not None else images
+
+
+def calculate_sidelobes_ratio(bp_nat_map, threshold=200*u.arcsec, method="pixel", validate=False, atol=1e-3):
     """
 
     Calculate the sidelobes ratio for a back-projected image map.
@@ -162,6 +447,14 @@ def calculate_sidelobes_ratio(bp_nat_map, threshold=200*u.arcsec):
     threshold : `astropy.units.Quantity`, optional
         The angular separation threshold (in arcseconds) around the peak within which sidelobes are excluded from the calculation.
         Default is 200 arcseconds.
+    method : {"pixel", "skycoord"}, optional
+        How the distance from the peak is calculated. "pixel" (default) uses the plate scale of the map to get the
+        distance in pixel space, "skycoord" transforms every pixel to world coordinates and uses `SkyCoord.separation`.
+    validate : bool, optional
+        If True, calculate the ratio with both methods and log a warning if they differ by more than `atol`.
+        The "pixel" result is returned.
+    atol : float, optional
+        Absolute tolerance on the sidelobes ratio used when `validate=True`. Default is 1e-3.
 
     Returns
     -------
@@ -172,20 +465,138 @@ def calculate_sidelobes_ratio(bp_nat_map, threshold=200*u.arcsec):
     Notes
     -----
     - This is based upon the methodology in the STIX-GSW IDL software.
+    - The "pixel" method uses the small-angle approximation, which is valid for the ~1 degree field of view
+      of the full-disk back-projection. The exclusion mask then only differs from the "skycoord" one for pixels
+      lying right on the `threshold` boundary, which changes the ratio well within the default `atol`.
+    """
+    if method not in ("pixel", "skycoord"):
+        raise ValueError(f"method must be 'pixel' or 'skycoord', not {method}")
+
+    # NaN-aware so that images only calculated around the peak and sidelobes (coarse-to-fine mode) can be used
+    max_bp = np.nanmax(bp_nat_map.data)
+    ind_max = np.unravel_index(np.nanargmax(bp_nat_map.data, axis=None), bp_nat_map.data.shape)
+
+    if method == "skycoord" or validate:
+        mask_skycoord = _sidelobes_mask_skycoord(bp_nat_map, ind_max, threshold)
+        ratio_skycoord = np.nanmax(np.where(mask_skycoord, 0, bp_nat_map.data)) / max_bp
+        if method == "skycoord":
+            return ratio_skycoord
+
+    mask = _sidelobes_mask_pixel(bp_nat_map, ind_max, threshold)
+    bp_image_masked = np.copy(bp_nat_map.data)
+    bp_image_masked[mask] = 0
+
+    sidelobes_ratio = np.nanmax(bp_image_masked) / max_bp
+
+    if validate and not np.isclose(sidelobes_ratio, ratio_skycoord, rtol=0, atol=atol):
+        logging.warning(f"Sidelobes ratio from pixel mask ({sidelobes_ratio:.5f}) differs from SkyCoord "
+                        f"result ({ratio_skycoord:.5f}) by more than {atol}; "
+                        f"{np.count_nonzero(mask != mask_skycoord)} pixels differ in the mask")
+
+    return sidelobes_ratio
+
+
+def _sidelobes_mask_pixel(bp_nat_map, ind_max, threshold):
+    """
+    Mask of pixels within `threshold` of the peak pixel, using the plate scale of the map.
+    """
+    scale_x = bp_nat_map.scale.axis1.to_value(u.arcsec / u.pix)
+    scale_y = bp_nat_map.scale.axis2.to_value(u.arcsec / u.pix)
+    yy, xx = np.ogrid[:bp_nat_map.data.shape[0], :bp_nat_map.data.shape[1]]
+    distance_wrt_peak = np.hypot((xx - ind_max[1]) * scale_x, (yy - ind_max[0]) * scale_y)
+    return distance_wrt_peak <= threshold.to_value(u.arcsec)
+
+
+def _sidelobes_mask_skycoord(bp_nat_map, ind_max, threshold):
+    """
+    Mask of pixels within `threshold` of the peak pixel, using the world coordinates of every pixel.
     """
-    max_bp = np.max(bp_nat_map.data)
-    ind_max = np.unravel_index(np.argmax(bp_nat_map.data, axis=None), bp_nat_map.data.shape)
     max_bp_coord = bp_nat_map.pixel_to_world(ind_max[1] * u.pix, ind_max[0] * u.pix)
 
     yy, xx = np.indices(bp_nat_map.data.shape)
     world_coords = bp_nat_map.pixel_to_world(xx * u.pix, yy * u.pix)
     
     distance_wrt_peak = world_coords.separation(max_bp_coord)
-    
-    bp_image_masked = np.copy(bp_nat_map.data)
-    mask = distance_wrt_peak <= threshold
-    bp_image_masked[mask] = 0
+    return distance_wrt_peak <= threshold
 
-    sidelobes_ratio = np.max(bp_image_masked) / max_bp
-    
-    return sidelobes_ratio
+
+def _coarse_to_fine_image(vis, imsize, pixel, coarse_factor=None, n_candidates=20, threshold=200 * u.arcsec):
+    """
+    Back-projected image calculated at full resolution only around the peak and sidelobe candidates.
+
+    The full field of view is first back-projected on a grid with pixels `coarse_factor` times larger.
+    The `n_candidates` highest local maxima of this coarse image are then back-projected at full
+    resolution in windows of 3x3 coarse pixels around them, which gives the peak. The same is then done
+    for the highest local maxima of the coarse image outside `threshold` of the peak, so the largest
+    sidelobe (as used by `calculate_sidelobes_ratio`) is also found at full resolution. The full resolution
+    pixels are on the same grid as `vis_to_image(vis, imsize, pixel_size=pixel)`, so have the same values.
+
+    By default `coarse_factor` is chosen so there are at least 3 coarse pixels per period of the finest
+    fringe pattern of the visibilities (~120 arcsec for sub-collimators 7-10), so that no peak falls
+    between the coarse pixels. This gives larger factors (and speed-ups) the further Solar Orbiter is
+    from the Sun: for the 512x512 field of view of 2.6 solar radii, a factor of 8 at 1 AU down to 2 near
+    perihelion (~17 arcsec pixels), where the coarse image still has a quarter of the pixels. The full
+    image is only back-projected when the factor would be 1, i.e. pixels larger than ~40 arcsec.
+
+    Returns
+    -------
+    `numpy.ndarray` or `astropy.units.Quantity`
+        image of shape `imsize`, NaN outside the refined windows.
+    """
+    n_rows, n_cols = imsize.to_value(u.pixel).astype(int)
+    scale_y, scale_x = pixel.to_value(u.arcsec / u.pixel)
+    unit = getattr(vis.visibilities, "unit", None)
+
+    if coarse_factor is None:
+        finest_period = 1 / np.max(np.hypot(vis.u, vis.v).to_value(1 / u.arcsec))
+        coarse_factor = max(1, int(finest_period / (3 * max(scale_x, scale_y))))
+    if coarse_factor == 1:
+        return vis_to_image(vis, imsize, pixel_size=pixel)
+
+    # pixel centres, as in `xrayvision.transform.generate_xy` (rows are y, with pixel_size[0])
+    x = (np.arange(n_cols) - n_cols / 2 + 0.5) * scale_x
+    y = (np.arange(n_rows) - n_rows / 2 + 0.5) * scale_y
+    # coarse pixel i covers the full resolution rows (or columns) i * coarse_factor to (i + 1) * coarse_factor - 1
+    coarse_x = x[0] + (np.arange(-(-n_cols // coarse_factor)) * coarse_factor + (coarse_factor - 1) / 2) * scale_x
+    coarse_y = y[0] + (np.arange(-(-n_rows // coarse_factor)) * coarse_factor + (coarse_factor - 1) / 2) * scale_y
+    coarse_xx, coarse_yy = np.meshgrid(coarse_x, coarse_y)
+    coarse = _back_project_points(vis, coarse_xx.ravel(), coarse_yy.ravel()).reshape(coarse_xx.shape)
+
+    image = np.full((n_rows, n_cols), np.nan)
+
+    def refine(coarse_image):
+        local_max = np.isfinite(coarse_image) & (coarse_image == maximum_filter(coarse_image, size=3, mode="nearest"))
+        candidates = np.flatnonzero(local_max)
+        candidates = candidates[np.argsort(coarse_image.ravel()[candidates])[::-1][:n_candidates]]
+
+        todo = np.zeros_like(image, dtype=bool)
+        for i, j in zip(*np.unravel_index(candidates, coarse_image.shape)):
+            todo[max(i - 1, 0) * coarse_factor:(i + 2) * coarse_factor,
+                 max(j - 1, 0) * coarse_factor:(j + 2) * coarse_factor] = True
+        rows, cols = np.nonzero(todo & np.isnan(image))
+        image[rows, cols] = _back_project_points(vis, x[cols], y[rows])
+
+    refine(coarse)
+
+    # only keep coarse pixels which can contain full resolution pixels outside the threshold from the peak
+    peak_row, peak_col = np.unravel_index(np.nanargmax(image), image.shape)
+    half_diagonal = np.hypot(scale_x, scale_y) * coarse_factor / 2
+    distance = np.hypot(coarse_xx - x[peak_col], coarse_yy - y[peak_row])
+    refine(np.where(distance > threshold.to_value(u.arcsec) - half_diagonal, coarse, -np.inf))
+
+    return image * unit if unit is not None else image
+
+
+def _back_project_points(vis, x, y):
+    """
+    Natural weighted back-projection of `vis` at the points `x`, `y` (in arcsec).
+
+    This is the same calculation as `xrayvision.imaging.vis_to_image`, but for any set of points
+    rather than a full image grid.
+    """
+    weights = get_weights(vis, scheme="natural")
+    uu = vis.u.to_value(1 / u.arcsec)
+    vv = vis.v.to_value(1 / u.arcsec)
+    visibilities = np.asarray(getattr(vis.visibilities, "value", vis.visibilities))
+    phase = np.exp(-2j * np.pi * (x[:, np.newaxis] * uu[np.newaxis, :] + y[:, np.newaxis] * vv[np.newaxis, :]))
+    return np.real(np.sum(visibilities * weights * phase, axis=1))
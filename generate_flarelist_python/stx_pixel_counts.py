@@ -0,0 +1,242 @@
+import numpy as np
+from astropy import units as u
+from astropy.time import Time
+from sunpy.time import TimeRange
+from stixpy.calibration.livetime import get_livetime_fraction
+from stixpy.calibration.visibility import STIX_INSTRUMENT, _PIXEL_SLICES, get_elut_correction
+
+
+class PixelDataCounts:
+    """
+    Counts of a STIX pixel data product held in memory, from which the meta pixels of many time and
+    energy ranges are cut.
+
+    `stixpy.calibration.visibility.create_meta_pixels` works on the whole file each time it is called:
+    it calculates the live time fraction of every time bin, converts all the counts to float, and reads
+    the ELUT to correct the energy edges. This class does that work once for the file (and once per
+    energy range for the ELUT correction), so the meta pixels of each flare in the file only need the
+    counts of its time bins to be selected and summed.
+
+    For many (e.g. sliding) time windows in the same energy range, `window_meta_pixels` uses cumulative
+    sums of the counts, errors and live time along the time axis, so the meta pixels of any window are
+    the difference of two rows of these sums, however many time bins the window covers.
+
+    Parameters
+    ----------
+    pixel_data : `stixpy.product.Product`
+        The loaded pixel data product.
+    pixels : str, optional
+        The set of pixels used to make the meta pixels, as for `create_meta_pixels`. Default is "top+bot".
+
+    Example Usage:
+    -------------
+    >>> counts = PixelDataCounts(get_product(cpd_file))
+    >>> meta_pixels = counts.meta_pixels(time_range, [4, 16] * u.keV)
+
+    """
+
+    def __init__(self, pixel_data, pixels="top+bot"):
+        self.pixel_data = pixel_data
+        self.pixels = pixels
+        self._idx_pix = _PIXEL_SLICES.get(pixels.lower(), None)
+        if self._idx_pix is None:
+            raise ValueError(f"Unrecognised input for 'pixels': {pixels}. Supported values: {list(_PIXEL_SLICES.keys())}")
+
+        # start and end of each time bin, as datetime64 so each time range is a quick comparison
+        self._starts = (pixel_data.times - pixel_data.duration / 2).datetime64
+        self._ends = (pixel_data.times + pixel_data.duration / 2).datetime64
+
+        # Map the triggers to all 32 detectors
+        triggers = pixel_data.data["triggers"][:, STIX_INSTRUMENT.subcol_adc_mapping].astype(float)
+        timedel = pixel_data.data["timedel"].to("s").reshape(-1, 1)
+        self._livefrac, *_ = get_livetime_fraction(triggers / timedel)
+        self._livetime = self._livefrac * timedel
+
+        self._e_cor = {}
+        self._cumulative = {}
+
+        # number of changes of the columns that must be constant within a time range, up to each time bin
+        self._changes = sum(
+            np.concatenate([[0], np.any(np.diff(np.asarray(pixel_data.data[column]), axis=0) != 0,
+                                        axis=tuple(range(1, np.ndim(pixel_data.data[column]))))])
+            for column in ["rcr", "pixel_masks", "detector_masks"]
+        ).cumsum()
+
+    def time_indices(self, time_range):
+        """
+        Indices of the time bins that overlap `time_range`, selected in the same way as `create_meta_pixels`.
+        """
+        start, end = Time(time_range[0]).datetime64, Time(time_range[1]).datetime64
+        t_mask = (
+            (self._starts >= start) & (self._ends <= end)  # fully within the time range
+            | (start <= self._starts) & (end >= self._ends)  # fully overlaps the time range
+            | (self._starts <= start) & (self._ends >= start)  # starts within the time range
+            | (self._starts <= end) & (self._ends >= end)  # ends within the time range
+        )
+        return np.argwhere(t_mask).ravel()
+
+    def window_indices(self, time_range, window, step):
+        """
+        First and last time bin of each sliding window over `time_range`.
+
+        The windows are `window` long and start every `step` from the start of `time_range`, the last
+        one ending at or before its end. The time bins of each window are selected as in
+        `time_indices` (every bin overlapping the window), which for contiguous time bins is a binary search.
+
+        Returns
+        -------
+        `numpy.ndarray`
+            array of shape (number of windows, 2) with the first and last time bin index of each window.
+        """
+        start, end = Time(time_range[0]), Time(time_range[1])
+        n_windows = int(np.floor(((end - start - window) / step).decompose().value)) + 1
+        window_starts = (start + np.arange(max(n_windows, 0)) * step).datetime64
+        window_ends = (start + np.arange(max(n_windows, 0)) * step + window).datetime64
+        first = np.searchsorted(self._ends, window_starts, side="left")
+        last = np.searchsorted(self._starts, window_ends, side="right") - 1
+        return np.stack([first, last], axis=-1)
+
+    def window_meta_pixels(self, first, last, energy_range):
+        """
+        Meta pixels summed over the time bins `first` to `last` (inclusive) and `energy_range`, from the
+        cumulative sums along the time axis.
+
+        This gives the same result as `meta_pixels` for the time range of these bins, up to floating point
+        rounding of the sums.
+
+        Returns
+        -------
+        dict
+            the meta pixels, in the form returned by `create_meta_pixels`.
+        """
+        if first > last or first < 0 or last >= len(self._starts):
+            raise ValueError(f"No time bins between {first} and {last}")
+        if self._changes[last] != self._changes[first]:
+            raise ValueError(
+                "The following: rcr, pixel_masks or detector_masks changed in the selected time interval "
+                "please select a time interval where these are constant."
+            )
+
+        pixel_data = self.pixel_data
+        e_ind, ct_cumulative, ct_error2_cumulative, lt_cumulative = self._cumulative_sums(energy_range)
+        ct_summed = ct_cumulative[last + 1] - ct_cumulative[first]
+        ct_error_summed = np.sqrt(ct_error2_cumulative[last + 1] - ct_error2_cumulative[first])
+        lt = lt_cumulative[last + 1] - lt_cumulative[first]
+
+        time_range = TimeRange(
+            pixel_data.times[first] - pixel_data.duration[first] / 2,
+            pixel_data.times[last] + pixel_data.duration[last] / 2,
+        )
+        return self._to_meta_pixels(ct_summed, ct_error_summed, lt, e_ind, time_range, energy_range)
+
+    def meta_pixels(self, time_range, energy_range):
+        """
+        Meta pixels summed over `time_range` and `energy_range`.
+
+        This gives the same result as `create_meta_pixels(pixel_data, time_range, energy_range,
+        pixels=pixels, no_shadowing=True)`.
+
+        Parameters
+        ----------
+        time_range : list
+            Start and end times.
+        energy_range : `astropy.units.Quantity`
+            Start and end energies.
+
+        Returns
+        -------
+        dict
+            the meta pixels, in the form returned by `create_meta_pixels`.
+        """
+        pixel_data = self.pixel_data
+        t_ind = self.time_indices(time_range)
+        e_mask = (pixel_data.energies["e_low"] >= energy_range[0]) & (pixel_data.energies["e_high"] <= energy_range[1])
+        e_ind = np.argwhere(e_mask).ravel()
+
+        changed = []
+        for column in ["rcr", "pixel_masks", "detector_masks"]:
+            if np.unique(pixel_data.data[column][t_ind], axis=0).shape[0] != 1:
+                changed.append(column)
+        if len(changed) > 0:
+            raise ValueError(
+                f"The following: {', '.join(changed)} changed in the selected time interval "
+                f"please select a time interval where these are constant."
+            )
+
+        time_range = TimeRange(
+            pixel_data.times[t_ind[0]] - pixel_data.duration[t_ind[0]] / 2,
+            pixel_data.times[t_ind[-1]] + pixel_data.duration[t_ind[-1]] / 2,
+        )
+
+        # only the selected counts are converted, rather than the whole file
+        counts = pixel_data.data["counts"][t_ind].astype(float)
+        count_errors = np.sqrt(pixel_data.data["counts_comp_err"][t_ind].astype(float).value ** 2 + counts.value) * u.ct
+        ct, ct_error2 = self._energy_summed_counts(counts, count_errors, e_ind)
+        ct_summed, ct_error_summed = ct.sum(axis=0), np.sqrt(ct_error2.sum(axis=0))
+        lt = self._livetime[t_ind].sum(axis=0)
+
+        return self._to_meta_pixels(ct_summed, ct_error_summed, lt, e_ind, time_range, energy_range)
+
+    def _energy_summed_counts(self, counts, count_errors, e_ind):
+        """
+        Energy edge corrected counts and squared errors of each time bin, summed over energy.
+        """
+        e_cor_high, e_cor_low = self._energy_correction(e_ind)
+        idx_pix = self._idx_pix
+        ct = counts[..., idx_pix, e_ind]
+        ct[..., 0] = ct[..., 0] * e_cor_low[..., idx_pix]
+        ct[..., -1] = ct[..., -1] * e_cor_high[..., idx_pix]
+        ct_error = count_errors[..., idx_pix, e_ind]
+        ct_error[..., 0] = ct_error[..., 0] * e_cor_low[..., idx_pix]
+        ct_error[..., -1] = ct_error[..., -1] * e_cor_high[..., idx_pix]
+        return ct.sum(axis=3), np.sum(ct_error**2, axis=3)
+
+    def _cumulative_sums(self, energy_range):
+        # cumulative sums (with a leading zero) over the time bins of the energy summed counts,
+        # squared errors and live time, made once per energy range
+        key = tuple(u.Quantity(energy_range).to_value(u.keV))
+        if key not in self._cumulative:
+            pixel_data = self.pixel_data
+            e_mask = (pixel_data.energies["e_low"] >= energy_range[0]) & (pixel_data.energies["e_high"] <= energy_range[1])
+            e_ind = np.argwhere(e_mask).ravel()
+            counts = pixel_data.data["counts"].astype(float)
+            count_errors = np.sqrt(pixel_data.data["counts_comp_err"].astype(float).value ** 2 + counts.value) * u.ct
+            ct, ct_error2 = self._energy_summed_counts(counts, count_errors, e_ind)
+
+            def cumulative(values):
+                return np.concatenate([np.zeros((1, *values.shape[1:])) * values.unit, np.cumsum(values, axis=0)])
+
+            self._cumulative[key] = (e_ind, cumulative(ct), cumulative(ct_error2), cumulative(self._livetime))
+        return self._cumulative[key]
+
+    def _energy_correction(self, e_ind):
+        # the ELUT is read from file on each call, so keep the correction for each energy range
+        key = tuple(e_ind)
+        if key not in self._e_cor:
+            self._e_cor[key] = get_elut_correction(e_ind, self.pixel_data)
+        return self._e_cor[key]
+
+    def _to_meta_pixels(self, ct_summed, ct_error_summed, lt, e_ind, time_range, energy_range):
+        abcd_counts = ct_summed.reshape(ct_summed.shape[0], -1, 4).sum(axis=1)
+        abcd_count_errors = np.sqrt((ct_error_summed.reshape(ct_error_summed.shape[0], -1, 4) ** 2).sum(axis=1))
+
+        abcd_rate = abcd_counts / lt.reshape(-1, 1)
+        abcd_rate_error = abcd_count_errors / lt.reshape(-1, 1)
+
+        energies = self.pixel_data.energies
+        e_bin = energies[e_ind][-1]["e_high"] - energies[e_ind][0]["e_low"]
+        abcd_rate_kev = abcd_rate / e_bin
+        abcd_rate_error_kev = abcd_rate_error / e_bin
+
+        pixel_areas = STIX_INSTRUMENT.pixel_config["Area"].to("cm2")
+        areas = pixel_areas[self._idx_pix].reshape(-1, 4).sum(axis=0)
+
+        return {
+            "abcd_rate_kev": abcd_rate_kev,
+            "abcd_rate_kev_cm": abcd_rate_kev / areas,
+            "abcd_rate_error_kev_cm": abcd_rate_error_kev / areas,
+            "time_range": time_range,
+            "energy_range": energy_range,
+            "pixels": self.pixels,
+            "areas": areas,
+        }
@@ -0,0 +1,173 @@
+import logging
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+from astropy import units as u
+from astropy.io import fits
+from astropy.table import QTable, vstack
+from astropy.time import Time
+from sunpy.net import Fido, attrs as a
+import stixpy.coordinates.transforms as stx_transforms
+
+
+class PointingCache:
+    """
+    In-memory cache of the STIX aux (pointing/ephemeris) data, loaded once per day.
+
+    `stixpy.coordinates.transforms.get_hpc_info` gets the roll, Solar Orbiter position and pointing
+    by searching for, downloading and reading the aux files for the exact time range asked for, and it is
+    called for every flare (and again inside the STIX imaging frame transformations). This cache instead
+    loads each day of aux data once and keeps the roll, position and pointing columns as arrays in memory.
+    Lookups for a time range are then a slice of these arrays, which is averaged over by `get_hpc_info`.
+
+    Once `install()` is called, the lookups from `get_hpc_info` (including those made within the
+    coordinate frame transformations) are served from this cache. Worker processes don't share the
+    cache (or the installed lookups when they are spawned), so they are set up with `init_worker`.
+
+    Parameters
+    ----------
+    margin : `astropy.units.Quantity`, optional
+        Extra time either side of a requested time range that is returned, so there are aux data points
+        to interpolate between for short time ranges. Default is 10 minutes.
+
+    Example Usage:
+    -------------
+    >>> pointing_cache.install()
+    >>> pointing_cache.prefetch(flarelist["peak_UTC"])
+    >>> roll, solo_xyz, pointing = get_hpc_info(tstart, tend)
+
+    """
+
+    def __init__(self, margin=10 * u.min):
+        self.margin = timedelta(seconds=margin.to_value(u.s))
+        self._days = {}
+        self._day_times = {}
+
+    def __len__(self):
+        return len(self._days)
+
+    def install(self):
+        """
+        Serve the aux data lookups of `stixpy.coordinates.transforms.get_hpc_info` from this cache.
+        """
+        stx_transforms._get_ephemeris_data = self.aux_data
+
+    def prefetch(self, times):
+        """
+        Load the aux data for every day covering `times` (e.g. the `peak_UTC` column of a flarelist).
+        """
+        times = pd.to_datetime(pd.Series(times), format="ISO8601")
+        days = sorted(set(times.dt.date) | set((times - self.margin).dt.date) | set((times + self.margin).dt.date))
+        logging.info(f"Prefetching aux data for {len(days)} days")
+        for day in days:
+            self._load_day(day)
+
+    def loaded_days(self):
+        """
+        The aux data of the days loaded so far, by day, e.g. to pass to `init_worker`.
+        """
+        return dict(self._days)
+
+    def add_days(self, days):
+        """
+        Add aux data already loaded (by another cache, see `loaded_days`) to this cache.
+        """
+        for day, aux in days.items():
+            self._days[day] = aux
+            self._day_times[day] = aux["time"].datetime64
+
+    def aux_data(self, start_time, end_time=None):
+        """
+        Aux data from `start_time` to `end_time` (with `margin` either side), in the same form as
+        read by stixpy from the aux files.
+
+        Parameters
+        ----------
+        start_time : `astropy.time.Time`
+            Time or start of a time interval.
+        end_time : `astropy.time.Time`, optional
+            End of the time interval.
+
+        Returns
+        -------
+        `astropy.table.QTable`
+        """
+        if end_time is None:
+            end_time = start_time
+        start = Time(start_time).min().datetime - self.margin
+        end = Time(end_time).max().datetime + self.margin
+
+        day = start.date()
+        tables = []
+        while day <= end.date():
+            aux_day = self._load_day(day)
+            if len(aux_day) == 0:
+                # no data, or a failed download which isn't cached (so isn't in `_day_times`)
+                day += timedelta(days=1)
+                continue
+            times = self._day_times[day]
+            i0, i1 = np.searchsorted(times, [np.datetime64(start), np.datetime64(end)])
+            # include one point either side so there is always something to interpolate from
+            tables.append(aux_day[max(i0 - 1, 0):i1 + 1])
+            day += timedelta(days=1)
+
+        aux = vstack(tables) if len(tables) > 1 else (tables[0] if tables else [])
+        if len(aux) == 0:
+            raise ValueError(f"No STIX pointing data found for time range {start_time} to {end_time}.")
+        return aux
+
+    def _load_day(self, day):
+        if day in self._days:
+            return self._days[day]
+
+        day_start = Time(day.isoformat())
+        query = Fido.search(a.Time(day_start, day_start + 1 * u.day - 1 * u.s), a.Instrument.stix, a.Level.anc,
+                            a.stix.DataType.asp, a.stix.DataProduct.asp_ephemeris)
+        aux_data = []
+        if len(query["stix"]) > 0:
+            aux_files = Fido.fetch(query["stix"])
+            if aux_files.errors:
+                # not cached, so that the day is fetched again the next time it is needed
+                logging.warning(f"Failed to download the STIX pointing data for {day}: {aux_files.errors}")
+                aux = QTable()
+                aux["time"] = Time([], format="isot")
+                return aux
+            for aux_file in aux_files:
+                hdu = fits.getheader(aux_file, ext=0)
+                aux = QTable.read(aux_file, hdu=2)
+                # Shift AUX data by half a time bin (starting time vs. bin centre), as in stixpy
+                aux["time"] = Time(hdu.get("DATE-BEG")) + aux["time"] - 32 * u.s
+                aux_data.append(aux)
+
+        if aux_data:
+            aux = vstack(aux_data)
+            aux.sort(keys=["time"])
+            times = aux["time"].datetime64
+            # files can overlap the neighbouring days, only keep this day so rows aren't duplicated
+            in_day = (times >= np.datetime64(day)) & (times < np.datetime64(day + timedelta(days=1)))
+            aux = aux[in_day]
+        else:
+            logging.warning(f"No STIX pointing data found for {day}")
+            aux = QTable()
+            aux["time"] = Time([], format="isot")
+
+        self._days[day] = aux
+        self._day_times[day] = aux["time"].datetime64
+        return aux
+
+
+# shared pointing cache used across the pipeline
+pointing_cache = PointingCache()
+
+
+def init_worker(days):
+    """
+    Set up the shared pointing cache of a worker process: install it, and add the aux data of
+    `days` loaded by the parent process, as returned by `pointing_cache.loaded_days()`.
+
+    Used as the `initializer` of a process pool, as with the spawn start method (the default on
+    macOS and Windows) workers don't inherit the state of the parent process.
+    """
+    pointing_cache.install()
+    pointing_cache.add_days(days)
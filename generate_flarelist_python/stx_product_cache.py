@@ -0,0 +1,104 @@
+import os
+import logging
+from collections import OrderedDict
+
+from stixpy.product import Product
+
+
+class ProductCache:
+    """
+    A least-recently-used cache of opened STIX data products.
+
+    Opening a CPD file with `stixpy.product.Product` decodes the full FITS file, and many flares
+    share the same file. This cache keeps the parsed products in memory so that each file is only
+    decoded once per run. Entries are keyed by the file path and its modification time, so a file
+    that is re-downloaded or changed on disk is read again.
+
+    The cache is bounded both by the number of products and by the total size of the files on disk
+    (used as an estimate of the memory each decoded product takes up). When either limit is
+    exceeded the least recently used products are dropped.
+
+    Parameters
+    ----------
+    max_items : int, default=16
+        Maximum number of products to hold.
+    max_bytes : int, default=2GB
+        Maximum summed size (in bytes) of the files of the products held.
+
+    """
+
+    def __init__(self, max_items=16, max_bytes=2 * 1024**3):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._products = OrderedDict()
+        self._nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._products)
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def get(self, path):
+        """
+        Return the `Product` for the file at `path`, reading it from disk if it is not cached.
+
+        Parameters
+        ----------
+        path : str
+            Path to the STIX data product file.
+
+        Returns
+        -------
+        `stixpy.product.Product`
+
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns)
+
+        if key in self._products:
+            self.hits += 1
+            self._products.move_to_end(key)
+            return self._products[key][0]
+
+        self.misses += 1
+        # drop any older version of the same file
+        for old_key in [k for k in self._products if k[0] == path]:
+            self._remove(old_key)
+
+        product = Product(path)
+        self._products[key] = (product, stat.st_size)
+        self._nbytes += stat.st_size
+        self._evict()
+        return product
+
+    def clear(self):
+        """Remove all products from the cache."""
+        self._products.clear()
+        self._nbytes = 0
+
+    def _remove(self, key):
+        _, size = self._products.pop(key)
+        self._nbytes -= size
+
+    def _evict(self):
+        # always keep the most recent product even if it alone is over the byte limit
+        while len(self._products) > 1 and (len(self._products) > self.max_items or self._nbytes > self.max_bytes):
+            key = next(iter(self._products))
+            logging.debug(f"Evicting {key[0]} from product cache")
+            self._remove(key)
+
+
+# shared cache used across the pipeline (one per process)
+product_cache = ProductCache()
+
+
+def get_product(path):
+    """
+    Return the `stixpy.product.Product` for `path` from the shared product cache.
+    """
+    return product_cache.get(path)
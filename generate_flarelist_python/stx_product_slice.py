@@ -0,0 +1,132 @@
+import os
+
+import numpy as np
+from astropy import units as u
+from astropy.io import fits
+from astropy.table import QTable
+from astropy.time import Time
+from stixpy.product import Product
+from stixpy.product.product_factory import BITS_TO_UINT
+
+
+def read_product_slice(path, time_range):
+    """
+    Read the time bins of a STIX science data file that overlap `time_range` into a product.
+
+    `stixpy.product.Product` reads and decodes every row of the DATA table, while imaging a flare only
+    needs the ~40 s around its peak. Here the file is memory mapped and only the `time` and `timedel`
+    columns are read for all rows, to find the time bins overlapping `time_range` (selected in the same
+    way as `create_meta_pixels`). Only those rows of the DATA table are then read and decoded, so the
+    I/O and memory for each flare scale with its time range rather than the length of the file.
+
+    All energy channels of the selected rows are kept: the rows of a FITS table are stored contiguously,
+    so a subset of channels would not be any less to read, and the ELUT correction and energy masks of
+    the product index the full channel axis.
+
+    Parameters
+    ----------
+    path : str
+        Path to the STIX science data file.
+    time_range : list
+        Start and end times (anything `astropy.time.Time` understands).
+
+    Returns
+    -------
+    `stixpy.product.Product`
+        the same type of product as `Product(path)`, with only the selected time bins.
+
+    Example Usage:
+    -------------
+    >>> cpd_sci = read_product_slice(cpd_file, ["2023-05-01T12:00:00", "2023-05-01T12:00:40"])
+    >>> meta_pixels = create_meta_pixels(cpd_sci, time_range, energy_range, no_shadowing=True)
+
+    """
+    path = os.fspath(path)
+    with fits.open(path, memmap=True) as hdul:
+        meta = hdul[0].header
+        if meta.get("INSTRUME", "") != "STIX":
+            raise ValueError(f"File '{path}' is not a STIX fits file.")
+
+        rows = _time_rows(path, time_range)
+        if rows.stop <= rows.start:
+            raise ValueError(f"No time bins of '{path}' in the time range {time_range[0]} to {time_range[1]}")
+
+        product_data = {"meta": meta, "data": _read_table(hdul["DATA"], rows)}
+        for name in ["CONTROL", "IDB_VERSIONS", "ENERGIES"]:
+            try:
+                product_data[name.lower()] = _read_table(hdul[name])
+            except KeyError:
+                if name == "CONTROL":
+                    raise
+
+    # choose the product type from the header as `Product` does for a whole file
+    return Product._check_registered_widgets(**product_data)
+
+
+def _time_rows(path, time_range):
+    # the rows of the (time ordered) time bins that overlap the time range
+    with fits.open(path) as hdul:
+        meta = hdul[0].header
+        date_obs = meta["date-obs"] if "date-obs" in meta else meta["date_obs"]
+        times, durations = _column_seconds(path, hdul, "DATA", ["time", "timedel"])
+    start, end = ((Time(t) - Time(date_obs)).to_value(u.s) for t in time_range)
+    first = np.searchsorted(times + durations / 2, start, side="left")
+    last = np.searchsorted(times - durations / 2, end, side="right")
+    return slice(first, last)
+
+
+def _column_seconds(path, hdul, extname, names):
+    # Each value of a column is in a different (large) row, and reading a column through a memory map
+    # has the OS map in (and read ahead) most of the table. Instead just the bytes of the columns are
+    # read from each row, using the column definitions from the header without loading the table.
+    hdu = hdul[extname]
+    columns = hdu.columns
+    fields = [columns.dtype.fields[name] for name in names]
+    first_byte = min(offset for _, offset in fields)
+    n_bytes = max(offset + dtype.itemsize for dtype, offset in fields) - first_byte
+    data_offset = hdul.fileinfo(hdul.index_of(extname))["datLoc"] + first_byte
+    row_bytes = hdu.header["NAXIS1"]
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_RANDOM)
+        buffer = b"".join(os.pread(fd, n_bytes, data_offset + row * row_bytes) for row in range(hdu.header["NAXIS2"]))
+    finally:
+        os.close(fd)
+    # FITS tables are big endian
+    rows = np.frombuffer(buffer, dtype=np.dtype({"names": names,
+                                                 "formats": [dtype.newbyteorder(">") for dtype, _ in fields],
+                                                 "offsets": [offset - first_byte for _, offset in fields],
+                                                 "itemsize": n_bytes}))
+
+    seconds = []
+    for name in names:
+        column = columns[name]
+        values = rows[name].astype(float) * (column.bscale or 1) + (column.bzero or 0)
+        seconds.append((values * u.Unit(column.unit or "s")).to_value(u.s))
+    return seconds
+
+
+def _read_table(hdu, rows=None):
+    """
+    Read (the `rows` of) a table HDU into a QTable, keeping the dtypes of columns with units
+    as `stixpy.product.product_factory.read_qtable` does.
+    """
+    if rows is not None:
+        hdu = fits.BinTableHDU(data=hdu.data[rows], header=hdu.header)
+    qtable = QTable.read(hdu)
+
+    for col in hdu.columns:
+        if col.unit:
+            dtype = col.dtype
+            if col.bzero:
+                bits = np.log2(col.bzero)
+                if bits.is_integer():
+                    dtype = BITS_TO_UINT[int(bits + 1)]
+            if hasattr(dtype, "subdtype"):
+                dtype = dtype.base
+            qtable[col.name] = qtable[col.name].astype(dtype)
+
+    # copy so nothing refers to the memory mapped file once it is closed
+    return qtable.copy(copy_data=True)